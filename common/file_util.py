@@ -1,5 +1,6 @@
 import datetime
 import hashlib
+import json
 import os
 
 
@@ -23,6 +24,31 @@ def get_stripped_name(version, filename):
     raise ValueError(f"Invalid mp3 filename for adding stripped name: {filename}")
 
 
+# Where the cut plan of an episode is kept, next to it.
+def get_sidecar_name(filename):
+    if filename.endswith(".mp3"):
+        return f"{filename[:-4]}.edl.json"
+
+    raise ValueError(f"Invalid mp3 filename for a sidecar: {filename}")
+
+
+# Where the sponsor announcement number goes into an episode's cut plan, next
+# to its sidecar.
+def get_clip_name(filename, number):
+    return f"{get_sidecar_name(filename)[:-len('.json')]}.{number}.wav"
+
+
+# The episode a clip name from get_clip_name belongs to, or None if it isn't
+# one.
+def get_clip_episode(candidate):
+    if not candidate.endswith(".wav") or candidate.startswith("."):
+        return None
+    name, _, number = candidate[:-len(".wav")].rpartition(".")
+    if not number.isdigit() or not name.endswith(".edl"):
+        return None
+    return f"{name[:-len('.edl')]}.mp3"
+
+
 def is_stripped_filename(filename):
     return filename.split('.')[0].endswith("-stripped")
 
@@ -85,3 +111,146 @@ def get_day(path):
 
 def oldest_first(paths):
     return sorted(paths, key=get_day)
+
+
+def newest_first(paths):
+    return sorted(paths, key=get_day, reverse=True)
+
+
+# The manager tells the stripper how much each feed's backlog matters, by the
+# 'weight' of each feed in its config, in this file next to the feed
+# directories.
+FEED_WEIGHTS = 'feeds.json'
+
+
+def write_feed_weights(path, feeds):
+    weights = {feed['name']: feed.get('weight', 1) for feed in feeds}
+    temp = os.path.join(path, f'.{FEED_WEIGHTS}')
+    with open(temp, 'w') as file:
+        json.dump(weights, file, indent=1)
+    os.replace(temp, os.path.join(path, FEED_WEIGHTS))
+
+
+# Feeds missing from the file have a weight of 1.
+def read_feed_weights(path):
+    try:
+        with open(os.path.join(path, FEED_WEIGHTS)) as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+
+# What we can tell about an episode from its filename,
+# YYYY-MM-DD-feed-hash[-stripped][.version].mp3. Slotted, since an archive
+# directory has thousands of them.
+class Episode:
+    __slots__ = ('filename', 'date', 'feed', 'id_hash', 'stripped', 'version')
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.version = get_version_number(filename)
+        name = filename.split('.')[0]
+        self.stripped = name.endswith('-stripped')
+        if self.stripped:
+            name = name[:-len('-stripped')]
+        parts = name.split('-')
+        try:
+            self.date = datetime.date(int(parts[0]), int(parts[1]), int(parts[2]))
+            parts = parts[3:]
+        except (ValueError, IndexError):
+            self.date = None
+        self.id_hash = parts.pop() if len(parts) > 1 else None
+        self.feed = '-'.join(parts)
+
+    # The filename of the episode this is a stripped version of, or of
+    # itself, without a version.
+    def original(self):
+        name = get_without_version_number(self.filename)
+        if self.stripped:
+            return name[:-len('-stripped.mp3')] + '.mp3'
+        return name
+
+
+# The mp3 files in one feed directory, read with a single scandir, with the
+# stripped version of each episode found by its original's filename, and the
+# sponsor clips kept beside each by theirs.
+class FeedDirectory:
+    def __init__(self, path):
+        self.path = path
+        self.episodes = {}
+        self.stripped = {}
+        self.clips = {}
+        self.mtime = None
+        self.refresh()
+
+    def __contains__(self, filename):
+        return filename in self.episodes
+
+    def __iter__(self):
+        return iter(list(self.episodes.values()))
+
+    def __len__(self):
+        return len(self.episodes)
+
+    def add(self, filename):
+        episode = get_clip_episode(filename)
+        if episode is not None:
+            self.clips.setdefault(episode, set()).add(filename)
+            return
+        if (not filename.endswith('.mp3') or filename.startswith('.')
+                or filename in self.episodes):
+            return
+        episode = Episode(filename)
+        self.episodes[filename] = episode
+        if episode.stripped:
+            self.stripped.setdefault(episode.original(), filename)
+
+    def remove(self, filename):
+        clip_episode = get_clip_episode(filename)
+        if clip_episode is not None:
+            clips = self.clips.get(clip_episode, set())
+            clips.discard(filename)
+            if not clips:
+                self.clips.pop(clip_episode, None)
+            return
+        episode = self.episodes.pop(filename, None)
+        if episode and episode.stripped and self.stripped.get(episode.original()) == filename:
+            del self.stripped[episode.original()]
+            for other in self.episodes.values():
+                if other.stripped and other.original() == episode.original():
+                    self.stripped[other.original()] = other.filename
+                    break
+
+    # Catch up with files added or removed since we last looked. The
+    # directory's mtime tells us whether anything changed.
+    def refresh(self):
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+        if mtime is not None and mtime == self.mtime:
+            return False
+        self.mtime = mtime
+        filenames = set()
+        if mtime is not None:
+            with os.scandir(self.path) as entries:
+                filenames = {entry.name for entry in entries
+                             if entry.name.endswith('.mp3') or get_clip_episode(entry.name)}
+        known = self.episodes.keys() | {clip for clips in self.clips.values() for clip in clips}
+        for filename in known - filenames:
+            self.remove(filename)
+        for filename in sorted(filenames - known):
+            self.add(filename)
+        return True
+
+    def find_stripped(self, filename):
+        if filename.endswith('-stripped.mp3'):
+            return None
+        return self.stripped.get(get_without_version_number(filename))
+
+    # Episodes we have not stripped yet.
+    def unstripped(self):
+        return [
+            episode for episode in self
+            if not episode.stripped and episode.original() not in self.stripped
+        ]
@@ -0,0 +1,184 @@
+from contextlib import contextmanager
+import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import os
+import tempfile
+import threading
+import time
+
+# Seconds, from a quick ffprobe to a long episode.
+DEFAULT_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+
+
+def get_labels(labels):
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+
+def escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(labels, extra=()):
+    labels = list(labels) + list(extra)
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{escape(value)}"' for name, value in labels) + '}'
+
+
+def format_number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+# Counters, gauges and histograms, written in Prometheus' text format to a
+# file for node_exporter's textfile collector or served over HTTP, and JSON
+# log lines for anything timed or logged.
+class Metrics:
+    def __init__(self, prefix='', json_logs=False):
+        self.lock = threading.Lock()
+        self.configure(prefix, json_logs)
+        self.reset()
+
+    def configure(self, prefix='', json_logs=False):
+        self.prefix = f'{prefix}_' if prefix else ''
+        self.json_logs = json_logs
+
+    def reset(self):
+        with self.lock:
+            self.counters = {}
+            self.gauges = {}
+            # (name, labels) -> [count in each bucket, sum, count]
+            self.histograms = {}
+            self.buckets = {}
+
+    def count(self, name, value=1, **labels):
+        key = (name, get_labels(labels))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.gauges[(name, get_labels(labels))] = value
+
+    def observe(self, name, value, buckets=DEFAULT_BUCKETS, **labels):
+        key = (name, get_labels(labels))
+        with self.lock:
+            self.buckets.setdefault(name, tuple(buckets))
+            buckets = self.buckets[name]
+            histogram = self.histograms.setdefault(key, [[0] * len(buckets), 0, 0])
+            for number, bound in enumerate(buckets):
+                if value <= bound:
+                    histogram[0][number] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    # Observe how long the with block takes, and log it.
+    @contextmanager
+    def timer(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            self.observe(name, seconds, **labels)
+            self.log(name, seconds=round(seconds, 3), **labels)
+
+    def log(self, event, **fields):
+        if not self.json_logs:
+            return
+        print(json.dumps({
+            'time': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            'event': event,
+            **fields,
+        }, default=str))
+
+    # What has been recorded, to send from another process and merge there.
+    def snapshot(self):
+        with self.lock:
+            return {
+                'counters': dict(self.counters),
+                'histograms': {key: [list(value[0]), value[1], value[2]]
+                               for key, value in self.histograms.items()},
+                'buckets': dict(self.buckets),
+            }
+
+    def merge(self, snapshot):
+        with self.lock:
+            for key, value in snapshot['counters'].items():
+                self.counters[key] = self.counters.get(key, 0) + value
+            for name, buckets in snapshot['buckets'].items():
+                self.buckets.setdefault(name, buckets)
+            for key, (counts, total, count) in snapshot['histograms'].items():
+                histogram = self.histograms.setdefault(key, [[0] * len(counts), 0, 0])
+                histogram[0] = [a + b for a, b in zip(histogram[0], counts)]
+                histogram[1] += total
+                histogram[2] += count
+
+    def render(self):
+        lines = []
+        with self.lock:
+            for kind, values in (('counter', self.counters), ('gauge', self.gauges)):
+                for name in sorted({name for name, _ in values}):
+                    lines.append(f'# TYPE {self.prefix}{name} {kind}')
+                    for (other, labels), value in sorted(values.items()):
+                        if other == name:
+                            lines.append(f'{self.prefix}{name}{format_labels(labels)} '
+                                         f'{format_number(value)}')
+            for name in sorted({name for name, _ in self.histograms}):
+                full_name = f'{self.prefix}{name}'
+                lines.append(f'# TYPE {full_name} histogram')
+                for (other, labels), (counts, total, count) in sorted(self.histograms.items()):
+                    if other != name:
+                        continue
+                    for bound, bucket_count in zip(self.buckets[name] + (float('inf'),),
+                                                   counts + [count]):
+                        le = (('le', format_number(bound)),)
+                        lines.append(f'{full_name}_bucket{format_labels(labels, le)} '
+                                     f'{bucket_count}')
+                    lines.append(f'{full_name}_sum{format_labels(labels)} {format_number(total)}')
+                    lines.append(f'{full_name}_count{format_labels(labels)} {count}')
+        return '\n'.join(lines) + '\n'
+
+    # Replaced in one go, so the collector never reads half a file.
+    def write_textfile(self, path):
+        directory = os.path.dirname(os.path.abspath(path))
+        with tempfile.NamedTemporaryFile('w', dir=directory, prefix='.', delete=False) as file:
+            file.write(self.render())
+        os.replace(file.name, path)
+
+    # Serve /metrics on port from a daemon thread.
+    def serve(self, port):
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != '/metrics':
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer(('', port), Handler)
+        threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+        return server
+
+
+# Shared by everything in the process.
+metrics = Metrics()
+
+
+# Run function(*args) in a worker process, returning its result and what it
+# recorded, for the parent to merge.
+def collect(function, *args):
+    metrics.reset()
+    result = function(*args)
+    return result, metrics.snapshot()
@@ -1,15 +1,25 @@
 import datetime
+import os
+import tempfile
 import unittest
 
 from file_util import (
+    Episode,
+    FeedDirectory,
     build_filename,
+    get_clip_episode,
+    get_clip_name,
+    get_sidecar_name,
     get_stripped_name,
     matches_stripped_filename,
     find_stripped_filename,
     get_version_number,
     get_without_version_number,
     get_day,
-    oldest_first
+    newest_first,
+    oldest_first,
+    read_feed_weights,
+    write_feed_weights,
 )
 
 ENCODED_ID = '6ca13d52'
@@ -65,6 +75,23 @@ class TestFileUtil(unittest.TestCase):
         with self.assertRaises(ValueError):
             get_stripped_name('v9.9', 'foo.baz')
 
+    def test_get_sidecar_name(self):
+        self.assertEqual(
+            get_sidecar_name(f'2022-01-01-name-{ENCODED_ID}.mp3'),
+            f'2022-01-01-name-{ENCODED_ID}.edl.json'
+        )
+
+        with self.assertRaises(ValueError):
+            get_sidecar_name('foo.baz')
+
+    def test_get_clip_name(self):
+        filename = f'2022-01-01-name-{ENCODED_ID}.mp3'
+        self.assertEqual(get_clip_name(filename, 2), f'2022-01-01-name-{ENCODED_ID}.edl.2.wav')
+        self.assertEqual(get_clip_episode(get_clip_name(filename, 12)), filename)
+        self.assertIsNone(get_clip_episode(get_sidecar_name(filename)))
+        self.assertIsNone(get_clip_episode(f'2022-01-01-name-{ENCODED_ID}.edl.x.wav'))
+        self.assertIsNone(get_clip_episode(f'2022-01-01-name-{ENCODED_ID}.1.wav'))
+
     def test_is_stripped_filename(self):
         self.assertTrue(matches_stripped_filename('foo.mp3', 'foo-stripped.mp3'))
         self.assertTrue(matches_stripped_filename('foo/bar/baz.mp3', 'foo/bar/baz-stripped.mp3'))
@@ -138,3 +165,113 @@ class TestFileUtil(unittest.TestCase):
                 '/2/2/2/2/2022-01-03-name.py'
             ]
         )
+
+    def test_newest_first(self):
+        self.assertEqual(
+            newest_first([
+                '/1/2022-01-02-name.mp3',
+                '/2/2022-01-03-name.mp3',
+                '/3/2022-01-01-name.mp3'
+            ]),
+            [
+                '/2/2022-01-03-name.mp3',
+                '/1/2022-01-02-name.mp3',
+                '/3/2022-01-01-name.mp3'
+            ]
+        )
+
+    def test_feed_weights(self):
+        with tempfile.TemporaryDirectory() as path:
+            self.assertEqual(read_feed_weights(path), {})
+            write_feed_weights(path, [{'name': 'a', 'weight': 2.5}, {'name': 'b'}])
+            self.assertEqual(read_feed_weights(path), {'a': 2.5, 'b': 1})
+            self.assertEqual(os.listdir(path), ['feeds.json'])
+
+
+class TestFeedDirectory(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = self.directory.name
+        for filename in [
+            f'2022-01-01-my-feed-{ENCODED_ID}.mp3',
+            f'2022-01-01-my-feed-{ENCODED_ID}-stripped.v1.2.3.mp3',
+            '2022-01-02-my-feed-aaaaaaaa.mp3',
+            '2022-01-03-my-feed-bbbbbbbb.mp3.part',
+            'my-feed.xml',
+        ]:
+            self.touch(filename)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def touch(self, filename):
+        open(os.path.join(self.path, filename), 'w').close()
+
+    def test_episode(self):
+        episode = Episode(f'2022-01-01-my-feed-{ENCODED_ID}-stripped.v1.2.3.mp3')
+        self.assertEqual(episode.date, datetime.date(2022, 1, 1))
+        self.assertEqual(episode.feed, 'my-feed')
+        self.assertEqual(episode.id_hash, ENCODED_ID)
+        self.assertTrue(episode.stripped)
+        self.assertEqual(episode.version, 'v1.2.3')
+        self.assertEqual(episode.original(), f'2022-01-01-my-feed-{ENCODED_ID}.mp3')
+
+        episode = Episode('2022-01-01-name.mp3')
+        self.assertEqual((episode.feed, episode.id_hash, episode.stripped, episode.version),
+                         ('name', None, False, None))
+        self.assertIsNone(Episode('foo.mp3').date)
+
+    def test_find_stripped(self):
+        directory = FeedDirectory(self.path)
+        self.assertEqual(len(directory), 3)
+        self.assertIn('2022-01-02-my-feed-aaaaaaaa.mp3', directory)
+        self.assertEqual(
+            directory.find_stripped(f'2022-01-01-my-feed-{ENCODED_ID}.mp3'),
+            f'2022-01-01-my-feed-{ENCODED_ID}-stripped.v1.2.3.mp3'
+        )
+        self.assertIsNone(directory.find_stripped('2022-01-02-my-feed-aaaaaaaa.mp3'))
+        self.assertIsNone(directory.find_stripped('2022-01-01-name-stripped.mp3'))
+        self.assertEqual([episode.filename for episode in directory.unstripped()],
+                         ['2022-01-02-my-feed-aaaaaaaa.mp3'])
+
+    def test_refresh(self):
+        directory = FeedDirectory(self.path)
+        self.assertFalse(directory.refresh())
+
+        self.touch('2022-01-02-my-feed-aaaaaaaa-stripped.v2.mp3')
+        os.remove(os.path.join(self.path, f'2022-01-01-my-feed-{ENCODED_ID}-stripped.v1.2.3.mp3'))
+        # Make sure the mtime changes, however coarse the filesystem's clock.
+        os.utime(self.path, ns=(0, directory.mtime + 1))
+        self.assertTrue(directory.refresh())
+        self.assertIsNone(directory.find_stripped(f'2022-01-01-my-feed-{ENCODED_ID}.mp3'))
+        self.assertEqual(directory.find_stripped('2022-01-02-my-feed-aaaaaaaa.mp3'),
+                         '2022-01-02-my-feed-aaaaaaaa-stripped.v2.mp3')
+        self.assertEqual([episode.filename for episode in directory.unstripped()],
+                         [f'2022-01-01-my-feed-{ENCODED_ID}.mp3'])
+
+    def test_remove(self):
+        directory = FeedDirectory(self.path)
+        directory.add(f'2022-01-01-my-feed-{ENCODED_ID}-stripped.v2.mp3')
+        directory.remove(f'2022-01-01-my-feed-{ENCODED_ID}-stripped.v1.2.3.mp3')
+        self.assertEqual(directory.find_stripped(f'2022-01-01-my-feed-{ENCODED_ID}.mp3'),
+                         f'2022-01-01-my-feed-{ENCODED_ID}-stripped.v2.mp3')
+
+    def test_clips(self):
+        episode = f'2022-01-01-my-feed-{ENCODED_ID}.mp3'
+        self.touch(get_clip_name(episode, 0))
+        directory = FeedDirectory(self.path)
+        self.assertEqual(len(directory), 3)
+        self.assertEqual(directory.clips, {episode: {get_clip_name(episode, 0)}})
+
+        self.touch(get_clip_name(episode, 1))
+        os.utime(self.path, ns=(0, directory.mtime + 1))
+        directory.refresh()
+        self.assertEqual(directory.clips[episode],
+                         {get_clip_name(episode, 0), get_clip_name(episode, 1)})
+        directory.remove(get_clip_name(episode, 0))
+        directory.remove(get_clip_name(episode, 1))
+        self.assertEqual(directory.clips, {})
+
+    def test_missing(self):
+        directory = FeedDirectory(os.path.join(self.path, 'missing'))
+        self.assertEqual(len(directory), 0)
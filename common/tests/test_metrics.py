@@ -0,0 +1,112 @@
+import contextlib
+import io
+import json
+import os
+import pickle
+import tempfile
+import unittest
+import urllib.request
+
+from metrics import Metrics, collect, metrics
+
+
+class TestMetrics(unittest.TestCase):
+    def test_counter(self):
+        registry = Metrics('test')
+        registry.count('requests_total', endpoint='chat')
+        registry.count('requests_total', 2, endpoint='chat')
+        registry.count('requests_total', endpoint='speech')
+        text = registry.render()
+        self.assertIn('# TYPE test_requests_total counter', text)
+        self.assertIn('test_requests_total{endpoint="chat"} 3', text)
+        self.assertIn('test_requests_total{endpoint="speech"} 1', text)
+
+    def test_gauge(self):
+        registry = Metrics()
+        registry.set('depth', 4, stage='reduce')
+        registry.set('depth', 2, stage='reduce')
+        self.assertIn('depth{stage="reduce"} 2\n', registry.render())
+
+    def test_histogram(self):
+        registry = Metrics()
+        for value in (0.5, 3, 100):
+            registry.observe('seconds', value, buckets=(1, 10), stage='render')
+        text = registry.render()
+        self.assertIn('# TYPE seconds histogram', text)
+        self.assertIn('seconds_bucket{stage="render",le="1"} 1', text)
+        self.assertIn('seconds_bucket{stage="render",le="10"} 2', text)
+        self.assertIn('seconds_bucket{stage="render",le="+Inf"} 3', text)
+        self.assertIn('seconds_sum{stage="render"} 103.5', text)
+        self.assertIn('seconds_count{stage="render"} 3', text)
+
+    def test_escape_labels(self):
+        registry = Metrics()
+        registry.count('total', feed='say "hi"\n')
+        self.assertIn('total{feed="say \\"hi\\"\\n"} 1', registry.render())
+
+    def test_merge(self):
+        registry = Metrics()
+        registry.count('total')
+        registry.observe('seconds', 1)
+        other = Metrics()
+        other.count('total', 2)
+        other.observe('seconds', 2)
+        registry.merge(pickle.loads(pickle.dumps(other.snapshot())))
+        text = registry.render()
+        self.assertIn('total 3', text)
+        self.assertIn('seconds_count 2', text)
+        self.assertIn('seconds_sum 3', text)
+
+    def test_collect(self):
+        metrics.count('before')
+
+        def work(value):
+            metrics.count('work_total', value)
+            return value * 2
+
+        result, snapshot = collect(work, 21)
+        self.assertEqual(result, 42)
+        self.assertEqual(list(snapshot['counters']), [('work_total', ())])
+        metrics.reset()
+
+    def test_timer_logs_json(self):
+        registry = Metrics(json_logs=True)
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            with registry.timer('stage_seconds', stage='reduce'):
+                pass
+        line = json.loads(output.getvalue())
+        self.assertEqual((line['event'], line['stage']), ('stage_seconds', 'reduce'))
+        self.assertIn('stage_seconds_count{stage="reduce"} 1', registry.render())
+
+    def test_no_json_logs(self):
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            Metrics().log('event', value=1)
+        self.assertEqual(output.getvalue(), '')
+
+    def test_write_textfile(self):
+        registry = Metrics('test')
+        registry.count('total')
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'test.prom')
+            registry.write_textfile(path)
+            with open(path) as file:
+                self.assertEqual(file.read(), registry.render())
+            self.assertEqual(os.listdir(directory), ['test.prom'])
+
+    def test_serve(self):
+        registry = Metrics('test')
+        registry.count('total')
+        server = registry.serve(0)
+        try:
+            url = f'http://127.0.0.1:{server.server_address[1]}/metrics'
+            with urllib.request.urlopen(url) as response:
+                self.assertEqual(response.read().decode(), registry.render())
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+if __name__ == '__main__':
+    unittest.main()
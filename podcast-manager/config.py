@@ -1,3 +1,5 @@
+# An optional 'weight' (default 1) puts a feed's backlog ahead of feeds with
+# less weight when the stripper catches up.
 feeds = [
     {
         'name': '99pi',
@@ -2,6 +2,7 @@
 
 import datetime
 import os
+import time
 from time import sleep
 
 import click
@@ -10,9 +11,16 @@ import feedparser
 import requests
 
 try:
-    from ..common import build_filename, find_stripped_filename, is_old, get_version_number
+    from ..common import (
+        build_filename, FeedDirectory, is_old, get_sidecar_name, get_version_number,
+        write_feed_weights, metrics
+    )
 except ImportError:
-    from file_util import build_filename, find_stripped_filename, is_old, get_version_number
+    from file_util import (
+        build_filename, FeedDirectory, is_old, get_sidecar_name, get_version_number,
+        write_feed_weights
+    )
+    from metrics import metrics
 
 from config import feeds
 
@@ -32,25 +40,37 @@ def create_podcast_feed(podcast_root, parsed_input_feed, podcast_name):
     return output
 
 
-def download_episode(podcast_root, url, output_path):
+def download_episode(podcast_root, url, output_path, feed_name=None):
     headers = {
         'User-Agent': f'Mozilla/5.0 (compatible; PodcastDownloader/1.0; +{podcast_root})'
     }
 
+    # The stripper only sees the episode once it is complete and renamed.
+    partial_path = f'{output_path}.part'
+    feed_name = feed_name or os.path.basename(os.path.dirname(output_path))
+    downloaded = 0
     try:
-        response = requests.get(url, headers=headers, stream=True)
-        response.raise_for_status()
-
-        # Save the file
-        with open(output_path, 'wb') as f:
-            for chunk in response.iter_content(chunk_size=1024):
-                if chunk:
-                    f.write(chunk)
+        with metrics.timer('download_seconds', feed=feed_name):
+            response = requests.get(url, headers=headers, stream=True)
+            response.raise_for_status()
+
+            # Save the file
+            with open(partial_path, 'wb') as f:
+                for chunk in response.iter_content(chunk_size=1024):
+                    if chunk:
+                        f.write(chunk)
+                        downloaded += len(chunk)
+            os.replace(partial_path, output_path)
 
         print(f"Downloaded: {output_path} from {response.url}")
+        metrics.count('downloads_total', feed=feed_name, result='ok')
 
     except requests.exceptions.RequestException as e:
         print(f"Failed to download {output_path}: {e}")
+        metrics.count('downloads_total', feed=feed_name, result='failed')
+        if os.path.exists(partial_path):
+            os.remove(partial_path)
+    metrics.count('download_bytes_total', downloaded, feed=feed_name)
 
 
 def add_episode(output, input_episode, episode_url, stripper_version=None):
@@ -93,7 +113,26 @@ def generate_index(links):
     return index_html
 
 
-def purge_podcast_files(path):
+# An original goes with its sidecar and the sponsor announcements beside it,
+# which are no use without it.
+def remove_episode(directory, filename):
+    os.remove(os.path.join(directory.path, filename))
+    directory.remove(filename)
+    for clip in sorted(directory.clips.get(filename, ())):
+        directory.remove(clip)
+        try:
+            os.remove(os.path.join(directory.path, clip))
+        except FileNotFoundError:
+            pass
+    try:
+        os.remove(os.path.join(directory.path, get_sidecar_name(filename)))
+    except FileNotFoundError:
+        pass
+
+
+# With keep_originals, originals with a stripped version are kept, so the
+# stripper can render them again from their sidecars.
+def purge_podcast_files(path, keep_originals=False):
     for feed in feeds:
         feed_directory = os.path.join(path, feed['name'])
         if not os.path.exists(feed_directory):
@@ -101,16 +140,18 @@ def purge_podcast_files(path):
 
         since = datetime.datetime.strptime(feed['since'], "%Y-%m-%d")
 
-        for filename in os.listdir(feed_directory):
-            if not filename.endswith('.mp3'):
-                continue
-            if find_stripped_filename(filename, os.listdir(feed_directory)):
+        directory = FeedDirectory(feed_directory)
+        for episode in directory:
+            filename = episode.filename
+            if not keep_originals and directory.find_stripped(filename):
                 print(f'Deleting {filename} with stripped version.')
-                os.remove(os.path.join(feed_directory, filename))
+                metrics.count('purged_total', feed=feed['name'], reason='stripped')
+                remove_episode(directory, filename)
                 continue
             if is_old(filename, since):
                 print(f'Deleting old {filename}.')
-                os.remove(os.path.join(feed_directory, filename))
+                metrics.count('purged_total', feed=feed['name'], reason='old')
+                remove_episode(directory, filename)
 
 
 @click.command()
@@ -121,18 +162,36 @@ def purge_podcast_files(path):
               help='Manager will run again after this time.')
 @click.option('--download/--no-download', is_flag=True, envvar='DOWNLOAD', default=True,
               help='Actually download episodes.')
-def main(path, podcast_root, interval, download):
+@click.option('--keep-originals/--no-keep-originals', envvar='KEEP_ORIGINALS', default=False,
+              help='Keep episodes after they are stripped, to strip them again with '
+                   '"stripper.py rerender".')
+@click.option('--metrics-file', envvar='METRICS_FILE',
+              help="Write Prometheus metrics here, for node_exporter's textfile collector")
+@click.option('--metrics-port', envvar='METRICS_PORT', type=int,
+              help='Serve Prometheus metrics at /metrics on this port')
+@click.option('--json-logs/--no-json-logs', envvar='JSON_LOGS', default=False,
+              help='Also log timings as JSON lines')
+def main(path, podcast_root, interval, download, keep_originals, metrics_file, metrics_port,
+         json_logs):
     print(f'Publishing podcasts from {path} under {podcast_root} every {interval} seconds.')
+    metrics.configure('manager', json_logs)
+    if metrics_port:
+        metrics.serve(metrics_port)
     while True:
-        purge_podcast_files(path)
+        loop_start = time.perf_counter()
+        purge_podcast_files(path, keep_originals)
+        os.makedirs(path, exist_ok=True)
+        write_feed_weights(path, feeds)
         index_html_links = []
         for feed in feeds:
 
-            input = feedparser.parse(feed['url'])
+            with metrics.timer('fetch_seconds', feed=feed['name']):
+                input = feedparser.parse(feed['url'])
             output = create_podcast_feed(podcast_root, input, feed['name'])
 
             feed_directory = os.path.join(path, feed['name'])
             os.makedirs(feed_directory, exist_ok=True)
+            directory = FeedDirectory(feed_directory)
 
             for input_episode in input.entries:
                 published = datetime.datetime(*(input_episode['published_parsed'][0:6]))
@@ -149,13 +208,13 @@ def main(path, podcast_root, interval, download):
                     feed['name'],
                     input_episode.id
                 )
-                feed_files = os.listdir(feed_directory)
+                directory.refresh()
 
                 for link in [link
                              for link in input_episode.links
                              if link['type'] == 'audio/mpeg']:
 
-                    stripped_filename = find_stripped_filename(episode_filename, feed_files)
+                    stripped_filename = directory.find_stripped(episode_filename)
                     if stripped_filename:
                         add_episode(
                             output,
@@ -164,13 +223,14 @@ def main(path, podcast_root, interval, download):
                             stripper_version=get_version_number(stripped_filename)
                         )
                     else:
-                        if episode_filename not in feed_files:
+                        if episode_filename not in directory:
                             print(f"Downloading {episode_filename}.")
                             if download:
                                 download_episode(
                                     podcast_root,
                                     link['href'],
-                                    os.path.join(feed_directory, episode_filename)
+                                    os.path.join(feed_directory, episode_filename),
+                                    feed['name']
                                 )
                         add_episode(
                             output,
@@ -179,6 +239,8 @@ def main(path, podcast_root, interval, download):
                         )
 
             output.rss_file(os.path.join(path, f'{feed["name"]}.xml'))
+            directory.refresh()
+            metrics.set('episodes', len(directory), feed=feed['name'])
             index_html_links.append(
                 (feed['name'],
                  f'{podcast_root}/{feed["name"]}.xml'))
@@ -186,6 +248,12 @@ def main(path, podcast_root, interval, download):
         with open(os.path.join(path, "index.html"), "w") as index_html:
             index_html.write(generate_index(index_html_links))
 
+        loop_seconds = time.perf_counter() - loop_start
+        metrics.observe('loop_seconds', loop_seconds)
+        metrics.log('loop', seconds=round(loop_seconds, 3), feeds=len(feeds))
+        if metrics_file:
+            metrics.write_textfile(metrics_file)
+
         if interval != '0':
             print(f'will check back in {interval} seconds')
             sleep(int(interval))
@@ -0,0 +1,353 @@
+from concurrent.futures import Future
+import hashlib
+import os
+import queue
+import re
+import tempfile
+import threading
+import time
+import wave
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    import faster_whisper
+    from faster_whisper.tokenizer import Tokenizer
+except ImportError:
+    faster_whisper = None
+
+from openai import OpenAI
+
+from cache import get_key, to_namespace
+from ffmpeg_util import decode_pcm
+from openai_util import (
+    get_chunked_transcript,
+    get_commercials,
+    result_cache,
+    stitch_transcripts,
+    write_sponsor
+)
+
+try:
+    from ..common import metrics
+except ImportError:
+    from metrics import metrics
+
+# Where transcripts, commercials and sponsor announcements come from. Every
+# backend has some of these, listed in its CAPABILITIES:
+#
+#   transcribe(chunks, extension): the transcript of (offset, audio) chunks of
+#       one episode, as reduce_stage makes them.
+#   detect(transcript, lines, encoding, window): the commercials among lines
+#       of the transcript, in order, as they are found.
+#   speak(company, file): the path of an announcement of company, which is
+#       file unless it was cached.
+CAPABILITIES = ('transcribe', 'detect', 'speak')
+
+
+class OpenAIBackend:
+    CAPABILITIES = {'transcribe', 'detect', 'speak'}
+
+    def __init__(self, client):
+        self.client = client
+
+    def transcribe(self, chunks, extension='ogg'):
+        return get_chunked_transcript(self.client, chunks, extension)
+
+    def detect(self, transcript, lines=None, encoding='packed', window=0):
+        return get_commercials(self.client, transcript, lines, encoding, window, stream=True)
+
+    def speak(self, company, file=None):
+        return write_sponsor(self.client, company, file)
+
+
+# Answers straight away and always the same way, without a network or a
+# model, for trying things out and for tests. Halfway through every period
+# seconds of an episode is a commercial of length seconds for "Sponsor N",
+# counting periods from 0, and every line of it says so.
+class FakeBackend:
+    CAPABILITIES = {'transcribe', 'detect', 'speak'}
+    SPONSOR_LINE = re.compile(r'brought to you by (\w+ \d+)')
+
+    def __init__(self, line_seconds=4, period=600, length=60, speech_seconds=2):
+        self.line_seconds = line_seconds
+        self.period = period
+        self.length = length
+        self.speech_seconds = speech_seconds
+
+    def get_text(self, seconds):
+        number, into = divmod(seconds, self.period)
+        if self.period / 2 <= into < self.period / 2 + self.length:
+            return f'This episode is brought to you by Sponsor {int(number)}, use code PIZZA.'
+        return f'At {int(seconds)} seconds the hosts keep talking.'
+
+    def transcribe(self, chunks, extension='ogg'):
+        transcripts = []
+        for offset, audio in chunks:
+            duration = len(decode_pcm(audio, 8000)) / 2 / 8000
+            segments = [
+                {
+                    'id': line,
+                    'start': line * self.line_seconds,
+                    'end': min(duration, (line + 1) * self.line_seconds),
+                    'text': self.get_text(offset + line * self.line_seconds),
+                }
+                for line in range(int(-(-duration // self.line_seconds)))
+            ]
+            transcripts.append(to_namespace({
+                'text': ' '.join(segment['text'] for segment in segments),
+                'segments': segments,
+            }))
+        return stitch_transcripts(transcripts, [offset for offset, _ in chunks])
+
+    def detect(self, transcript, lines=None, encoding='packed', window=0):
+        if lines is None:
+            lines = range(len(transcript.segments))
+        commercial = None
+        for line in lines:
+            match = self.SPONSOR_LINE.search(transcript.segments[line].text)
+            if (commercial and match and commercial['end_line'] == line - 1
+                    and commercial['sponsor'] == match.group(1)):
+                commercial['end_line'] = line
+                continue
+            if commercial:
+                yield commercial
+            commercial = None
+            if match:
+                commercial = {'sponsor': match.group(1), 'start_line': line, 'end_line': line}
+        if commercial:
+            yield commercial
+
+    def speak(self, company, file=None):
+        if file is None:
+            with tempfile.NamedTemporaryFile(delete=False, suffix='.wav') as temp:
+                file = temp.name
+        with wave.open(file, 'wb') as output:
+            output.setnchannels(1)
+            output.setsampwidth(2)
+            output.setframerate(24000)
+            output.writeframes(bytes(2 * 24000 * self.speech_seconds))
+        return file
+
+
+# Gathers items submitted from any number of threads into batches of up to
+# size items for one call of run(items), which returns a result for each.
+# Once a batch has an item, it waits up to max_wait seconds for more.
+class Batcher:
+    def __init__(self, run, size=8, max_wait=0.2):
+        self.run = run
+        self.size = size
+        self.max_wait = max_wait
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def submit(self, item):
+        future = Future()
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.loop, name='batcher', daemon=True)
+                self.thread.start()
+        self.queue.put((item, future))
+        return future
+
+    def next_batch(self):
+        batch = [self.queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.size:
+            try:
+                batch.append(self.queue.get(timeout=max(0, deadline - time.monotonic())))
+            except queue.Empty:
+                break
+        return batch
+
+    def loop(self):
+        while True:
+            batch = self.next_batch()
+            try:
+                results = self.run([item for item, _ in batch])
+            except Exception as error:
+                for _, future in batch:
+                    future.set_exception(error)
+                continue
+            for (_, future), result in zip(batch, results):
+                future.set_result(result)
+
+
+# Whisper hears 30 seconds at a time, as 3000 frames of log-mel features.
+SAMPLE_RATE = 16000
+WINDOW_SECONDS = 30
+WINDOW_FRAMES = 3000
+MAX_TOKENS = 448
+TIME_PRECISION = 0.02
+
+
+def split_windows(samples, rate=SAMPLE_RATE, seconds=WINDOW_SECONDS):
+    size = rate * seconds
+    return [samples[start:start + size] for start in range(0, len(samples), size)]
+
+
+# The (start, end, text) segments of the tokens Whisper gave for a window.
+# Text is between a pair of timestamp tokens.
+def get_segments(tokens, timestamp_begin, eot, decode):
+    segments = []
+    start = None
+    text = []
+    for token in tokens:
+        if token >= timestamp_begin:
+            # A timestamp ends the text before it and starts the text after
+            # it, whether or not the model repeats it for the next segment.
+            seconds = (token - timestamp_begin) * TIME_PRECISION
+            if text:
+                segments.append((start or 0, seconds, decode(text).strip()))
+                text = []
+            start = seconds
+        elif token < eot:
+            text.append(token)
+    if text:
+        segments.append((start or 0, WINDOW_SECONDS, decode(text).strip()))
+    return segments
+
+
+# A transcript of consecutive windows' segments.
+def join_windows(window_segments):
+    segments = []
+    for number, window in enumerate(window_segments):
+        offset = number * WINDOW_SECONDS
+        for start, end, text in window:
+            segments.append({
+                'id': len(segments),
+                'start': offset + start,
+                'end': offset + min(end, WINDOW_SECONDS),
+                'text': text,
+            })
+    return {'text': ' '.join(segment['text'] for segment in segments), 'segments': segments}
+
+
+# Whisper on the CPU with CTranslate2, through faster-whisper. The model is
+# loaded once, from a local directory, and stays loaded. Every window of every
+# episode being transcribed goes through one Batcher, so episodes analyzed at
+# the same time share calls of the model.
+class LocalBackend:
+    CAPABILITIES = {'transcribe'}
+
+    def __init__(self, model_path, batch_size=8, max_wait=0.2, threads=0, language='en'):
+        self.model_path = model_path
+        self.threads = threads
+        self.language = language
+        self.model = None
+        self.tokenizer = None
+        self.batcher = Batcher(self.run_batch, batch_size, max_wait)
+
+    # Only the batcher's thread uses the model.
+    def get_model(self):
+        if self.model is None:
+            print(f'Loading {self.model_path}')
+            self.model = faster_whisper.WhisperModel(
+                self.model_path, device='cpu', compute_type='int8', cpu_threads=self.threads)
+            self.tokenizer = Tokenizer(
+                self.model.hf_tokenizer,
+                self.model.model.is_multilingual,
+                task='transcribe',
+                language=self.language
+            )
+        return self.model
+
+    def get_features(self, window):
+        features = self.model.feature_extractor(window)[:, :WINDOW_FRAMES]
+        return np.pad(features, ((0, 0), (0, WINDOW_FRAMES - features.shape[1])))
+
+    def run_batch(self, windows):
+        model = self.get_model()
+        metrics.observe('model_batch_windows', len(windows), buckets=(1, 2, 4, 8, 16, 32))
+        with metrics.timer('model_seconds', backend='local'):
+            features = np.stack([self.get_features(window) for window in windows])
+            results = model.model.generate(
+                model.encode(features),
+                [list(self.tokenizer.sot_sequence)] * len(windows),
+                beam_size=1,
+                max_length=MAX_TOKENS,
+            )
+        return [
+            get_segments(result.sequences_ids[0], self.tokenizer.timestamp_begin,
+                         self.tokenizer.eot, self.tokenizer.decode)
+            for result in results
+        ]
+
+    # Like OpenAI's transcripts, these are cached by a hash of the audio.
+    def transcribe(self, chunks, extension='ogg'):
+        model = os.path.basename(os.path.normpath(self.model_path))
+        pending = []
+        for _, audio in chunks:
+            key = get_key('local', model, hashlib.sha256(audio).hexdigest())
+            cached = result_cache.get_json(key)
+            if cached is not None:
+                print('Using cached transcript')
+                pending.append((key, cached, None))
+                continue
+            samples = np.frombuffer(decode_pcm(audio, SAMPLE_RATE), np.int16) / 32768
+            windows = split_windows(samples.astype(np.float32))
+            pending.append((key, None, [self.batcher.submit(window) for window in windows]))
+        transcripts = []
+        for key, transcript, futures in pending:
+            if transcript is None:
+                transcript = join_windows([future.result() for future in futures])
+                result_cache.put_json(key, transcript)
+            transcripts.append(to_namespace(transcript))
+        return stitch_transcripts(transcripts, [offset for offset, _ in chunks])
+
+
+BACKENDS = {
+    'openai': OpenAIBackend,
+    'local': LocalBackend,
+    'fake': FakeBackend,
+}
+
+
+def is_available(name):
+    if name == 'local':
+        return np is not None and faster_whisper is not None
+    return True
+
+
+# Sends each capability to the backend chosen for it.
+class Backend:
+    def __init__(self, transcriber, detector, speaker):
+        self.transcriber = transcriber
+        self.detector = detector
+        self.speaker = speaker
+
+    def transcribe(self, chunks, extension='ogg'):
+        return self.transcriber.transcribe(chunks, extension)
+
+    def detect(self, transcript, lines=None, encoding='packed', window=0):
+        return self.detector.detect(transcript, lines, encoding, window)
+
+    def speak(self, company, file=None):
+        return self.speaker.speak(company, file)
+
+
+# names maps each capability to the name of a backend in BACKENDS. A backend
+# named for more than one capability is only made once.
+def make_backend(names, open_ai_key=None, model_path=None, batch_size=8):
+    made = {}
+    for capability in CAPABILITIES:
+        name = names[capability]
+        if capability not in BACKENDS[name].CAPABILITIES:
+            raise ValueError(f'The {name} backend can\'t {capability}')
+        if not is_available(name):
+            raise ValueError(f'The {name} backend needs numpy and faster-whisper')
+        if name in made:
+            continue
+        if name == 'openai':
+            made[name] = OpenAIBackend(OpenAI(api_key=open_ai_key))
+        elif name == 'local':
+            if not model_path:
+                raise ValueError('The local backend needs a model path')
+            made[name] = LocalBackend(model_path, batch_size)
+        else:
+            made[name] = BACKENDS[name]()
+    return Backend(*(made[names[capability]] for capability in CAPABILITIES))
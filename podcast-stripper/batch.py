@@ -0,0 +1,270 @@
+import json
+import sqlite3
+import threading
+import time
+
+from openai_util import (
+    COMMERCIALS_MODEL,
+    get_commercials_request,
+    get_windows,
+    merge_window_commercials,
+    result_cache
+)
+
+try:
+    from ..common import metrics
+except ImportError:
+    from metrics import metrics
+
+# Only detection goes through batches. The Batch API can't transcribe.
+ENDPOINT = '/v1/chat/completions'
+COMPLETION_WINDOW = '24h'
+# The most requests OpenAI takes in one batch, and a little under the most
+# bytes it takes in a batch's input file (200 MB).
+MAX_REQUESTS = 50_000
+MAX_BATCH_BYTES = 190_000_000
+OVERLAP = 20
+# A batch in one of these won't change any more.
+FINISHED = ('completed', 'failed', 'expired', 'cancelled')
+
+SCHEMA = [
+    '''
+    CREATE TABLE IF NOT EXISTS requests (
+        custom_id TEXT PRIMARY KEY,
+        body TEXT NOT NULL,
+        batch_id TEXT,
+        result TEXT,
+        error TEXT,
+        created REAL NOT NULL
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS batches (
+        id TEXT PRIMARY KEY,
+        status TEXT NOT NULL,
+        created REAL NOT NULL
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS waiting (
+        job_id INTEGER NOT NULL,
+        custom_id TEXT NOT NULL,
+        PRIMARY KEY (job_id, custom_id)
+    )
+    ''',
+]
+
+
+# Raised by BatchQueue.detect when the answers are on their way. keys are the
+# requests to wait for.
+class Deferred(Exception):
+    def __init__(self, keys):
+        super().__init__(f'Waiting for {len(keys)} batched requests')
+        self.keys = keys
+
+
+# Detection for episodes that can wait, through OpenAI's Batch API: half the
+# price of asking one at a time and far higher limits, but the answers come
+# within a day rather than seconds. Requests are kept in SQLite, so they
+# survive a restart, until run_once sends them all, in as few batches as
+# OpenAI's limits allow. It then checks on the batches until they are
+# finished, and says which jobs waiting for them have all their answers.
+class BatchQueue:
+    def __init__(self, client, database=':memory:', clock=time.time,
+                 max_bytes=MAX_BATCH_BYTES):
+        self.client = client
+        self.max_bytes = max_bytes
+        self.connection = sqlite3.connect(database, check_same_thread=False)
+        self.connection.row_factory = sqlite3.Row
+        self.lock = threading.Lock()
+        self.clock = clock
+        with self.connection:
+            for statement in SCHEMA:
+                self.connection.execute(statement)
+
+    # Like get_commercials: the commercials among lines of the transcript,
+    # asking in windows of lines. Raises Deferred until a batch has answered
+    # every window, and returns None if it couldn't.
+    def detect(self, transcript, lines=None, encoding='packed', window=0):
+        if lines is None:
+            lines = range(len(transcript.segments))
+        if not lines:
+            return []
+        requests = [
+            get_commercials_request(transcript, window_lines, encoding)
+            for window_lines in get_windows(lines, window, OVERLAP)
+        ]
+        keys = [key for key, _ in requests]
+        with self.lock:
+            rows = {
+                row['custom_id']: row for row in self.connection.execute(
+                    f'SELECT * FROM requests WHERE custom_id IN ({", ".join("?" * len(keys))})',
+                    keys
+                )
+            }
+            failed = [key for key in keys if key in rows and rows[key]['error'] is not None]
+            if failed:
+                print(f'The batch couldn\'t find the commercials: {rows[failed[0]]["error"]}')
+                # The caller asks directly instead. Forget the errors, so the
+                # next time these windows are detected they are batched again,
+                # unless another job is still waiting to hear about them.
+                with self.connection:
+                    self.connection.execute(
+                        f'DELETE FROM requests WHERE custom_id IN ({", ".join("?" * len(failed))}) '
+                        'AND custom_id NOT IN (SELECT custom_id FROM waiting)',
+                        failed
+                    )
+                return None
+            if all(key in rows and rows[key]['result'] is not None for key in keys):
+                results = [json.loads(rows[key]['result']) for key in keys]
+                return results[0] if len(results) == 1 else merge_window_commercials(results)
+            with self.connection:
+                self.connection.executemany(
+                    'INSERT OR IGNORE INTO requests (custom_id, body, created) VALUES (?, ?, ?)',
+                    [(key, json.dumps(body), self.clock()) for key, body in requests]
+                )
+        raise Deferred(keys)
+
+    # Remember that job_id needs the answers to keys.
+    def wait(self, job_id, keys):
+        with self.lock, self.connection:
+            self.connection.executemany(
+                'INSERT OR IGNORE INTO waiting (job_id, custom_id) VALUES (?, ?)',
+                [(job_id, key) for key in keys]
+            )
+
+    def pending(self):
+        with self.lock:
+            return self.connection.execute(
+                'SELECT COUNT(*) FROM requests WHERE result IS NULL AND error IS NULL'
+            ).fetchone()[0]
+
+    # Send the oldest requests not sent yet as one batch, as many as fit.
+    # Returns the batch's id, or None if there was nothing to send.
+    def submit(self):
+        with self.lock:
+            rows = self.connection.execute(
+                'SELECT custom_id, body FROM requests WHERE batch_id IS NULL '
+                'AND result IS NULL AND error IS NULL ORDER BY created LIMIT ?',
+                (MAX_REQUESTS,)
+            ).fetchall()
+        if not rows:
+            return None
+        lines = []
+        size = 0
+        for row in rows:
+            line = (json.dumps({
+                'custom_id': row['custom_id'],
+                'method': 'POST',
+                'url': ENDPOINT,
+                'body': json.loads(row['body']),
+            }) + '\n').encode()
+            if lines and size + len(line) > self.max_bytes:
+                break
+            lines.append(line)
+            size += len(line)
+        rows = rows[:len(lines)]
+        data = b''.join(lines)
+        print(f'Sending a batch of {len(rows)} requests, {len(data)} bytes')
+        metrics.count('upload_bytes_total', len(data), endpoint='batches')
+        input_file = self.client.files.create(file=('detect.jsonl', data), purpose='batch')
+        batch = self.client.batches.create(
+            input_file_id=input_file.id,
+            endpoint=ENDPOINT,
+            completion_window=COMPLETION_WINDOW
+        )
+        with self.lock, self.connection:
+            self.connection.execute(
+                'INSERT INTO batches (id, status, created) VALUES (?, ?, ?)',
+                (batch.id, batch.status, self.clock())
+            )
+            self.connection.executemany(
+                'UPDATE requests SET batch_id = ? WHERE custom_id = ?',
+                [(batch.id, row['custom_id']) for row in rows]
+            )
+        return batch.id
+
+    def read_file(self, file_id):
+        if not file_id:
+            return []
+        text = self.client.files.content(file_id).text
+        return [json.loads(line) for line in text.splitlines() if line.strip()]
+
+    # Keep what a finished batch found. Requests it didn't answer get an
+    # error, and are asked about directly instead.
+    def collect(self, batch):
+        answers = []
+        for line in self.read_file(batch.output_file_id) + self.read_file(batch.error_file_id):
+            response = line.get('response') or {}
+            if response.get('status_code') == 200:
+                body = response['body']
+                usage = body.get('usage') or {}
+                metrics.count('tokens_total', usage.get('prompt_tokens', 0), direction='in',
+                              model=COMMERCIALS_MODEL)
+                metrics.count('tokens_total', usage.get('completion_tokens', 0),
+                              direction='out', model=COMMERCIALS_MODEL)
+                # A refusal or a cut off answer fails only its own request.
+                try:
+                    content = json.loads(body['choices'][0]['message']['content'])
+                    commercials = content['commercials']
+                except (ValueError, KeyError, IndexError, TypeError) as error:
+                    answers.append((None, json.dumps(f'bad answer: {error!r}'),
+                                    line['custom_id']))
+                    continue
+                result_cache.put_json(line['custom_id'], commercials)
+                answers.append((json.dumps(commercials), None, line['custom_id']))
+            else:
+                error = line.get('error') or response.get('body') or 'no answer'
+                answers.append((None, json.dumps(error), line['custom_id']))
+        metrics.count('batch_requests_total', len(answers), status=batch.status)
+        with self.lock, self.connection:
+            self.connection.executemany(
+                'UPDATE requests SET result = ?, error = ? WHERE custom_id = ?', answers)
+            self.connection.execute(
+                'UPDATE requests SET error = ? WHERE batch_id = ? '
+                'AND result IS NULL AND error IS NULL',
+                (f'batch {batch.status}', batch.id)
+            )
+
+    # Jobs with every answer they were waiting for, which stop waiting.
+    def get_ready(self):
+        with self.lock, self.connection:
+            ready = [row['job_id'] for row in self.connection.execute(
+                'SELECT waiting.job_id FROM waiting JOIN requests USING (custom_id) '
+                'GROUP BY waiting.job_id '
+                'HAVING SUM(requests.result IS NULL AND requests.error IS NULL) = 0'
+            )]
+            self.connection.executemany(
+                'DELETE FROM waiting WHERE job_id = ?', [(job_id,) for job_id in ready])
+        return ready
+
+    def check(self):
+        with self.lock:
+            batch_ids = [row['id'] for row in self.connection.execute(
+                f'SELECT id FROM batches WHERE status NOT IN ({", ".join("?" * len(FINISHED))})',
+                FINISHED
+            )]
+        for batch_id in batch_ids:
+            batch = self.client.batches.retrieve(batch_id)
+            if batch.status in FINISHED:
+                print(f'Batch {batch_id} {batch.status}')
+                self.collect(batch)
+            with self.lock, self.connection:
+                self.connection.execute(
+                    'UPDATE batches SET status = ? WHERE id = ?', (batch.status, batch_id))
+
+    # Returns the ids of the jobs that have their answers now.
+    def run_once(self):
+        while self.submit():
+            pass
+        self.check()
+        return self.get_ready()
+
+    def run(self, on_ready, interval=300):
+        while True:
+            try:
+                for job_id in self.run_once():
+                    on_ready(job_id)
+            except Exception as error:
+                print(f'Batch failed: {error!r}')
+            time.sleep(interval)
@@ -0,0 +1,56 @@
+# Finding the episodes left to strip in one big feed directory, listing it for
+# every file as we used to, and with FeedDirectory.
+#
+#   cd podcast-stripper && PYTHONPATH=../common python -m benchmarks.bench_feed_directory
+
+import os
+import tempfile
+import time
+
+import click
+
+from file_util import FeedDirectory, build_filename, find_stripped_filename, get_stripped_name
+
+
+def write_episodes(directory, count):
+    for number in range(count):
+        filename = build_filename(2000 + number // 365, 1 + number % 12, 1 + number % 28,
+                                  'feed', str(number))
+        open(os.path.join(directory, filename), 'w').close()
+        # Most of an archive is stripped already.
+        if number % 10:
+            open(os.path.join(directory, get_stripped_name('v1', filename)), 'w').close()
+
+
+@click.command()
+@click.option('--files', default=10000, help='Episodes in the directory')
+@click.option('--sample', default=200,
+              help='Episodes to time the old way, which is too slow to do them all')
+def main(files, sample):
+    with tempfile.TemporaryDirectory() as directory:
+        write_episodes(directory, files // 2)
+        filenames = sorted(os.listdir(directory))
+        originals = [filename for filename in filenames if '-stripped' not in filename]
+
+        start = time.perf_counter()
+        for filename in originals[:sample]:
+            find_stripped_filename(filename, os.listdir(directory))
+        per_file = (time.perf_counter() - start) / min(sample, len(originals))
+        print(f'listdir and find_stripped_filename: {per_file * 1000:.2f} ms per episode, '
+              f'{per_file * len(originals):.1f} seconds for {len(originals)} episodes '
+              f'among {len(filenames)} files')
+
+        start = time.perf_counter()
+        feed_directory = FeedDirectory(directory)
+        unstripped = feed_directory.unstripped()
+        print(f'FeedDirectory: {time.perf_counter() - start:.3f} seconds to find '
+              f'{len(unstripped)} unstripped episodes among {len(feed_directory)} files')
+
+        start = time.perf_counter()
+        feed_directory.refresh()
+        print(f'FeedDirectory.refresh with nothing changed: '
+              f'{(time.perf_counter() - start) * 1e6:.0f} microseconds')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+# How long it takes to fingerprint an episode and look it up among many known
+# commercials.
+#
+#   cd podcast-stripper && PYTHONPATH=../common python -m benchmarks.bench_fingerprint \
+#       --commercials 10000
+
+import time
+
+import click
+import numpy as np
+
+from fingerprint import (
+    FANOUT,
+    FRAME_SECONDS,
+    PEAKS_PER_SECOND,
+    RATE,
+    FingerprintIndex,
+    get_landmarks,
+    get_span,
+)
+
+COMMERCIAL_SECONDS = 30
+
+
+# Landmarks like a commercial's: random hashes, about as many as real audio gives.
+def get_random_landmarks(random, seconds):
+    count = int(seconds * PEAKS_PER_SECOND * FANOUT * 0.8)
+    hashes = random.integers(0, 1 << 26, count)
+    times = np.sort(random.integers(0, int(seconds / FRAME_SECONDS), count))
+    return hashes, times
+
+
+@click.command()
+@click.option('--commercials', default=10000, help='Known commercials in the index')
+@click.option('--minutes', default=60, help='Length of the synthetic episode')
+def main(commercials, minutes):
+    random = np.random.default_rng(0)
+
+    # Noise standing in for an episode.
+    samples = (random.standard_normal(minutes * 60 * RATE) * 3000).astype(np.int16)
+    start = time.perf_counter()
+    episode_hashes, episode_times = get_landmarks(samples)
+    print(f'fingerprint: {time.perf_counter() - start:.2f} seconds for {minutes} minutes, '
+          f'{len(episode_hashes)} landmarks')
+
+    index = FingerprintIndex()
+    for number in range(commercials):
+        index.add(f'Sponsor {number}', *get_random_landmarks(random, COMMERCIAL_SECONDS),
+                  COMMERCIAL_SECONDS)
+    # One of them is in the episode, ten minutes in.
+    hashes, times = get_span(episode_hashes, episode_times, 600, 600 + COMMERCIAL_SECONDS)
+    index.add('Known', hashes, times, COMMERCIAL_SECONDS)
+
+    start = time.perf_counter()
+    index.build()
+    print(f'build: {time.perf_counter() - start:.2f} seconds for {len(index)} commercials, '
+          f'{len(index.hashes)} landmarks')
+
+    start = time.perf_counter()
+    matches = index.match(episode_hashes, episode_times)
+    print(f'lookup: {time.perf_counter() - start:.3f} seconds, found '
+          + ', '.join(f'{match["sponsor"]} at {match["start"]:.1f}' for match in matches))
+
+
+if __name__ == "__main__":
+    main()
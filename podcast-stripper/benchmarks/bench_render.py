@@ -0,0 +1,75 @@
+# Compare the ways of rendering a trimmed episode.
+#
+#   cd podcast-stripper && PYTHONPATH=../common python -m benchmarks.bench_render \
+#       --minutes 60 --breaks 5
+
+import os
+import subprocess
+import tempfile
+import time
+
+import click
+
+from ffmpeg_util import get_size, render_copied, render_segments, render_trimmed
+
+
+def write_tone(output_file, seconds, frequency=440, rate=44100, channels=2):
+    command = [
+        'ffmpeg',
+        '-y',
+        '-loglevel',
+        'error',
+        '-hide_banner',
+        '-f',
+        'lavfi',
+        '-i',
+        f'sine=frequency={frequency}:sample_rate={rate}:duration={seconds}',
+        '-ac',
+        str(channels),
+        output_file,
+    ]
+    subprocess.run(command, check=True)
+
+
+def get_parts(duration, sponsor_file, breaks):
+    parts = []
+    commercial_length = 90
+    spacing = duration / (breaks + 1)
+    start = 0
+    for n in range(breaks):
+        commercial_start = spacing * (n + 1)
+        parts.append((start, commercial_start))
+        parts.append(sponsor_file)
+        start = commercial_start + commercial_length
+    parts.append((start, None))
+    return parts
+
+
+@click.command()
+@click.option('--minutes', default=60, help='Length of the synthetic episode')
+@click.option('--breaks', default=5, help='Number of commercial breaks')
+def main(minutes, breaks):
+    directory = tempfile.mkdtemp()
+    source = os.path.join(directory, 'episode.mp3')
+    sponsor = os.path.join(directory, 'sponsor.wav')
+    write_tone(source, minutes * 60)
+    write_tone(sponsor, 3, frequency=880, rate=24000, channels=1)
+    parts = get_parts(minutes * 60, sponsor, breaks)
+
+    renderers = [
+        ('segments', render_segments),
+        ('single-pass', render_trimmed),
+        ('copy', render_copied),
+    ]
+    for name, render in renderers:
+        output = os.path.join(directory, f'{name}.mp3')
+        start = time.perf_counter()
+        intermediates = render(source, parts, output) or []
+        elapsed = time.perf_counter() - start
+        written = get_size(output) + sum(
+            get_size(file) for file in intermediates if file != sponsor)
+        print(f'{name}: {elapsed:.2f} seconds, {written / 1e6:.1f} MB written')
+
+
+if __name__ == "__main__":
+    main()
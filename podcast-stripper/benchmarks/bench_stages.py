@@ -0,0 +1,207 @@
+# Time each stage of stripping synthetic episodes of several lengths and
+# numbers of commercials, with a fake OpenAI client, and write the results as
+# JSON so two runs can be compared.
+#
+#   cd podcast-stripper && PYTHONPATH=../common python -m benchmarks.bench_stages \
+#       --minutes 10 --minutes 60 --commercials 2 --commercials 6 \
+#       --output benchmark-before.json
+#   ... change something ...
+#   PYTHONPATH=../common python -m benchmarks.bench_stages ... \
+#       --output benchmark-after.json --baseline benchmark-before.json
+
+import json
+import os
+import platform
+import statistics
+import subprocess
+import tempfile
+import time
+
+import click
+
+from benchmarks.fake_client import FakeClient, get_transcript, to_namespace
+from ffmpeg_util import (
+    add_image,
+    get_duration,
+    join_segments_mp3,
+    probe_file,
+    reduce_audio,
+    reduce_audio_file,
+    render_copied,
+    render_trimmed,
+    write_audio_clip,
+)
+from openai_util import get_commercials, get_messages, limiter, write_sponsor
+
+LINE_SECONDS = 4
+COMMERCIAL_SECONDS = 60
+
+
+def run(command):
+    subprocess.run(['ffmpeg', '-y', '-loglevel', 'error', '-hide_banner'] + command, check=True)
+
+
+# Cover art and an episode of a tone over pink noise, roughly as hard to
+# encode as speech.
+def write_episode(directory, minutes):
+    image = os.path.join(directory, 'art.jpg')
+    run(['-f', 'lavfi', '-i', 'color=c=orange:s=600x600', '-frames:v', '1', image])
+    episode = os.path.join(directory, f'episode-{minutes}.mp3')
+    seconds = minutes * 60
+    run([
+        '-f', 'lavfi', '-i', f'sine=frequency=220:sample_rate=44100:duration={seconds}',
+        '-f', 'lavfi', '-i', f'anoisesrc=color=pink:amplitude=0.1:sample_rate=44100'
+                             f':duration={seconds}',
+        '-filter_complex', '[0:a][1:a]amix=inputs=2,aformat=channel_layouts=stereo[a]',
+        '-map', '[a]', '-c:a', 'libmp3lame', '-b:a', '128k', episode,
+    ])
+    return episode, image
+
+
+# Commercials spread evenly through the episode, as (start_line, end_line,
+# sponsor).
+def get_commercials_at(duration, count):
+    lines = int(duration // LINE_SECONDS)
+    spacing = lines // (count + 1)
+    length = min(COMMERCIAL_SECONDS // LINE_SECONDS, spacing // 2)
+    return [
+        (spacing * (number + 1), spacing * (number + 1) + length - 1, f'Sponsor {number}')
+        for number in range(count)
+    ]
+
+
+def get_parts(commercials, sponsor_file):
+    parts = []
+    start = 0
+    for start_line, end_line, _ in commercials:
+        parts.append((start, start_line * LINE_SECONDS))
+        parts.append(sponsor_file)
+        start = (end_line + 1) * LINE_SECONDS
+    parts.append((start, None))
+    return parts
+
+
+def time_stage(function, repeat, setup=None):
+    seconds = []
+    for _ in range(repeat):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        function()
+        seconds.append(time.perf_counter() - start)
+    return seconds
+
+
+def bench_episode(directory, episode, image, commercial_count, repeat):
+    duration = get_duration(episode)
+    commercials = get_commercials_at(duration, commercial_count)
+    transcript = get_transcript(duration, commercials, LINE_SECONDS)
+    client = FakeClient(transcript)
+    segments = to_namespace(transcript)
+    lines = range(len(segments.segments))
+    sponsor_file = write_sponsor(client, 'Sponsor 0', os.path.join(directory, 'sponsor.wav'))
+    parts = get_parts(commercials, sponsor_file)
+    clips = [
+        part if isinstance(part, str) else os.path.join(directory, f'clip-{number}.wav')
+        for number, part in enumerate(parts)
+    ]
+    joined = os.path.join(directory, 'joined.mp3')
+
+    def write_clips():
+        for part, clip in zip(parts, clips):
+            if not isinstance(part, str):
+                write_audio_clip(episode, clip, *part)
+
+    stages = [
+        ('get_duration', lambda: get_duration(episode), probe_file.cache_clear),
+        ('reduce_audio_file',
+         lambda: reduce_audio_file(episode, os.path.join(directory, 'reduced.mp3')), None),
+        ('reduce_audio', lambda: reduce_audio(episode, 'opus', '24k'), None),
+        ('prompt_packed', lambda: get_messages(segments, lines, 'packed'), None),
+        ('prompt_messages', lambda: get_messages(segments, lines, 'messages'), None),
+        ('detect', lambda: list(get_commercials(client, segments)), None),
+        ('write_sponsor', lambda: write_sponsor(
+            client, 'Sponsor 0', os.path.join(directory, 'sponsor.wav')), None),
+        ('write_audio_clip', write_clips, None),
+        ('join_segments_mp3', lambda: join_segments_mp3(clips, joined), None),
+        ('add_image', lambda: add_image(joined, image), None),
+        ('render_trimmed', lambda: render_trimmed(
+            episode, parts, os.path.join(directory, 'trimmed.mp3')), None),
+        ('render_copied', lambda: render_copied(
+            episode, parts, os.path.join(directory, 'copied.mp3')), None),
+    ]
+    results = []
+    for name, function, setup in stages:
+        seconds = time_stage(function, repeat, setup)
+        results.append({
+            'stage': name,
+            'minutes': round(duration / 60),
+            'commercials': commercial_count,
+            'seconds': seconds,
+            'median': statistics.median(seconds),
+            'min': min(seconds),
+        })
+        print(f'{duration / 60:.0f} min, {commercial_count} commercials, {name}: '
+              f'{statistics.median(seconds):.3f} s')
+    return results
+
+
+def get_environment():
+    ffmpeg = subprocess.run(['ffmpeg', '-version'], capture_output=True, text=True)
+    return {
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'cpus': os.cpu_count(),
+        'ffmpeg': ffmpeg.stdout.split('\n', 1)[0],
+    }
+
+
+def compare(results, baseline):
+    before = {
+        (result['stage'], result['minutes'], result['commercials']): result['median']
+        for result in baseline['results']
+    }
+    print('Compared with the baseline:')
+    for result in results:
+        key = (result['stage'], result['minutes'], result['commercials'])
+        if before.get(key):
+            print(f'  {result["minutes"]} min, {result["commercials"]} commercials, '
+                  f'{result["stage"]}: {before[key]:.3f} -> {result["median"]:.3f} s '
+                  f'({result["median"] / before[key]:.2f}x)')
+
+
+@click.command()
+@click.option('--minutes', multiple=True, type=int, default=[10, 60], show_default=True,
+              help='Lengths of the synthetic episodes')
+@click.option('--commercials', multiple=True, type=int, default=[2, 6], show_default=True,
+              help='Numbers of commercials in each episode')
+@click.option('--repeat', default=3, show_default=True, help='Times to run each stage')
+@click.option('--output', default='benchmark.json', show_default=True,
+              help='Where to write the results')
+@click.option('--baseline', type=click.File(), help='Results of an earlier run to compare with')
+def main(minutes, commercials, repeat, output, baseline):
+    # The fake client answers at once, so don't hold it to OpenAI's limits.
+    for endpoint in list(limiter.buckets):
+        limiter.configure(endpoint, 1_000_000)
+
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for length in minutes:
+            episode, image = write_episode(directory, length)
+            for count in commercials:
+                results += bench_episode(directory, episode, image, count, repeat)
+
+    report = {
+        'environment': get_environment(),
+        'settings': {'minutes': minutes, 'commercials': commercials, 'repeat': repeat},
+        'results': results,
+    }
+    with open(output, 'w') as file:
+        json.dump(report, file, indent=2)
+    print(f'Wrote {output}')
+    if baseline:
+        compare(results, json.load(baseline))
+
+
+if __name__ == "__main__":
+    main()
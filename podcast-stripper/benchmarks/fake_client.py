@@ -0,0 +1,111 @@
+# Stands in for the OpenAI client in benchmarks, answering straight away and
+# always the same way, so only our own code is timed.
+
+import json
+import re
+from types import SimpleNamespace
+import wave
+
+SPONSOR_LINE = re.compile(r'brought to you by (\w+ \d+)')
+
+
+# A transcript of duration seconds, one line every line_seconds, where the
+# lines from start_line to end_line of each commercial are an ad for sponsor.
+def get_transcript(duration, commercials, line_seconds=4):
+    segments = []
+    for line in range(int(duration // line_seconds)):
+        text = f'This is line {line} of the episode, where the hosts keep talking.'
+        for start_line, end_line, sponsor in commercials:
+            if start_line <= line <= end_line:
+                text = f'This episode is brought to you by {sponsor}, use code PIZZA.'
+        segments.append({
+            'id': line,
+            'start': line * line_seconds,
+            'end': (line + 1) * line_seconds,
+            'text': text,
+        })
+    return {'text': ' '.join(segment['text'] for segment in segments), 'segments': segments}
+
+
+def to_namespace(value):
+    return json.loads(json.dumps(value), object_hook=lambda item: SimpleNamespace(**item))
+
+
+# What with_raw_response gives: headers and parse().
+class RawResponse:
+    headers = {}
+
+    def __init__(self, parsed):
+        self.parsed = parsed
+
+    def parse(self):
+        return self.parsed
+
+
+class SpeechResponse:
+    headers = {}
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        return False
+
+    def stream_to_file(self, file):
+        with wave.open(str(file), 'wb') as output:
+            output.setnchannels(1)
+            output.setsampwidth(2)
+            output.setframerate(24000)
+            output.writeframes(bytes(2 * 24000 * self.seconds))
+
+
+class FakeClient:
+    def __init__(self, transcript, speech_seconds=3):
+        self.transcript = transcript
+        self.speech_seconds = speech_seconds
+        self.calls = []
+        self.audio = SimpleNamespace(
+            transcriptions=SimpleNamespace(
+                with_raw_response=SimpleNamespace(create=self.transcribe)),
+            speech=SimpleNamespace(
+                with_streaming_response=SimpleNamespace(create=self.speak)),
+        )
+        self.chat = SimpleNamespace(completions=SimpleNamespace(
+            with_raw_response=SimpleNamespace(create=self.complete)))
+
+    def transcribe(self, **kwargs):
+        self.calls.append('transcriptions')
+        return RawResponse(to_namespace(self.transcript))
+
+    # Finds the ad lines in what it was sent, as the model would, and answers
+    # in pieces like a stream.
+    def complete(self, messages, stream=False, **kwargs):
+        self.calls.append('chat')
+        commercials = []
+        for message in messages[1:]:
+            for text in message['content'].split('\n'):
+                line = int(text.split(' ', 1)[0])
+                match = SPONSOR_LINE.search(text)
+                if not match:
+                    continue
+                if (commercials and commercials[-1]['end_line'] == line - 1
+                        and commercials[-1]['sponsor'] == match.group(1)):
+                    commercials[-1]['end_line'] = line
+                else:
+                    commercials.append(
+                        {'sponsor': match.group(1), 'start_line': line, 'end_line': line})
+        content = json.dumps({'commercials': commercials})
+        if not stream:
+            return RawResponse(SimpleNamespace(
+                choices=[SimpleNamespace(message=SimpleNamespace(content=content))]))
+        return RawResponse(iter([
+            SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=piece))])
+            for piece in (content[start:start + 16] for start in range(0, len(content), 16))
+        ]))
+
+    def speak(self, **kwargs):
+        self.calls.append('speech')
+        return SpeechResponse(self.speech_seconds)
@@ -0,0 +1,181 @@
+from collections import Counter
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+from types import SimpleNamespace
+
+try:
+    from ..common import metrics
+except ImportError:
+    from metrics import metrics
+
+
+def get_key(*parts):
+    return hashlib.sha256(json.dumps(parts).encode()).hexdigest()
+
+
+def get_file_hash(filename):
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+# Files stored by key under directory, least recently used evicted first once
+# they add up to more than max_bytes. Files used in the last grace seconds
+# are kept, since whoever got their path may not have opened them yet. Does
+# nothing until configured with a directory. Lookups are counted as
+# cache_lookups_total by name.
+class DiskCache:
+    def __init__(self, directory=None, max_bytes=500_000_000, name='cache', grace=3600):
+        self.name = name
+        self.grace = grace
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.configure(directory, max_bytes)
+
+    def configure(self, directory, max_bytes=500_000_000):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.size = 0
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+            self.size = sum(os.path.getsize(path) for path, _ in self.entries())
+
+    def entries(self):
+        for root, _, files in os.walk(self.directory):
+            for file in files:
+                if not file.startswith('.'):
+                    path = os.path.join(root, file)
+                    yield path, os.path.getmtime(path)
+
+    def path(self, key, suffix=''):
+        return os.path.join(self.directory, key[:2], key + suffix)
+
+    def get(self, key, suffix=''):
+        if not self.directory:
+            return None
+        path = self.path(key, suffix)
+        try:
+            # mtime is our "last used" time.
+            os.utime(path)
+        except FileNotFoundError:
+            with self.lock:
+                self.misses += 1
+            metrics.count('cache_lookups_total', cache=self.name, result='miss')
+            return None
+        with self.lock:
+            self.hits += 1
+        metrics.count('cache_lookups_total', cache=self.name, result='hit')
+        return path
+
+    # Copy file into the cache and return the cached path.
+    def put(self, key, file, suffix=''):
+        if not self.directory:
+            return file
+        path = self.path(key, suffix)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=os.path.dirname(path), prefix='.',
+                                         delete=False) as temp:
+            with open(file, 'rb') as source:
+                shutil.copyfileobj(source, temp)
+        with self.lock:
+            if os.path.exists(path):
+                self.size -= os.path.getsize(path)
+            os.replace(temp.name, path)
+            self.size += os.path.getsize(path)
+        if self.size > self.max_bytes:
+            self.evict()
+        return path
+
+    def evict(self):
+        in_use = time.time() - self.grace
+        with self.lock:
+            for path, used in sorted(self.entries(), key=lambda entry: entry[1]):
+                if self.size <= self.max_bytes or used > in_use:
+                    break
+                self.size -= os.path.getsize(path)
+                os.remove(path)
+
+    def summary(self):
+        lookups = self.hits + self.misses
+        rate = self.hits / lookups if lookups else 0
+        return (f'{self.hits} hits, {self.misses} misses ({rate:.0%}), '
+                f'{self.size / 1e6:.1f} of {self.max_bytes / 1e6:.0f} MB')
+
+
+# Sponsor audio only depends on what is said and how, so the same company
+# always gets the same clip.
+def normalize_sponsor(sponsor):
+    return ' '.join(sponsor.split()).strip(' .,').casefold()
+
+
+def get_sponsor_key(model, voice, sponsor, response_format):
+    return get_key(model, voice, normalize_sponsor(sponsor), response_format)
+
+
+class SponsorCache(DiskCache):
+    HISTORY = '.sponsors.json'
+
+    def history_file(self):
+        return os.path.join(self.directory, self.HISTORY)
+
+    def get_history(self):
+        if not self.directory:
+            return Counter()
+        try:
+            with open(self.history_file()) as file:
+                return Counter(json.load(file))
+        except (FileNotFoundError, json.JSONDecodeError):
+            return Counter()
+
+    # Count how often we have needed each sponsor, for warming the cache and
+    # for the prefilter, by its normalized name.
+    def record(self, sponsor):
+        sponsor = normalize_sponsor(sponsor)
+        if not self.directory or not sponsor:
+            return
+        with self.lock:
+            history = self.get_history()
+            history[sponsor] += 1
+            with open(self.history_file(), 'w') as file:
+                json.dump(history, file)
+
+    def top_sponsors(self, count):
+        return [sponsor for sponsor, _ in self.get_history().most_common(count)]
+
+
+# Turns JSON objects into SimpleNamespaces, so transcript.segments[0].start
+# works the same for cached transcripts as for ones from OpenAI.
+def to_namespace(value):
+    return json.loads(json.dumps(value), object_hook=lambda item: SimpleNamespace(**item))
+
+
+def to_json_value(value):
+    if hasattr(value, 'model_dump'):
+        return value.model_dump()
+    return json.loads(json.dumps(value, default=vars))
+
+
+# OpenAI results stored as JSON.
+class ResultCache(DiskCache):
+    def get_json(self, key):
+        path = self.get(key, '.json')
+        if path is None:
+            return None
+        with open(path) as file:
+            return json.load(file)
+
+    def put_json(self, key, value):
+        if not self.directory:
+            return
+        with tempfile.NamedTemporaryFile('w', delete=False, suffix='.json') as temp:
+            json.dump(to_json_value(value), temp)
+        self.put(key, temp.name, '.json')
+        os.remove(temp.name)
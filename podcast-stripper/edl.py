@@ -0,0 +1,109 @@
+import json
+import os
+import shutil
+import tempfile
+
+try:
+    from ..common import get_clip_name, get_sidecar_name
+except ImportError:
+    from file_util import get_clip_name, get_sidecar_name
+
+from cache import get_file_hash
+
+# Bumped when the sidecar changes in a way older stripper versions can't read.
+FORMAT = 1
+
+
+def get_sidecar_path(audio_file):
+    return os.path.join(os.path.dirname(audio_file),
+                        get_sidecar_name(os.path.basename(audio_file)))
+
+
+# Replaces path in one go, so a rerender never reads half a file, with
+# whatever write puts in a file, readable by whoever can read audio_file.
+def replace_beside(audio_file, path, write, mode='w'):
+    with tempfile.NamedTemporaryFile(mode, dir=os.path.dirname(path) or '.', prefix='.',
+                                     delete=False) as file:
+        try:
+            write(file)
+            os.chmod(file.name, os.stat(audio_file).st_mode & 0o777)
+        except BaseException:
+            os.remove(file.name)
+            raise
+    os.replace(file.name, path)
+
+
+# Copied unless it is there already.
+def keep_clip(audio_file, part, clip, path):
+    if os.path.exists(path) and get_file_hash(path) == clip:
+        return
+
+    def copy(file):
+        with open(part, 'rb') as source:
+            shutil.copyfileobj(source, file)
+    replace_beside(audio_file, path, copy, 'wb')
+
+
+# The cut plan of an episode: which ranges of the source to keep and which
+# sponsor announcements go between them, as parts from get_parts and the
+# commercials they came from. Announcements are kept next to the episode,
+# so rendering them again needs no cache, TTS or backend, and ones left
+# from an older plan are removed.
+def get_plan(audio_file, commercials, parts, version, source_hash=None):
+    directory, filename = os.path.split(audio_file)
+    sponsors = iter(commercials)
+    plan_parts = []
+    number = 0
+    for part in parts:
+        if isinstance(part, str):
+            clip = get_file_hash(part)
+            name = get_clip_name(filename, number)
+            keep_clip(audio_file, part, clip, os.path.join(directory, name))
+            number += 1
+            plan_parts.append({'sponsor': next(sponsors)['sponsor'], 'clip': clip, 'file': name})
+        else:
+            start, end = part
+            plan_parts.append({'start': start, 'end': end})
+    # Clips are numbered from 0, so any left over follow on from ours.
+    while True:
+        try:
+            os.remove(os.path.join(directory, get_clip_name(filename, number)))
+        except FileNotFoundError:
+            break
+        number += 1
+    return {
+        'format': FORMAT,
+        'source': os.path.basename(audio_file),
+        'source_hash': source_hash or get_file_hash(audio_file),
+        'version': version,
+        'parts': plan_parts,
+    }
+
+
+def write_sidecar(audio_file, plan):
+    path = get_sidecar_path(audio_file)
+    replace_beside(audio_file, path, lambda file: json.dump(plan, file, indent=1))
+    return path
+
+
+def read_sidecar(path):
+    with open(path) as file:
+        plan = json.load(file)
+    if plan.get('format') != FORMAT:
+        raise ValueError(f'Unknown sidecar format {plan.get("format")}')
+    return plan
+
+
+# The parts to render again, with clips beside the sidecar in directory.
+# Raises FileNotFoundError for a clip that is gone.
+def get_plan_parts(plan, directory):
+    parts = []
+    for part in plan['parts']:
+        if 'file' in part:
+            clip = os.path.join(directory, part['file'])
+            if not os.path.exists(clip):
+                raise FileNotFoundError(f'No clip of {part["sponsor"]} at {clip}')
+            parts.append(clip)
+        else:
+            parts.append((part['start'], part['end']))
+    return parts
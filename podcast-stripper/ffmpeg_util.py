@@ -1,10 +1,41 @@
 #!/usr/bin/env python
 
+from concurrent.futures import Future, ThreadPoolExecutor
 import datetime
+import functools
+import json
+import mmap
 import os
+import re
 import subprocess
 import tempfile
 
+from mp3_util import (
+    Info,
+    count_frames,
+    get_reservoir,
+    get_reservoir_frame,
+    get_xing_frame,
+    index_frames,
+    parse_frame_header,
+    read_art,
+    read_mp3_info,
+    replace_art,
+    write_art,
+)
+from workspace import new_file
+
+try:
+    from ..common import metrics
+except ImportError:
+    from metrics import metrics
+
+
+# Every program we start goes through here, so we know how many we start.
+def run_program(command, **kwargs):
+    metrics.count('subprocesses_total', program=os.path.basename(command[0]))
+    return subprocess.run(command, **kwargs)
+
 
 # This function writes a new audio file with the data essential for
 # understanding speech.
@@ -24,7 +55,90 @@ def reduce_audio_file(input_file, output_file):
         '12000',
         output_file,
     ]
-    subprocess.run(command)
+    run_program(command)
+
+
+# Small encodings of speech for uploading to Whisper, and the file extension
+# Whisper needs to recognize them.
+UPLOAD_ENCODINGS = {
+    'mp3': (['-ar', '12000', '-c:a', 'libmp3lame', '-f', 'mp3'], 'mp3'),
+    'opus': (['-ar', '16000', '-c:a', 'libopus', '-application', 'voip', '-f', 'ogg'], 'ogg'),
+}
+
+
+# Like reduce_audio_file, but returns the encoded audio from start to end
+# without writing it to disk.
+def reduce_audio(input_file, encoding='opus', bitrate='24k', start=None, end=None):
+    options, _ = UPLOAD_ENCODINGS[encoding]
+    command = ['ffmpeg', '-loglevel', 'error', '-hide_banner']
+    # Seeking the input, rather than decoding up to start, keeps each chunk of
+    # a long episode as quick as the first.
+    if start:
+        command += ['-ss', seconds_to_ffmpeg_format(start)]
+    if end is not None:
+        command += ['-to', seconds_to_ffmpeg_format(end)]
+    command += ['-i', input_file, '-vn', '-ac', '1']
+    if bitrate:
+        command += ['-b:a', bitrate]
+    # The same audio must give the same bytes, for the transcript cache.
+    command += ['-fflags', '+bitexact', '-flags:a', '+bitexact']
+    command += options + ['pipe:1']
+    return run_program(command, capture_output=True, check=True).stdout
+
+
+# Raw 16-bit mono samples, for fingerprinting.
+def read_pcm(input_file, rate=12000, start=None, end=None):
+    command = ['ffmpeg', '-loglevel', 'error', '-hide_banner']
+    if start:
+        command += ['-ss', seconds_to_ffmpeg_format(start)]
+    if end is not None:
+        command += ['-to', seconds_to_ffmpeg_format(end)]
+    command += ['-i', input_file, '-vn', '-ac', '1', '-ar', str(rate), '-f', 's16le', 'pipe:1']
+    return run_program(command, capture_output=True, check=True).stdout
+
+
+# Like read_pcm, but of encoded audio such as reduce_audio gives.
+def decode_pcm(audio, rate=16000):
+    command = ['ffmpeg', '-loglevel', 'error', '-hide_banner', '-i', 'pipe:0',
+               '-vn', '-ac', '1', '-ar', str(rate), '-f', 's16le', 'pipe:1']
+    return run_program(command, input=audio, capture_output=True, check=True).stdout
+
+
+def find_silences(input_file, noise='-30dB', min_duration=0.5):
+    command = [
+        'ffmpeg',
+        '-hide_banner',
+        '-nostats',
+        '-i',
+        input_file,
+        '-af',
+        f'silencedetect=noise={noise}:d={min_duration}',
+        '-f',
+        'null',
+        '-',
+    ]
+    output = run_program(command, capture_output=True, encoding='utf-8').stderr
+    starts = [float(start) for start in re.findall(r'silence_start: ([\d.]+)', output)]
+    ends = [float(end) for end in re.findall(r'silence_end: ([\d.]+)', output)]
+    return list(zip(starts, ends))
+
+
+# Split points about chunk_length apart, moved back to the middle of a
+# silence when there is one in the last quarter of the chunk, so we don't cut
+# a word in half.
+def get_split_points(silences, duration, chunk_length):
+    points = []
+    start = 0
+    while duration - start > chunk_length:
+        target = start + chunk_length
+        candidates = [
+            (silence_start + silence_end) / 2
+            for silence_start, silence_end in silences
+            if target - chunk_length / 4 <= (silence_start + silence_end) / 2 <= target
+        ]
+        start = max(candidates, default=target)
+        points.append(start)
+    return points
 
 
 def seconds_to_ffmpeg_format(time):
@@ -65,18 +179,30 @@ def write_audio_clip(input_file, output_file, start_time, end_time=None):
             input_file,
             output_file,
         ]
-    subprocess.run(command)
+    run_program(command)
 
 
-def join_segments_mp3(input_file_list, output_file):
-    print(f'Joining {input_file_list} to {output_file}')
-    command = [
-        'ffmpeg',
-        '-y',
-        '-loglevel',
-        'error',
-        '-hide_banner',
+# Encodes output_file with ffmpeg from inputs, with output options. Cover
+# art, if any, goes into the MP3 as it is encoded, so it needn't be written
+# again to add it. If ffmpeg can't use the image, it is left out.
+def encode_mp3(inputs, options, output_file, image_file=None):
+    command = ['ffmpeg', '-y', '-loglevel', 'error', '-hide_banner'] + inputs
+    plain = command + options + [output_file]
+    if image_file is None:
+        print(f'Command: {plain}')
+        run_program(plain)
+        return
+    with_cover = command + ['-i', image_file] + options + [
+        '-map', f'{inputs.count("-i")}:v', '-c:v', 'copy', '-id3v2_version', '3', output_file]
+    print(f'Command: {with_cover}')
+    if run_program(with_cover).returncode:
+        print(f'Failed to add image {image_file} to {output_file}')
+        run_program(plain)
 
+
+def join_segments_mp3(input_file_list, output_file, image_file=None):
+    print(f'Joining {input_file_list} to {output_file}')
+    inputs = [
         # Input [0]: one second of silence
         '-f',
         'lavfi',
@@ -86,43 +212,300 @@ def join_segments_mp3(input_file_list, output_file):
         'anullsrc=r=22000:cl=mono',
 
         # input [1]-[n], one for each file
-    ] + list(sum([('-i', file) for file in input_file_list], ())) + [
-
+    ] + list(sum([('-i', file) for file in input_file_list], ()))
+    options = [
         # Describe the concatenation
         '-filter_complex',
         '[0]'.join([f'[{n+1}]' for n in range(len(input_file_list))]) +
-        f'concat=n={str(2*len(input_file_list)-1)}:v=0:a=1',
+        f'concat=n={str(2*len(input_file_list)-1)}:v=0:a=1[out]',
+
+        '-map',
+        '[out]',
+        '-c:a',
+        'libmp3lame',
+    ]
+    encode_mp3(inputs, options, output_file, image_file)
+
+
+# Waits for the parts still being written, keeping their order.
+def resolve_parts(parts):
+    return [part.result() if isinstance(part, Future) else part for part in parts]
+
+
+# Every part of the trimmed episode is one of:
+#   (start, end): a range of the input file in seconds, end=None for "to the end"
+#   'path.wav': a separate audio file, such as a sponsor announcement
+#   a Future of such a file, still being written
+# Parts are separated by one second of silence, and image_file, if given,
+# becomes the cover art. Each clip is started as soon as parts yields it, up to
+# workers at a time, in workspace if there is one, and the clips are joined
+# once every part is ready.
+def render_segments(input_file, parts, output_file, image_file=None, workspace=None,
+                    workers=4):
+    info = probe(input_file)
+
+    def write_clip(clip, start, end):
+        write_audio_clip(input_file, clip, start, end)
+        return clip
+
+    clips = []
+    with ThreadPoolExecutor(workers) as executor:
+        for part in parts:
+            if isinstance(part, (str, Future)):
+                clips.append(part)
+                continue
+            start, end = part
+            seconds = (info.duration if end is None else end) - start
+            size = int(seconds * info.sample_rate * info.channels * 2)
+            clips.append(executor.submit(
+                write_clip, new_file(workspace, '.wav', size), start, end))
+        clips = resolve_parts(clips)
+    join_segments_mp3(clips, output_file, image_file)
+    return clips
+
+
+# Same result as render_segments, but decodes the input once and encodes the
+# output once in a single ffmpeg invocation.
+def render_trimmed(input_file, parts, output_file, image_file=None, workspace=None):
+    parts = resolve_parts(parts)
+    print(f'Rendering {len(parts)} parts of {input_file} to {output_file}')
+    inputs = [
+        # Input [0]: the original episode
+        '-i',
+        input_file,
+
+        # Input [1]: one second of silence
+        '-f',
+        'lavfi',
+        '-t',
+        '1',
+        '-i',
+        'anullsrc=r=22000:cl=mono',
+    ]
+    input_count = 2
+    filters = []
+    labels = []
+    for part in parts:
+        if isinstance(part, str):
+            # Inputs [2]-[n], one for each file
+            inputs += ['-i', part]
+            labels.append(f'[{input_count}:a]')
+            input_count += 1
+            continue
+        start, end = part
+        label = f'[p{len(labels)}]'
+        trim = f'atrim=start={start}' + (f':end={end}' if end is not None else '')
+        filters.append(f'[0:a]{trim},asetpts=PTS-STARTPTS{label}')
+        labels.append(label)
 
+    filters.append(
+        '[1:a]'.join(labels) + f'concat=n={2*len(labels)-1}:v=0:a=1[out]'
+    )
+    options = [
+        '-filter_complex',
+        ';'.join(filters),
+        '-map',
+        '[out]',
         '-c:a',
         'libmp3lame',
-        output_file
     ]
-    print(f'Command: {command}')
-    subprocess.run(command)
+    encode_mp3(inputs, options, output_file, image_file)
+
+
+# The silence and announcements between two copied parts, encoded like the
+# episode so the frames can sit side by side. As in render_trimmed, there is
+# a second of silence between every part, so before and after say whether a
+# copied part comes before and after this gap.
+def encode_gap(files, frame, before=True, after=True):
+    layout = 'mono' if frame.channels == 1 else 'stereo'
+    inputs = ['-f', 'lavfi', '-t', '1', '-i', f'anullsrc=r={frame.sample_rate}:cl={layout}']
+    labels = [None] * before
+    for number, file in enumerate(files):
+        inputs += ['-i', file]
+        labels.append(f'[{number + 1}:a]')
+    labels += [None] * after
+    sequence = []
+    for number, label in enumerate(labels):
+        if number:
+            sequence.append('[0:a]')
+        if label:
+            sequence.append(label)
+    command = [
+        'ffmpeg',
+        '-loglevel',
+        'error',
+        '-hide_banner',
+    ] + inputs + [
+        '-filter_complex',
+        ''.join(sequence) + f'concat=n={len(sequence)}:v=0:a=1[out]',
+        '-map',
+        '[out]',
+        '-c:a',
+        'libmp3lame',
+        '-b:a',
+        str(frame.bitrate),
+        '-ar',
+        str(frame.sample_rate),
+        '-ac',
+        str(frame.channels),
+        '-write_xing',
+        '0',
+        '-id3v2_version',
+        '0',
+        '-f',
+        'mp3',
+        'pipe:1',
+    ]
+    return run_program(command, capture_output=True, check=True).stdout
+
+
+# Same parts as render_segments, but the episode's own MP3 frames are copied
+# byte for byte, so only the silence and announcements between them are
+# encoded. Cuts land on the nearest frame, about 26 ms. Falls back to
+# render_trimmed for anything but layer III MP3.
+def render_copied(input_file, parts, output_file, image_file=None, workspace=None,
+                  block=1 << 20):
+    index = index_frames(input_file) if input_file.endswith('.mp3') else None
+    if index is None:
+        return render_trimmed(input_file, parts, output_file, image_file)
+    parts = resolve_parts(parts)
+    print(f'Copying {len(parts)} parts of {input_file} to {output_file}')
+    frame_count = len(index.offsets) - 1
+    written_frames = 0
+
+    with open(input_file, 'rb') as source, \
+            mmap.mmap(source.fileno(), 0, access=mmap.ACCESS_READ) as data, \
+            open(output_file, 'wb') as output:
+        first_offset = index.offsets[index.first_frame]
+        template = data[first_offset:first_offset + 4]
+        # Encode the gaps at the episode's average bitrate rather than that of
+        # its first frame, which is often quiet.
+        gap_frame = parse_frame_header(template)._replace(bitrate=probe(input_file).bitrate)
+
+        # The ID3 tag as it was, with the new cover art if there is one, and
+        # room for a Xing header once we know how many frames there are.
+        tag = data[:index.tag_size]
+        if image_file is not None:
+            with open(image_file, 'rb') as file:
+                image = file.read()
+            tag = replace_art(tag, image, get_image_mime(image))
+        output.write(tag or data[:index.tag_size])
+        xing_offset = output.tell()
+        output.write(get_xing_frame(template, 0, 0))
+
+        def to_frame(seconds):
+            number = index.first_frame + round(
+                seconds * index.frame.sample_rate / index.frame.samples)
+            return min(max(number, index.first_frame), frame_count)
+
+        gap = []
+        copied_before = False
+        for part in parts + [None]:
+            if isinstance(part, str):
+                gap.append(part)
+                continue
+            if gap or (copied_before and part is not None):
+                encoded = encode_gap(gap, gap_frame, before=copied_before,
+                                     after=part is not None)
+                output.write(encoded)
+                written_frames += count_frames(encoded)
+                gap = []
+            if part is None:
+                break
+
+            start, end = part
+            first = to_frame(start)
+            last = frame_count if end is None else to_frame(end)
+            if first >= last:
+                continue
+            # The first frame we copy may start its audio in the frames before
+            # it, so carry those bytes over in a silent frame.
+            reservoir = get_reservoir(data, index, first)
+            if reservoir:
+                output.write(get_reservoir_frame(template, reservoir))
+                written_frames += 1
+            for offset in range(index.offsets[first], index.offsets[last], block):
+                output.write(data[offset:min(offset + block, index.offsets[last])])
+            written_frames += last - first
+            copied_before = True
+
+        size = output.tell() - xing_offset
+        output.seek(xing_offset)
+        output.write(get_xing_frame(template, written_frames, size))
+
+    if image_file is not None and tag is None:
+        add_image(output_file, image_file)
 
 
 def get_size(filename):
     return os.path.getsize(filename)
 
 
-def get_duration(filename):
+def ffprobe(filename):
     command = [
         'ffprobe',
         '-v',
         'error',
         '-show_entries',
-        'format=duration',
+        'format=duration,bit_rate:stream=codec_type,sample_rate,channels'
+        ':stream_disposition=attached_pic',
         '-of',
-        'default=noprint_wrappers=1:nokey=1',
+        'json',
         filename,
     ]
-    return float(subprocess.check_output(command, encoding='utf-8'))
+    output = run_program(command, capture_output=True, check=True, encoding='utf-8').stdout
+    result = json.loads(output)
+    streams = result.get('streams', [])
+    audio = next((stream for stream in streams if stream.get('codec_type') == 'audio'), {})
+    return Info(
+        float(result['format']['duration']),
+        int(result['format'].get('bit_rate', 0)),
+        int(audio.get('sample_rate', 0)),
+        int(audio.get('channels', 0)),
+        any(stream.get('disposition', {}).get('attached_pic') for stream in streams)
+    )
+
+
+@functools.lru_cache(maxsize=1024)
+def probe_file(filename, size, mtime):
+    info = None
+    if filename.endswith('.mp3'):
+        try:
+            info = read_mp3_info(filename)
+        except (OSError, ValueError, IndexError) as error:
+            print(f'Failed to read MP3 headers of {filename}: {error}')
+    return info or ffprobe(filename)
 
 
+# Duration, bitrate, sample rate, channels and whether there is cover art.
+# MP3 headers are read directly, anything else goes to ffprobe. Each version
+# of a file is only probed once.
+def probe(filename):
+    stat = os.stat(filename)
+    return probe_file(filename, stat.st_size, stat.st_mtime_ns)
+
+
+def get_duration(filename):
+    return probe(filename).duration
+
+
+def get_image_mime(image):
+    return 'image/png' if image.startswith(b'\x89PNG') else 'image/jpeg'
+
+
+# Set the cover art, writing the ID3 tag of an MP3 ourselves rather than
+# remuxing the whole file, and only falling back to ffmpeg for tags we don't
+# handle.
 def add_image(podcast, image_file):
     if image_file is None:
         return
-    with tempfile.NamedTemporaryFile(delete=False, suffix=".mp3") as temp_podcast:
+    with open(image_file, 'rb') as file:
+        image = file.read()
+    if podcast.endswith('.mp3') and write_art(podcast, image, get_image_mime(image)):
+        return
+    directory = os.path.dirname(os.path.abspath(podcast))
+    with tempfile.NamedTemporaryFile(delete=False, suffix=".mp3", prefix='.',
+                                     dir=directory) as temp_podcast:
         command = [
             'ffmpeg',
             '-y',
@@ -137,38 +520,50 @@ def add_image(podcast, image_file):
             '0:0',
             '-map',
             '1:0',
+            '-c:a',
+            'copy',
             '-c:v',
             'copy',
             temp_podcast.name
         ]
         try:
-            subprocess.run(command, check=True)
+            run_program(command, check=True)
         except subprocess.CalledProcessError as error:
             print(f'Failed to add image {image_file} to {podcast}: {error}')
             print(' '.join(command))
-        subprocess.run(['cp', temp_podcast.name, podcast])
+            os.remove(temp_podcast.name)
+            return
+    os.replace(temp_podcast.name, podcast)
 
 
-def get_image(filename):
-    with tempfile.NamedTemporaryFile(delete=False, suffix=".jpg") as image_file:
-        image_file.close()
-        command = [
-            'ffmpeg',
-            '-y',
-            '-loglevel',
-            'error',
-            '-hide_banner',
-            '-i',
-            filename,
-            '-an',
-            '-vcodec',
-            'copy',
-            image_file.name
-        ]
+def get_image(filename, workspace=None):
+    if not probe(filename).has_art:
+        return None
+    art = read_art(filename) if filename.endswith('.mp3') else None
+    if art is not None:
+        mime, image = art
+        image_file = new_file(workspace, '.png' if mime == 'image/png' else '.jpg', len(image))
+        with open(image_file, 'wb') as file:
+            file.write(image)
+        return image_file
+    image_file = new_file(workspace, '.jpg')
+    command = [
+        'ffmpeg',
+        '-y',
+        '-loglevel',
+        'error',
+        '-hide_banner',
+        '-i',
+        filename,
+        '-an',
+        '-vcodec',
+        'copy',
+        image_file
+    ]
     try:
-        subprocess.run(command, check=True)
+        run_program(command, check=True)
     except subprocess.CalledProcessError as error:
         print(f'Failed to extract image from {filename}: {error}')
         return None
     print(f'Extracted image from {filename}')
-    return image_file.name
+    return image_file
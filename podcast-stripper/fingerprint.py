@@ -0,0 +1,227 @@
+import glob
+import json
+import os
+import tempfile
+import threading
+import uuid
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from ffmpeg_util import read_pcm
+
+# Spectrogram of 12 kHz mono audio, with overlapping frames so a commercial
+# gives nearly the same peaks wherever it starts.
+RATE = 12000
+WINDOW = 1024
+HOP = 256
+FRAME_SECONDS = HOP / RATE
+
+# A peak must be the loudest point within this many bins and frames.
+PEAK_BINS = 10
+PEAK_FRAMES = 8
+PEAKS_PER_SECOND = 8
+
+# Each peak is paired with the next few peaks up to about two seconds later.
+FANOUT = 4
+MAX_DELTA = 96
+
+# Commercials kept before the oldest are forgotten.
+MAX_ADS = 2000
+
+
+def is_available():
+    return np is not None
+
+
+def shifted_max(values, distance, axis):
+    result = values.copy()
+    for shift in range(1, distance + 1):
+        ahead = [slice(None)] * values.ndim
+        behind = [slice(None)] * values.ndim
+        ahead[axis] = slice(shift, None)
+        behind[axis] = slice(None, -shift)
+        np.maximum(result[tuple(ahead)], values[tuple(behind)], out=result[tuple(ahead)])
+        np.maximum(result[tuple(behind)], values[tuple(ahead)], out=result[tuple(behind)])
+    return result
+
+
+# (frames, bins) of the loudest local peaks, at most PEAKS_PER_SECOND of them
+# in each second, in time order. The spectrogram is worked out a block of
+# frames at a time so an hour long episode doesn't need it all in memory.
+def get_peaks(samples, block=4096):
+    if len(samples) < WINDOW:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    all_frames = np.lib.stride_tricks.sliding_window_view(samples, WINDOW)[::HOP]
+    window = np.hanning(WINDOW).astype(np.float32)
+    frames, bins, values = [], [], []
+    for start in range(0, len(all_frames), block):
+        first = max(0, start - PEAK_FRAMES)
+        spectrum = np.abs(np.fft.rfft(all_frames[first:start + block + PEAK_FRAMES] * window))
+        spectrogram = np.log1p(spectrum).astype(np.float32)
+        local_max = shifted_max(shifted_max(spectrogram, PEAK_BINS, 1), PEAK_FRAMES, 0)
+        is_peak = (spectrogram == local_max) & (spectrogram > spectrogram.mean())
+        is_peak[:start - first] = False
+        is_peak[start - first + block:] = False
+        block_frames, block_bins = np.nonzero(is_peak)
+        values.append(spectrogram[block_frames, block_bins])
+        frames.append(block_frames + first)
+        bins.append(block_bins)
+    frames, bins, values = np.concatenate(frames), np.concatenate(bins), np.concatenate(values)
+
+    seconds = (frames * FRAME_SECONDS).astype(np.int64)
+    order = np.lexsort((-values, seconds))
+    seconds = seconds[order]
+    first_in_second = np.searchsorted(seconds, seconds)
+    keep = order[np.arange(len(order)) - first_in_second < PEAKS_PER_SECOND]
+    keep.sort()
+    return frames[keep], bins[keep]
+
+
+# Landmark hashes: pairs of peaks and the frames between them, and the frame
+# of the first peak. Neighbouring bins share a hash, to allow for the peaks
+# moving slightly when the audio is re-encoded.
+def get_landmarks(samples):
+    frames, bins = get_peaks(samples)
+    bins = bins // 2
+    hashes = []
+    times = []
+    for step in range(1, FANOUT + 1):
+        delta = frames[step:] - frames[:-step]
+        near = (delta > 0) & (delta <= MAX_DELTA)
+        hashes.append((bins[:-step][near] << 18) | (bins[step:][near] << 8) | delta[near])
+        times.append(frames[:-step][near])
+    return np.concatenate(hashes), np.concatenate(times)
+
+
+def fingerprint_file(input_file, start=None, end=None):
+    samples = np.frombuffer(read_pcm(input_file, RATE, start, end), dtype=np.int16)
+    return get_landmarks(samples)
+
+
+# The landmarks of the part of an episode from start to end seconds, so a
+# commercial can be indexed without decoding it again.
+def get_span(hashes, times, start, end):
+    first = int(start / FRAME_SECONDS)
+    last = int(end / FRAME_SECONDS)
+    inside = (times >= first) & (times + (hashes & 0xFF) <= last)
+    return hashes[inside], times[inside] - first
+
+
+# Landmarks of known commercials, looked up with sorted arrays so matching an
+# hour long episode against thousands of commercials is a few vectorized
+# searches. Only the max_ads most recently learned are kept. Each is saved
+# under a name of its own, so processes sharing the directory don't write
+# over each other's.
+class FingerprintIndex:
+    def __init__(self, directory=None, max_ads=MAX_ADS):
+        self.lock = threading.Lock()
+        self.max_ads = max_ads
+        self.configure(directory)
+
+    def configure(self, directory):
+        self.directory = directory
+        self.ads = []
+        self.pending = []
+        # Commercials before this one are forgotten.
+        self.first = self.built_first = 0
+        self.hashes = self.ad_ids = self.times = None
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+            for path in sorted(glob.glob(os.path.join(directory, '*.npz')),
+                               key=os.path.getmtime):
+                with np.load(path) as saved:
+                    info = json.loads(str(saved['info']))
+                    self.add(info['sponsor'], saved['hashes'], saved['times'],
+                             info['duration'], path=path)
+
+    def __len__(self):
+        return len(self.ads) - self.first
+
+    # Saves the commercial unless it was loaded from path.
+    def add(self, sponsor, hashes, times, duration, path=None):
+        if path is None and self.directory:
+            with tempfile.NamedTemporaryFile(dir=self.directory, prefix='.', suffix='.npz',
+                                             delete=False) as file:
+                np.savez(file, hashes=hashes, times=times,
+                         info=json.dumps({'sponsor': sponsor, 'duration': duration}))
+            path = os.path.join(self.directory, f'{uuid.uuid4().hex}.npz')
+            os.replace(file.name, path)
+        with self.lock:
+            ad_id = len(self.ads)
+            self.ads.append({'sponsor': sponsor, 'duration': duration, 'path': path})
+            self.pending.append((ad_id, hashes, times))
+            while len(self.ads) - self.first > self.max_ads:
+                self.forget_oldest()
+        return ad_id
+
+    def forget_oldest(self):
+        path = self.ads[self.first]['path']
+        self.first += 1
+        if path:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def build(self):
+        with self.lock:
+            if not self.pending and self.built_first == self.first:
+                return
+            parts = [(self.hashes, self.ad_ids, self.times)] if self.hashes is not None else []
+            parts += [
+                (hashes, np.full(len(hashes), ad_id, dtype=np.int64), times)
+                for ad_id, hashes, times in self.pending
+            ]
+            self.pending = []
+            hashes, ad_ids, times = (np.concatenate(values) for values in zip(*parts))
+            keep = ad_ids >= self.first
+            hashes, ad_ids, times = hashes[keep], ad_ids[keep], times[keep]
+            order = np.argsort(hashes, kind='stable')
+            self.hashes, self.ad_ids, self.times = hashes[order], ad_ids[order], times[order]
+            self.built_first = self.first
+
+    # Known commercials in an episode, as dicts with 'sponsor', 'start', 'end'
+    # in seconds and 'votes': how many landmarks agree.
+    def match(self, hashes, times, min_votes=20):
+        self.build()
+        if self.hashes is None or not len(hashes):
+            return []
+        left = np.searchsorted(self.hashes, hashes, 'left')
+        right = np.searchsorted(self.hashes, hashes, 'right')
+        counts = right - left
+        if not counts.sum():
+            return []
+        query = np.repeat(np.arange(len(hashes)), counts)
+        positions = np.repeat(left - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+        ad_ids = self.ad_ids[positions]
+        offsets = times[query] - self.times[positions]
+
+        # Votes for each (commercial, offset), counting offsets one frame off
+        # too, since the commercial rarely starts on a frame boundary.
+        keys, votes = np.unique((ad_ids << 32) + offsets + (1 << 31), return_counts=True)
+        smoothed = votes.copy()
+        for neighbour in (keys - 1, keys + 1):
+            index = np.clip(np.searchsorted(keys, neighbour), 0, len(keys) - 1)
+            smoothed += np.where(keys[index] == neighbour, votes[index], 0)
+
+        matches = []
+        for index in np.argsort(-smoothed):
+            if smoothed[index] < min_votes:
+                break
+            ad_id = int(keys[index] >> 32)
+            start = float(((keys[index] & 0xFFFFFFFF) - (1 << 31)) * FRAME_SECONDS)
+            ad = self.ads[ad_id]
+            if any(match['ad_id'] == ad_id and abs(match['start'] - start) < ad['duration']
+                   for match in matches):
+                continue
+            matches.append({
+                'ad_id': ad_id,
+                'sponsor': ad['sponsor'],
+                'start': max(0.0, start),
+                'end': start + ad['duration'],
+                'votes': int(smoothed[index]),
+            })
+        return sorted(matches, key=lambda match: match['start'])
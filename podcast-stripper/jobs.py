@@ -0,0 +1,285 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from cache import to_json_value, to_namespace
+
+# Every episode goes through these in order, or ends up failed. Only episodes
+# waiting for a batch are batched.
+STATES = ('queued', 'transcribed', 'batched', 'detected', 'rendered', 'failed')
+# Episodes in these states still have work to do.
+PENDING = ('queued', 'transcribed', 'detected')
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL,
+    content_hash TEXT NOT NULL,
+    output TEXT NOT NULL,
+    settings TEXT NOT NULL,
+    state TEXT NOT NULL DEFAULT 'queued',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    transcript TEXT,
+    commercials TEXT,
+    created REAL NOT NULL,
+    updated REAL NOT NULL,
+    not_before REAL NOT NULL DEFAULT 0,
+    fresh INTEGER NOT NULL DEFAULT 0,
+    weight REAL NOT NULL DEFAULT 1,
+    UNIQUE (path, content_hash)
+)
+'''
+
+# The error of jobs that can never work, like episodes that are too long.
+SKIPPED = 'skipped'
+
+# The state of a job that starts again after the last stage it finished.
+RESUMED_STATE = ("CASE WHEN commercials IS NOT NULL THEN 'detected' "
+                 "WHEN transcript IS NOT NULL THEN 'transcribed' ELSE 'queued' END")
+
+# Columns added since the first version of the table, for older databases.
+ADDED_COLUMNS = {
+    'fresh': 'INTEGER NOT NULL DEFAULT 0',
+    'weight': 'REAL NOT NULL DEFAULT 1',
+}
+
+# Seconds for a backlog episode to gain one point of priority while it waits.
+AGING = 3600
+
+
+# Episodes to strip, kept in SQLite so they survive a restart. Each job
+# remembers the transcript and commercials once it has them, so it picks up
+# after the last stage it finished.
+# Fresh episodes are taken first, by their feed's weight, then the backlog by
+# its feed's weight, with every aging seconds spent waiting worth one more
+# point, so long-waiting episodes go ahead of newer backlog from heavier feeds.
+# Ties go to the job queued first.
+class JobQueue:
+    def __init__(self, database=':memory:', max_attempts=3, retry_delay=60, clock=time.time,
+                 aging=AGING):
+        self.connection = sqlite3.connect(database, check_same_thread=False)
+        self.connection.row_factory = sqlite3.Row
+        with self.connection:
+            self.connection.execute(SCHEMA)
+            columns = {row['name'] for row in self.connection.execute('PRAGMA table_info(jobs)')}
+            for column, definition in ADDED_COLUMNS.items():
+                if column not in columns:
+                    self.connection.execute(f'ALTER TABLE jobs ADD COLUMN {column} {definition}')
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.aging = aging
+        self.clock = clock
+        # Jobs handed out by take and not yet finished or failed.
+        self.active = set()
+        self.changed = threading.Condition()
+
+    # Returns the job's id, or None when the same file needs no new job. A
+    # file that failed goes back in the queue after the last stage it
+    # finished. One that was stripped, but isn't any more, starts over.
+    def add(self, path, output, settings, content_hash, fresh=False, weight=1):
+        now = self.clock()
+        with self.changed:
+            row = self.find(path, content_hash)
+            if row is not None and self.is_handled(row):
+                return None
+            with self.connection:
+                if row is None:
+                    cursor = self.connection.execute(
+                        'INSERT INTO jobs '
+                        '(path, content_hash, output, settings, created, updated, fresh, weight) '
+                        'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                        (path, content_hash, output, json.dumps(settings), now, now,
+                         int(fresh), weight)
+                    )
+                    job_id = cursor.lastrowid
+                else:
+                    job_id = row['id']
+                    if row['state'] == 'rendered':
+                        self.connection.execute(
+                            'UPDATE jobs SET transcript = NULL, commercials = NULL WHERE id = ?',
+                            (job_id,))
+                    self.connection.execute(
+                        f'UPDATE jobs SET state = {RESUMED_STATE}, output = ?, settings = ?, '
+                        'attempts = 0, error = NULL, not_before = 0, fresh = ?, weight = ?, '
+                        'created = ?, updated = ? WHERE id = ?',
+                        (output, json.dumps(settings), int(fresh), weight, now, now, job_id)
+                    )
+            self.changed.notify_all()
+            return job_id
+
+    def find(self, path, content_hash):
+        return self.connection.execute(
+            'SELECT * FROM jobs WHERE path = ? AND content_hash = ?',
+            (path, content_hash)).fetchone()
+
+    # A job needs nothing more when it still has work left or is waiting for
+    # a batch, was skipped, or was stripped and the stripped file is there.
+    @staticmethod
+    def is_handled(row):
+        if row['state'] == 'rendered':
+            return os.path.exists(row['output'])
+        if row['state'] == 'failed':
+            return row['error'] == SKIPPED
+        return True
+
+    # Whether the file at path with content_hash needs no new job.
+    def has_job(self, path, content_hash):
+        with self.changed:
+            row = self.find(path, content_hash)
+        return row is not None and self.is_handled(row)
+
+    def to_job(self, row):
+        job = {
+            'id': row['id'],
+            'path': row['path'],
+            'output': row['output'],
+            'state': row['state'],
+            **json.loads(row['settings']),
+        }
+        if row['transcript'] is not None:
+            job['transcript'] = to_namespace(json.loads(row['transcript']))
+        if row['commercials'] is not None:
+            job['commercials'] = json.loads(row['commercials'])
+        return job
+
+    def get(self, job_id):
+        with self.changed:
+            row = self.connection.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        return self.to_job(row) if row else None
+
+    # The due job with work left and the highest priority, and how long until
+    # one is due if none is.
+    def next_ready(self):
+        placeholders = ', '.join('?' * len(PENDING))
+        now = self.clock()
+        rows = self.connection.execute(
+            'SELECT *, weight + CASE WHEN fresh THEN 0 ELSE (? - created) / ? END AS priority '
+            f'FROM jobs WHERE state IN ({placeholders}) '
+            'ORDER BY fresh DESC, priority DESC, created, id',
+            (now, self.aging, *PENDING)
+        )
+        wait = None
+        for row in rows:
+            if row['id'] in self.active:
+                continue
+            if row['not_before'] > now:
+                due = row['not_before'] - now
+                wait = due if wait is None else min(wait, due)
+                continue
+            return row, None
+        return None, wait
+
+    # Wait for a job with work left and return it as a job dict. Returns None
+    # if there is none after timeout seconds.
+    def take(self, timeout=None):
+        deadline = None if timeout is None else self.clock() + timeout
+        with self.changed:
+            while True:
+                row, wait = self.next_ready()
+                if row is not None:
+                    self.active.add(row['id'])
+                    return self.to_job(row)
+                if deadline is not None:
+                    remaining = deadline - self.clock()
+                    if remaining <= 0:
+                        return None
+                    wait = remaining if wait is None else min(wait, remaining)
+                self.changed.wait(wait)
+
+    def update(self, job_id, **columns):
+        assignments = ', '.join(f'{column} = ?' for column in columns)
+        with self.connection:
+            self.connection.execute(
+                f'UPDATE jobs SET {assignments}, updated = ? WHERE id = ?',
+                (*columns.values(), self.clock(), job_id)
+            )
+
+    def advance(self, job_id, state, transcript=None, commercials=None):
+        columns = {'state': state}
+        if transcript is not None:
+            columns['transcript'] = json.dumps(to_json_value(transcript))
+        if commercials is not None:
+            columns['commercials'] = json.dumps(commercials)
+        with self.changed:
+            self.update(job_id, **columns)
+            self.changed.notify_all()
+
+    # Put a job aside in a state that isn't pending, without counting an
+    # attempt, until something advances it again.
+    def release(self, job_id, state):
+        with self.changed:
+            self.update(job_id, state=state)
+            self.active.discard(job_id)
+            self.changed.notify_all()
+
+    # Every job in one state goes to another.
+    def move(self, from_state, to_state):
+        with self.changed:
+            with self.connection:
+                self.connection.execute(
+                    'UPDATE jobs SET state = ?, updated = ? WHERE state = ?',
+                    (to_state, self.clock(), from_state)
+                )
+            self.changed.notify_all()
+
+    # Returns whether the job was fresh and the seconds since it was queued.
+    def finish(self, job_id):
+        with self.changed:
+            self.update(job_id, state='rendered', error=None)
+            self.active.discard(job_id)
+            self.changed.notify_all()
+            row = self.connection.execute(
+                'SELECT fresh, created FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        return bool(row['fresh']), self.clock() - row['created']
+
+    # Try again later from the last stage that finished, with exponential
+    # backoff, or give up after max_attempts. Jobs that can never work, like
+    # episodes that are too long, don't retry.
+    def fail(self, job_id, error, retry=True):
+        with self.changed:
+            row = self.connection.execute(
+                'SELECT attempts FROM jobs WHERE id = ?', (job_id,)).fetchone()
+            attempts = row['attempts'] + 1
+            if retry and attempts < self.max_attempts:
+                self.update(job_id, attempts=attempts, error=str(error),
+                            not_before=self.clock() + self.retry_delay * 2 ** (attempts - 1))
+            else:
+                self.update(job_id, attempts=attempts, error=str(error), state='failed')
+            self.active.discard(job_id)
+            self.changed.notify_all()
+
+    # Failed jobs go back to the queue with their attempts reset, to pick up
+    # after the last stage they finished. Skipped jobs stay failed unless
+    # skipped is set. Returns how many went back.
+    def retry_failed(self, skipped=False):
+        with self.changed:
+            with self.connection:
+                cursor = self.connection.execute(
+                    f'UPDATE jobs SET state = {RESUMED_STATE}, '
+                    'attempts = 0, error = NULL, not_before = 0, updated = ? '
+                    "WHERE state = 'failed' AND (? OR error IS NOT ?)",
+                    (self.clock(), skipped, SKIPPED)
+                )
+            self.changed.notify_all()
+            return cursor.rowcount
+
+    # (state, count, seconds since the oldest job got there) for each state.
+    def status(self):
+        now = self.clock()
+        with self.changed:
+            rows = self.connection.execute(
+                'SELECT state, COUNT(*) AS count, MIN(updated) AS oldest '
+                'FROM jobs GROUP BY state'
+            ).fetchall()
+        found = {row['state']: (row['count'], now - row['oldest']) for row in rows}
+        return [(state, *found.get(state, (0, 0))) for state in STATES]
+
+    def failures(self, limit=10):
+        with self.changed:
+            return self.connection.execute(
+                "SELECT path, attempts, error FROM jobs WHERE state = 'failed' "
+                'ORDER BY updated DESC LIMIT ?', (limit,)
+            ).fetchall()
@@ -0,0 +1,385 @@
+from array import array
+from collections import namedtuple
+import mmap
+import os
+import shutil
+import tempfile
+
+# Reading MP3 headers ourselves is much quicker than starting ffprobe, and
+# covers almost every podcast.
+
+# Kilobits per second by (MPEG version, layer), where version 2 also stands
+# for 2.5.
+BITRATES = {
+    (1, 1): [0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448],
+    (1, 2): [0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384],
+    (1, 3): [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],
+    (2, 1): [0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256],
+    (2, 2): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+    (2, 3): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+}
+SAMPLE_RATES = {
+    1: [44100, 48000, 32000],
+    2: [22050, 24000, 16000],
+    2.5: [11025, 12000, 8000],
+}
+VERSIONS = {0: 2.5, 2: 2, 3: 1}
+LAYERS = {1: 3, 2: 2, 3: 1}
+
+Frame = namedtuple('Frame', 'version layer bitrate sample_rate channels length samples')
+Info = namedtuple('Info', 'duration bitrate sample_rate channels has_art')
+
+
+def parse_frame_header(header):
+    if len(header) < 4 or header[0] != 0xFF or header[1] & 0xE0 != 0xE0:
+        return None
+    version = VERSIONS.get((header[1] >> 3) & 3)
+    layer = LAYERS.get((header[1] >> 1) & 3)
+    bitrate_index = header[2] >> 4
+    sample_rate_index = (header[2] >> 2) & 3
+    if version is None or layer is None or bitrate_index in (0, 15) or sample_rate_index == 3:
+        return None
+    bitrate = BITRATES[(int(version == 1) or 2, layer)][bitrate_index] * 1000
+    sample_rate = SAMPLE_RATES[version][sample_rate_index]
+    padding = (header[2] >> 1) & 1
+    channels = 1 if header[3] >> 6 == 3 else 2
+    if layer == 1:
+        samples = 384
+        length = (12 * bitrate // sample_rate + padding) * 4
+    else:
+        samples = 1152 if layer == 2 or version == 1 else 576
+        length = samples // 8 * bitrate // sample_rate + padding
+    return Frame(version, layer, bitrate, sample_rate, channels, length, samples)
+
+
+def syncsafe(data):
+    return (data[0] << 21) | (data[1] << 14) | (data[2] << 7) | data[3]
+
+
+# The size of the ID3v2 tag at the start of the file, and whether it has
+# cover art.
+def read_id3(file):
+    file.seek(0)
+    header = file.read(10)
+    if len(header) < 10 or header[:3] != b'ID3':
+        return 0, False
+    major = header[3]
+    size = 10 + syncsafe(header[6:10]) + (10 if header[5] & 0x10 else 0)
+
+    has_art = False
+    art_frame, header_size = (b'PIC', 6) if major == 2 else (b'APIC', 10)
+    position = 10
+    while position + header_size <= size:
+        file.seek(position)
+        frame = file.read(header_size)
+        if not frame[:3].strip(b'\0'):
+            break
+        if major == 2:
+            frame_id, frame_size = frame[:3], int.from_bytes(frame[3:6], 'big')
+        elif major == 4:
+            frame_id, frame_size = frame[:4], syncsafe(frame[4:8])
+        else:
+            frame_id, frame_size = frame[:4], int.from_bytes(frame[4:8], 'big')
+        if frame_id == art_frame:
+            has_art = True
+            break
+        position += header_size + frame_size
+    return size, has_art
+
+
+# The first frame header at or after offset that is followed by another,
+# so we don't mistake stray bytes for one.
+def find_first_frame(file, offset, search=64 * 1024):
+    file.seek(offset)
+    data = file.read(search)
+    position = data.find(b'\xff')
+    while 0 <= position < len(data) - 4:
+        frame = parse_frame_header(data[position:position + 4])
+        if frame:
+            following = data[position + frame.length:position + frame.length + 4]
+            if len(following) < 4 or parse_frame_header(following):
+                return offset + position, frame, data[position:]
+        position = data.find(b'\xff', position + 1)
+    return None, None, None
+
+
+def side_info_size(frame):
+    if frame.version == 1:
+        return 17 if frame.channels == 1 else 32
+    return 9 if frame.channels == 1 else 17
+
+
+# Frame count from a Xing/Info or VBRI header in the first frame, and the
+# LAME encoder delay and padding in samples.
+def read_vbr_header(frame, data):
+    xing = 4 + side_info_size(frame)
+    if data[xing:xing + 4] in (b'Xing', b'Info'):
+        flags = int.from_bytes(data[xing + 4:xing + 8], 'big')
+        if not flags & 1:
+            return None, 0
+        frames = int.from_bytes(data[xing + 8:xing + 12], 'big')
+        lame = xing + 8 + 4 * bin(flags & 3).count('1') + (100 if flags & 4 else 0)
+        lame += 4 if flags & 8 else 0
+        skip = 0
+        if data[lame:lame + 4] in (b'LAME', b'Lavf', b'Lavc'):
+            delay_padding = int.from_bytes(data[lame + 21:lame + 24], 'big')
+            skip = (delay_padding >> 12) + (delay_padding & 0xFFF)
+        return frames, skip
+    if data[36:40] == b'VBRI':
+        return int.from_bytes(data[50:54], 'big'), 0
+    return None, 0
+
+
+# A Xing/Info or VBRI frame describes the file rather than holding audio.
+def has_vbr_header(frame, data):
+    xing = 4 + side_info_size(frame)
+    return data[xing:xing + 4] in (b'Xing', b'Info') or data[36:40] == b'VBRI'
+
+
+# Duration in seconds, bitrate in bits per second, sample rate, channels and
+# whether there is cover art, or None if this doesn't look like an MP3.
+def read_mp3_info(filename):
+    size = os.path.getsize(filename)
+    with open(filename, 'rb') as file:
+        tag_size, has_art = read_id3(file)
+        start, frame, data = find_first_frame(file, tag_size)
+        if frame is None:
+            return None
+        end = size
+        if size >= 128:
+            file.seek(size - 128)
+            if file.read(3) == b'TAG':
+                end -= 128
+    audio_bytes = end - start
+
+    frames, skip = read_vbr_header(frame, data)
+    if frames:
+        # Less the silence encoders add at the start and end.
+        duration = max(0, frames * frame.samples - skip) / frame.sample_rate
+        bitrate = round(audio_bytes * 8 / duration) if duration else frame.bitrate
+    else:
+        duration = audio_bytes * 8 / frame.bitrate
+        bitrate = frame.bitrate
+    return Info(duration, bitrate, frame.sample_rate, frame.channels, has_art)
+
+
+# Where a frame's own audio data starts, after the header, CRC and side info.
+def main_data_start(data, offset, frame):
+    has_crc = not data[offset + 1] & 1
+    return offset + 4 + (2 if has_crc else 0) + side_info_size(frame)
+
+
+# How many bytes before its own main data a layer III frame's audio starts,
+# in the bit reservoir of earlier frames.
+def main_data_begin(data, offset, frame):
+    side_info = main_data_start(data, offset, frame) - side_info_size(frame)
+    if frame.version == 1:
+        return (data[side_info] << 1) | (data[side_info + 1] >> 7)
+    return data[side_info]
+
+
+# Offsets of every frame in an MP3 file, with one more for the end of the
+# last, and how far back into earlier frames each one's audio data starts.
+# first_frame is the first frame with audio, after any Xing/Info frame.
+FrameIndex = namedtuple('FrameIndex', 'tag_size first_frame frame offsets reservoir')
+
+
+def index_frames(filename):
+    with open(filename, 'rb') as file:
+        tag_size, _ = read_id3(file)
+        start, frame, data = find_first_frame(file, tag_size)
+        if frame is None or frame.layer != 3:
+            return None
+        first_frame = 1 if has_vbr_header(frame, data) else 0
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            offsets = array('Q')
+            reservoir = array('H')
+            frames = {}
+            position = start
+            while position + 4 <= len(data):
+                header = data[position:position + 4]
+                if header not in frames:
+                    frames[header] = parse_frame_header(header)
+                current = frames[header]
+                if current is None or current.layer != 3 or position + current.length > len(data):
+                    break
+                offsets.append(position)
+                reservoir.append(main_data_begin(data, position, current))
+                position += current.length
+            offsets.append(position)
+    return FrameIndex(tag_size, first_frame, frame, offsets, reservoir)
+
+
+# A frame header like template's, without CRC and at the highest bitrate, so
+# there is room for a full bit reservoir or a Xing header.
+def get_roomy_header(template):
+    return bytes([
+        template[0],
+        template[1] | 1,
+        (14 << 4) | (template[2] & 0x0D),
+        template[3],
+    ])
+
+
+# A frame that plays as silence but holds the bit reservoir a cut-off frame
+# needs from the frames before it.
+def get_reservoir_frame(template, reservoir_bytes):
+    header = get_roomy_header(template)
+    frame = parse_frame_header(header)
+    body = bytearray(frame.length - 4)
+    body[len(body) - len(reservoir_bytes):] = reservoir_bytes
+    return header + bytes(body)
+
+
+# The main data of the frames before frame number, which it may start in.
+def get_reservoir(data, index, number):
+    needed = index.reservoir[number]
+    pieces = []
+    while needed > 0 and number > index.first_frame:
+        number -= 1
+        offset = index.offsets[number]
+        frame = parse_frame_header(data[offset:offset + 4])
+        piece = data[main_data_start(data, offset, frame):index.offsets[number + 1]]
+        pieces.insert(0, piece[-needed:])
+        needed -= len(piece)
+    return b''.join(pieces)
+
+
+def get_xing_frame(template, frames, size):
+    header = get_roomy_header(template)
+    frame = parse_frame_header(header)
+    body = bytearray(frame.length - 4)
+    xing = side_info_size(frame)
+    body[xing:xing + 16] = (b'Xing' + (3).to_bytes(4, 'big') + frames.to_bytes(4, 'big')
+                            + size.to_bytes(4, 'big'))
+    return header + bytes(body)
+
+
+def count_frames(data):
+    count = 0
+    position = 0
+    while position + 4 <= len(data):
+        frame = parse_frame_header(data[position:position + 4])
+        if frame is None:
+            break
+        count += 1
+        position += frame.length
+    return count
+
+
+# Room left in the ID3 tags we write, so the next change to them can be
+# made in place.
+ID3_PADDING = 4096
+
+
+# The frames of an ID3v2.3 or 2.4 tag as (id, flags, body), or None for
+# tags we don't rewrite ourselves: version 2.2, unsynchronised, or with an
+# extended header or footer.
+def read_id3_frames(tag):
+    if tag[:3] != b'ID3' or tag[3] not in (3, 4) or tag[5] & 0xF0:
+        return None
+    major = tag[3]
+    frames = []
+    position = 10
+    while position + 10 <= len(tag):
+        frame_id = tag[position:position + 4]
+        if not frame_id.strip(b'\0'):
+            break
+        if major == 4:
+            size = syncsafe(tag[position + 4:position + 8])
+        else:
+            size = int.from_bytes(tag[position + 4:position + 8], 'big')
+        flags = tag[position + 8:position + 10]
+        frames.append((frame_id, flags, tag[position + 10:position + 10 + size]))
+        position += 10 + size
+    return frames
+
+
+def to_syncsafe(number):
+    return bytes((number >> shift) & 0x7F for shift in (21, 14, 7, 0))
+
+
+# An ID3v2 tag of exactly size bytes, or as small as it can be plus
+# ID3_PADDING.
+def build_id3_tag(major, frames, size=None):
+    body = b''
+    for frame_id, flags, frame_body in frames:
+        length = to_syncsafe(len(frame_body)) if major == 4 else len(frame_body).to_bytes(4, 'big')
+        body += frame_id + length + flags + frame_body
+    if size is None:
+        size = 10 + len(body) + ID3_PADDING
+    if 10 + len(body) > size:
+        return None
+    body += bytes(size - 10 - len(body))
+    return b'ID3' + bytes([major, 0, 0]) + to_syncsafe(len(body)) + body
+
+
+def get_apic_frame(image, mime='image/jpeg'):
+    # Latin-1 text, front cover, no description.
+    return (b'APIC', b'\0\0', b'\0' + mime.encode() + b'\0\x03\0' + image)
+
+
+# tag with any pictures replaced by image, the same size if it fits.
+def replace_art(tag, image, mime='image/jpeg'):
+    if not tag:
+        return build_id3_tag(4, [get_apic_frame(image, mime)])
+    frames = read_id3_frames(tag)
+    if frames is None:
+        return None
+    frames = [frame for frame in frames if frame[0] != b'APIC'] + [get_apic_frame(image, mime)]
+    return build_id3_tag(tag[3], frames, len(tag)) or build_id3_tag(tag[3], frames)
+
+
+# Set the cover art of an MP3 file. The tag is rewritten in place when its
+# padding has room, otherwise the file is written once with a new tag.
+# Returns False if we can't rewrite this file's tag.
+def write_art(filename, image, mime='image/jpeg'):
+    with open(filename, 'r+b') as file:
+        tag_size, _ = read_id3(file)
+        file.seek(0)
+        tag = replace_art(file.read(tag_size), image, mime)
+        if tag is None:
+            return False
+        if len(tag) == tag_size:
+            file.seek(0)
+            file.write(tag)
+            return True
+        directory = os.path.dirname(os.path.abspath(filename))
+        with tempfile.NamedTemporaryFile(dir=directory, prefix='.', delete=False) as temp:
+            try:
+                temp.write(tag)
+                file.seek(tag_size)
+                shutil.copyfileobj(file, temp, 1 << 20)
+            except BaseException:
+                os.remove(temp.name)
+                raise
+    os.chmod(temp.name, os.stat(filename).st_mode)
+    os.replace(temp.name, filename)
+    return True
+
+
+# The first picture in an MP3 file's ID3 tag, as (mime type, image data).
+def read_art(filename):
+    with open(filename, 'rb') as file:
+        tag_size, has_art = read_id3(file)
+        if not has_art:
+            return None
+        file.seek(0)
+        frames = read_id3_frames(file.read(tag_size))
+    for frame_id, flags, body in frames or []:
+        # Compressed, encrypted or otherwise encoded pictures are left to
+        # ffmpeg.
+        if frame_id != b'APIC' or flags[1]:
+            continue
+        encoding = body[0]
+        mime_end = body.index(b'\0', 1)
+        mime = body[1:mime_end].decode('latin-1')
+        terminator = b'\0\0' if encoding in (1, 2) else b'\0'
+        position = mime_end + 2
+        while True:
+            position = body.index(terminator, position)
+            if encoding not in (1, 2) or (position - mime_end) % 2 == 0:
+                break
+            position += 1
+        return mime, body[position + len(terminator):]
+    return None
@@ -1,5 +1,39 @@
+from concurrent.futures import ThreadPoolExecutor
 import datetime
+import hashlib
 import json
+import os
+import tempfile
+import time
+import wave
+
+from cache import (
+    ResultCache,
+    SponsorCache,
+    get_key,
+    get_sponsor_key,
+    normalize_sponsor,
+    to_json_value,
+    to_namespace
+)
+from ratelimit import RateLimiter
+
+try:
+    from ..common import metrics
+except ImportError:
+    from metrics import metrics
+
+# Shared by every thread talking to OpenAI.
+limiter = RateLimiter()
+sponsor_cache = SponsorCache(name='tts')
+result_cache = ResultCache(name='results')
+
+TRANSCRIPTION_MODEL = "whisper-1"
+COMMERCIALS_MODEL = "gpt-4o-mini"
+
+TTS_MODEL = "tts-1"
+TTS_VOICE = "shimmer"
+TTS_FORMAT = "wav"
 
 
 def srt_format(timestamp):
@@ -7,19 +41,73 @@ def srt_format(timestamp):
         datetime.datetime.fromtimestamp(timestamp), "%H:%M:%S,%f")[:-3]
 
 
-def get_transcript(client, filename):
-    transcript = client.audio.transcriptions.create(
-        model="whisper-1",
-        prompt="",
-        response_format="verbose_json",
-        file=open(filename, "rb")
-    )
+# The transcript of the same audio is the same, so it is cached by a hash of
+# the audio. audio is the name of a file or the encoded audio itself.
+def get_transcript(client, audio, extension='mp3'):
+    if isinstance(audio, str):
+        extension = audio.rsplit('.', 1)[-1]
+        with open(audio, 'rb') as file:
+            audio = file.read()
+
+    key = get_key(TRANSCRIPTION_MODEL, hashlib.sha256(audio).hexdigest())
+    cached = result_cache.get_json(key)
+    if cached is not None:
+        print('Using cached transcript')
+        return to_namespace(cached)
+
+    print(f'Uploading {len(audio)} bytes to transcribe')
+    metrics.count('upload_bytes_total', len(audio), endpoint='transcriptions')
+    with metrics.timer('openai_seconds', endpoint='transcriptions'):
+        response = limiter.call(
+            'transcriptions',
+            client.audio.transcriptions.with_raw_response.create,
+            model=TRANSCRIPTION_MODEL,
+            prompt="",
+            response_format="verbose_json",
+            file=(f'audio.{extension}', audio)
+        )
+    transcript = response.parse()
+    result_cache.put_json(key, transcript)
     return transcript
 
 
-def get_commercials(client, transcript):
-    # TODO Bobby: use "structured outputs" Aug 6 model
-    prompt = """Analyze the following SRT transcript of a podcast episode to
+# One transcript of consecutive chunks of audio, starting at offsets seconds.
+def stitch_transcripts(transcripts, offsets):
+    segments = []
+    for transcript, offset in zip(transcripts, offsets):
+        for segment in to_json_value(transcript)['segments']:
+            segments.append({
+                **segment,
+                'id': len(segments),
+                'start': segment['start'] + offset,
+                'end': segment['end'] + offset,
+            })
+    return to_namespace({
+        'text': ' '.join(transcript.text.strip() for transcript in transcripts),
+        'segments': segments,
+    })
+
+
+# Chunks are (offset, audio) of consecutive parts of one episode. They are
+# transcribed at the same time.
+def get_chunked_transcript(client, chunks, extension='mp3', workers=4):
+    if len(chunks) == 1:
+        return get_transcript(client, chunks[0][1], extension)
+
+    print(f'Transcribing {len(chunks)} chunks')
+    with ThreadPoolExecutor(workers) as executor:
+        transcripts = list(executor.map(
+            lambda chunk: get_transcript(client, chunk[1], extension), chunks))
+    return stitch_transcripts(transcripts, [offset for offset, _ in chunks])
+
+
+def get_transcript_hash(transcript):
+    return get_key([
+        (segment.start, segment.end, segment.text) for segment in transcript.segments
+    ])
+
+
+COMMERCIALS_PROMPT = """Analyze the following SRT transcript of a podcast episode to
         identify commercial segments. Commercial segments are typically
         introduced by a break or change in topic, often followed by
         sponsorship mentions. For each commercial:
@@ -31,39 +119,226 @@ def get_commercials(client, transcript):
 
         Use JSON. Example format:
 
-        [
+        {"commercials": [
             {"sponsor": "Some Company",
              "start_line": 77,
              "end_line": 80},
             {"sponsor": "Some Other Company",
              "start_line": 103,
              "end_line": 111}
-        ]
+        ]}
+        """
+
+COMMERCIALS_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "commercials",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {
+                "commercials": {
+                    "type": "array",
+                    "items": {
+                        "type": "object",
+                        "properties": {
+                            "sponsor": {"type": "string"},
+                            "start_line": {"type": "integer"},
+                            "end_line": {"type": "integer"},
+                        },
+                        "required": ["sponsor", "start_line", "end_line"],
+                        "additionalProperties": False,
+                    },
+                },
+            },
+            "required": ["commercials"],
+            "additionalProperties": False,
+        },
+    },
+}
+
+
+PACKED_PROMPT = COMMERCIALS_PROMPT + """
+        The transcript is in one message. Each line starts with its line
+        number.
         """
 
+
+# The transcript as chat messages.
+#   messages: one message per line, with SRT timestamps.
+#   packed: one message, with only line numbers and text.
+def get_messages(transcript, lines, encoding='packed'):
+    segments = transcript.segments
+    if encoding == 'packed':
+        return [
+            {"role": "system", "content": PACKED_PROMPT},
+            {
+                "role": "user",
+                "content": '\n'.join(f"{line} {segments[line].text.strip()}" for line in lines)
+            },
+        ]
+
     messages = [
         {
             "role": "user",
-            "content": (f"{line} {srt_format(segment.start)}"
-                        + f"--> {srt_format(segment.end)} {segment.text}")
-        } for line, segment in enumerate(transcript.segments)
+            "content": (f"{line} {srt_format(segments[line].start)}"
+                        + f"--> {srt_format(segments[line].end)} {segments[line].text}")
+        } for line in lines
     ]
-    messages.insert(0, {"role": "system", "content": prompt})
+    messages.insert(0, {"role": "system", "content": COMMERCIALS_PROMPT})
+    return messages
 
-    completion = client.chat.completions.create(
-        model="gpt-4o-mini",
-        messages=messages
-    )
 
-    # trim non-json from the front
-    json_string = completion.choices[0].message.content[
-        completion.choices[0].message.content.index('['):]
+# Yields each object in a JSON array as soon as it is complete, from JSON
+# arriving a piece at a time.
+def iter_array_objects(pieces):
+    text = ''
+    containers = []
+    in_string = False
+    escaped = False
+    start = None
+    for piece in pieces:
+        offset = len(text)
+        text += piece
+        for index in range(offset, len(text)):
+            character = text[index]
+            if in_string:
+                if escaped:
+                    escaped = False
+                elif character == '\\':
+                    escaped = True
+                elif character == '"':
+                    in_string = False
+            elif character == '"':
+                in_string = True
+            elif character in '{[':
+                if character == '{' and containers and containers[-1] == '[':
+                    start = index
+                containers.append(character)
+            elif character in '}]' and containers:
+                containers.pop()
+                if character == '}' and containers and containers[-1] == '[' and start is not None:
+                    yield json.loads(text[start:index + 1])
+                    start = None
 
-    # handle non-json in the end
-    try:
-        return json.loads(json_string)
-    except json.JSONDecodeError as e:
-        return json.loads(json_string[:e.pos])
+
+# The text of a streamed chat completion, counting the tokens it reports.
+def get_pieces(stream):
+    for chunk in stream:
+        usage = getattr(chunk, 'usage', None)
+        if usage:
+            metrics.count('tokens_total', usage.prompt_tokens, direction='in',
+                          model=COMMERCIALS_MODEL)
+            metrics.count('tokens_total', usage.completion_tokens, direction='out',
+                          model=COMMERCIALS_MODEL)
+        if chunk.choices:
+            yield chunk.choices[0].delta.content or ''
+
+
+# What to ask about lines of the transcript, and the key to cache the answer
+# by: what we send, the prompt and the model.
+def get_commercials_request(transcript, lines, encoding='packed'):
+    messages = get_messages(transcript, lines, encoding)
+    key = get_key(get_transcript_hash(transcript), get_key(messages[0]['content']),
+                  COMMERCIALS_MODEL, list(lines), encoding)
+    return key, {
+        'model': COMMERCIALS_MODEL,
+        'messages': messages,
+        'response_format': COMMERCIALS_FORMAT,
+    }
+
+
+# Commercials are yielded as the model writes them.
+def stream_commercials(client, transcript, lines, encoding='packed'):
+    key, request = get_commercials_request(transcript, lines, encoding)
+    cached = result_cache.get_json(key)
+    if cached is not None:
+        print('Using cached commercials')
+        yield from cached
+        return
+
+    start = time.perf_counter()
+    stream = limiter.call(
+        'chat',
+        client.chat.completions.with_raw_response.create,
+        **request,
+        stream=True,
+        # The last chunk says how many tokens we used.
+        stream_options={'include_usage': True}
+    ).parse()
+
+    commercials = []
+    for commercial in iter_array_objects(get_pieces(stream)):
+        commercials.append(commercial)
+        yield commercial
+    seconds = time.perf_counter() - start
+    metrics.observe('openai_seconds', seconds, endpoint='chat')
+    metrics.log('openai_seconds', endpoint='chat', seconds=round(seconds, 3),
+                lines=len(lines), commercials=len(commercials))
+    result_cache.put_json(key, commercials)
+
+
+def ask_for_commercials(client, transcript, lines, encoding='packed'):
+    return list(stream_commercials(client, transcript, lines, encoding))
+
+
+# Windows of lines, each overlapping the one before by overlap lines, but no
+# more than half a window.
+def get_windows(lines, window, overlap):
+    lines = list(lines)
+    if not window or len(lines) <= window:
+        return [lines]
+    overlap = min(overlap, window // 2)
+    step = window - overlap
+    return [lines[start:start + window] for start in range(0, len(lines) - overlap, step)]
+
+
+# The same commercial found in two overlapping windows is one commercial:
+# overlapping spans merge if they name the same sponsor, or if they overlap
+# by at least half the shorter one, as when each window spells the sponsor
+# its own way or only saw part of it. The first sponsor found is kept. Other
+# overlapping spans are back to back commercials for different sponsors, and
+# the later one starts after the earlier one ends.
+def merge_window_commercials(window_commercials):
+    merged = []
+    for commercial in sorted(
+            (commercial for commercials in window_commercials for commercial in commercials),
+            key=lambda commercial: (commercial['start_line'], commercial['end_line'])):
+        if merged and commercial['start_line'] <= merged[-1]['end_line']:
+            last = merged[-1]
+            overlap = min(last['end_line'], commercial['end_line']) - commercial['start_line'] + 1
+            shorter = min(last['end_line'] - last['start_line'],
+                          commercial['end_line'] - commercial['start_line']) + 1
+            if (normalize_sponsor(commercial['sponsor']) == normalize_sponsor(last['sponsor'])
+                    or 2 * overlap >= shorter):
+                last['end_line'] = max(last['end_line'], commercial['end_line'])
+                continue
+            commercial = {**commercial, 'start_line': last['end_line'] + 1}
+        merged.append(dict(commercial))
+    return merged
+
+
+# lines limits which lines of the transcript we send, keeping their numbers.
+# With window, long transcripts are sent as overlapping windows at the same
+# time. With stream, a transcript that fits in one window gives an iterator of
+# commercials as they arrive instead of a list.
+def get_commercials(client, transcript, lines=None, encoding='packed', window=0, overlap=20,
+                    workers=4, stream=False):
+    if lines is None:
+        lines = range(len(transcript.segments))
+    if not lines:
+        return []
+
+    windows = get_windows(lines, window, overlap)
+    if len(windows) == 1 and stream:
+        return stream_commercials(client, transcript, windows[0], encoding)
+    if len(windows) == 1:
+        return ask_for_commercials(client, transcript, windows[0], encoding)
+
+    print(f'Asking about {len(windows)} windows of {window} lines')
+    with ThreadPoolExecutor(workers) as executor:
+        return merge_window_commercials(executor.map(
+            lambda lines: ask_for_commercials(client, transcript, lines, encoding), windows))
 
 
 def combine_commercial_group(commercial_group):
@@ -75,11 +350,22 @@ def combine_commercial_group(commercial_group):
         sponsor = ', '.join([commercial['sponsor'] for commercial in commercial_group[:-1]])
         sponsor += f', and {commercial_group[-1]["sponsor"]}'
 
-    return {
+    # The group ends with whichever commercial ends last, which needn't be the
+    # last to start.
+    last = max(commercial_group, key=lambda commercial: commercial['end_line'])
+    combined = {
         'sponsor': sponsor,
         'start_line': commercial_group[0]['start_line'],
-        'end_line': commercial_group[-1]['end_line']
+        'end_line': last['end_line']
     }
+    # Commercials recognized by their audio know exactly where they start and end.
+    if 'start' in commercial_group[0]:
+        combined['start'] = commercial_group[0]['start']
+    if 'end' in last:
+        combined['end'] = last['end']
+    if any(commercial.get('known') for commercial in commercial_group):
+        combined['known'] = True
+    return combined
 
 
 def combine_commercials(commercials):
@@ -98,11 +384,43 @@ def combine_commercials(commercials):
         yield combine_commercial_group(commercial_group)
 
 
-def write_sponsor(client, company, file):
-    with client.audio.speech.with_streaming_response.create(
-        model="tts-1",
-        voice="shimmer",
-        input=f"This podcast is sponsored by, {company}.",
-        response_format='wav'
-    ) as response:
-        response.stream_to_file(file)
+# Streamed WAV headers don't know how long the audio is, so we go by the
+# file's size.
+def get_wav_seconds(file):
+    try:
+        with wave.open(file) as audio:
+            bytes_per_second = audio.getframerate() * audio.getnchannels() * audio.getsampwidth()
+    except (wave.Error, EOFError):
+        return 0
+    return max(0, os.path.getsize(file) - 44) / bytes_per_second
+
+
+# Returns the path of the sponsor announcement, which is file unless we
+# already had it in the cache. Then file, if it is an empty placeholder, is
+# removed.
+def write_sponsor(client, company, file=None):
+    key = get_sponsor_key(TTS_MODEL, TTS_VOICE, company, TTS_FORMAT)
+    cached = sponsor_cache.get(key, f'.{TTS_FORMAT}')
+    if cached:
+        if file is not None and os.path.exists(file) and not os.path.getsize(file):
+            os.remove(file)
+        return cached
+
+    if file is None:
+        with tempfile.NamedTemporaryFile(delete=False, suffix=f'.{TTS_FORMAT}') as temp:
+            file = temp.name
+
+    def stream():
+        with client.audio.speech.with_streaming_response.create(
+            model=TTS_MODEL,
+            voice=TTS_VOICE,
+            input=f"This podcast is sponsored by, {company}.",
+            response_format=TTS_FORMAT
+        ) as response:
+            response.stream_to_file(file)
+            return response
+
+    with metrics.timer('openai_seconds', endpoint='speech'):
+        limiter.call('speech', stream)
+    metrics.count('tts_seconds_total', get_wav_seconds(file))
+    return sponsor_cache.put(key, file, f'.{TTS_FORMAT}')
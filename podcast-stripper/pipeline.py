@@ -0,0 +1,114 @@
+from concurrent.futures import ProcessPoolExecutor
+import os
+import queue
+import threading
+import time
+
+try:
+    from ..common import collect, metrics
+except ImportError:
+    from metrics import collect, metrics
+
+
+def get_cpu_count():
+    # cgroup v2, then cgroup v1. Containers often see every core on the host
+    # but may only use a fraction of them.
+    quotas = [
+        ('/sys/fs/cgroup/cpu.max', None),
+        ('/sys/fs/cgroup/cpu/cpu.cfs_quota_us', '/sys/fs/cgroup/cpu/cpu.cfs_period_us'),
+    ]
+    for quota_file, period_file in quotas:
+        try:
+            with open(quota_file) as file:
+                values = file.read().split()
+            if period_file:
+                with open(period_file) as file:
+                    values.append(file.read().strip())
+            quota, period = values[:2]
+            if quota not in ('max', '-1'):
+                return max(1, int(quota) // int(period))
+        except (OSError, ValueError):
+            continue
+    return len(os.sched_getaffinity(0))
+
+
+# A bounded queue of jobs and the workers that drain it. Workers run
+# work(job) in their own thread, or in executor when one is given. The result
+# is handed to the next stage. A result of None drops the job.
+# on_result(job, result) and on_error(job, error) run in the worker thread,
+# to keep track of jobs. How long each job takes is recorded as
+# stage_seconds, along with whatever the work records in another process.
+class Stage:
+    def __init__(self, name, work, workers=1, executor=None, maxsize=None,
+                 on_result=None, on_error=None):
+        self.name = name
+        self.work = work
+        self.executor = executor
+        self.on_result = on_result
+        self.on_error = on_error
+        self.queue = queue.Queue(maxsize if maxsize is not None else 2 * workers)
+        self.next = None
+        self.threads = [
+            threading.Thread(target=self.run, name=f'{name}-{n}', daemon=True)
+            for n in range(workers)
+        ]
+
+    def start(self):
+        for thread in self.threads:
+            thread.start()
+
+    def run(self):
+        while True:
+            job = self.queue.get()
+            metrics.set('queue_depth', self.queue.qsize(), stage=self.name)
+            start = time.perf_counter()
+            try:
+                if isinstance(self.executor, ProcessPoolExecutor):
+                    result, snapshot = self.executor.submit(collect, self.work, job).result()
+                    metrics.merge(snapshot)
+                elif self.executor:
+                    result = self.executor.submit(self.work, job).result()
+                else:
+                    result = self.work(job)
+                seconds = time.perf_counter() - start
+                metrics.observe('stage_seconds', seconds, stage=self.name)
+                metrics.log('stage', stage=self.name, path=job.get('path'),
+                            seconds=round(seconds, 3))
+                if self.on_result:
+                    self.on_result(job, result)
+                if result is not None and self.next:
+                    self.next.queue.put(result)
+            except Exception as error:
+                print(f'{self.name} failed for {job.get("path")}: {error!r}')
+                metrics.count('stage_failures_total', stage=self.name)
+                if self.on_error:
+                    self.on_error(job, error)
+            finally:
+                self.queue.task_done()
+
+
+class Pipeline:
+    def __init__(self, stages):
+        self.stages = stages
+        for stage, next_stage in zip(stages, stages[1:]):
+            stage.next = next_stage
+        for stage in stages:
+            stage.start()
+
+    def submit(self, **job):
+        self.stages[0].queue.put(job)
+
+    # Blocks until the first stage has started on every job submitted, so the
+    # next job can be chosen as late as possible.
+    def wait_for_room(self):
+        queue = self.stages[0].queue
+        with queue.not_full:
+            while queue.queue:
+                queue.not_full.wait()
+
+    def depth(self):
+        return {stage.name: stage.queue.qsize() for stage in self.stages}
+
+    def join(self):
+        for stage in self.stages:
+            stage.queue.join()
@@ -0,0 +1,63 @@
+import re
+
+# Things people say when reading an ad, and how sure they make us.
+CUES = [
+    (2, r'brought to you by'),
+    (2, r'sponsored by'),
+    (2, r'support for (this|the) (podcast|show|program) comes from'),
+    (2, r'(promo|offer|discount) code'),
+    (2, r'use code'),
+    (1, r'\b\w+\s?(\.|dot)\s?(com|org|net|io|fm)\b'),
+    (1, r'\b(slash|/)\s?\w+'),
+    (1, r'free trial'),
+    (1, r'\d+\s?(%|percent) off'),
+    (1, r'first (month|order|box)'),
+    (1, r'(our|this) sponsor'),
+    (1, r'(a )?word from'),
+    (1, r'(go|head) (to|over to)'),
+    (1, r'sign up'),
+    (1, r'ad[- ]free'),
+]
+CUE_PATTERNS = [(weight, re.compile(pattern, re.IGNORECASE)) for weight, pattern in CUES]
+
+# Pre-roll and post-roll ads live in this fraction of the start and end.
+ROLL_FRACTION = 0.05
+
+
+def score_text(text, sponsors=()):
+    score = sum(weight for weight, pattern in CUE_PATTERNS if pattern.search(text))
+    lower = text.lower()
+    score += sum(2 for sponsor in sponsors if sponsor.lower() in lower)
+    return score
+
+
+def score_segments(segments, sponsors=()):
+    if not segments:
+        return []
+    duration = segments[-1].end
+    scores = []
+    for segment in segments:
+        score = score_text(segment.text, sponsors)
+        if (segment.start < duration * ROLL_FRACTION
+                or segment.end > duration * (1 - ROLL_FRACTION)):
+            score += 1
+        scores.append(score)
+    return scores
+
+
+# The line numbers worth asking the model about: every line scoring at least
+# threshold, and margin lines on either side of it. Lower threshold and higher
+# margin find more commercials and save fewer tokens.
+def get_candidate_lines(segments, threshold=2, margin=10, sponsors=()):
+    lines = set()
+    for line, score in enumerate(score_segments(segments, sponsors)):
+        if score >= threshold:
+            lines.update(range(max(0, line - margin), min(len(segments), line + margin + 1)))
+    return sorted(lines)
+
+
+# Roughly four characters per token.
+def estimate_tokens(segments, lines=None):
+    if lines is None:
+        lines = range(len(segments))
+    return sum(len(segments[line].text) // 4 + 1 for line in lines)
@@ -0,0 +1,131 @@
+from collections import defaultdict
+import random
+import re
+import threading
+import time
+
+from openai import RateLimitError
+
+# Requests per minute for each OpenAI endpoint we use.
+DEFAULT_LIMITS = {
+    'transcriptions': 50,
+    'chat': 500,
+    'speech': 50,
+}
+
+
+# OpenAI reports reset times like "1s", "6m0s" or "20ms".
+def parse_reset(value):
+    if value is None:
+        return None
+    units = {'h': 3600, 'm': 60, 's': 1, 'ms': 0.001}
+    parts = re.findall(r'([\d.]+)(ms|h|m|s)', value)
+    if not parts:
+        try:
+            return float(value)
+        except ValueError:
+            return None
+    return sum(float(number) * units[unit] for number, unit in parts)
+
+
+def get_retry_after(headers):
+    if not headers:
+        return None
+    if headers.get('retry-after-ms'):
+        return float(headers['retry-after-ms']) / 1000
+    return parse_reset(headers.get('retry-after'))
+
+
+class TokenBucket:
+    def __init__(self, per_minute, capacity=None, clock=time.monotonic):
+        self.rate = per_minute / 60
+        self.capacity = capacity or max(1, per_minute // 60)
+        self.tokens = self.capacity
+        self.clock = clock
+        self.updated = clock()
+        self.blocked_until = 0
+        self.lock = threading.Lock()
+
+    # Reserve a token and return how long the caller must wait before using it.
+    def reserve(self):
+        with self.lock:
+            now = self.clock()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+            return max(wait, self.blocked_until - now)
+
+    def block(self, seconds):
+        with self.lock:
+            self.blocked_until = max(self.blocked_until, self.clock() + seconds)
+
+
+class RateLimiter:
+    def __init__(self, limits=None, retries=6, base_delay=1, max_delay=60,
+                 clock=time.monotonic, sleep=time.sleep):
+        self.buckets = {}
+        self.clock = clock
+        self.sleep = sleep
+        self.retries = retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.requests = defaultdict(int)
+        self.rate_limited = defaultdict(int)
+        self.throttled_seconds = defaultdict(float)
+        self.lock = threading.Lock()
+        for endpoint, per_minute in {**DEFAULT_LIMITS, **(limits or {})}.items():
+            self.configure(endpoint, per_minute)
+
+    def configure(self, endpoint, per_minute):
+        self.buckets[endpoint] = TokenBucket(per_minute, clock=self.clock)
+
+    def wait(self, endpoint, seconds):
+        if seconds <= 0:
+            return
+        with self.lock:
+            self.throttled_seconds[endpoint] += seconds
+        self.sleep(seconds)
+
+    # Pause the endpoint when the response says we have used up our quota.
+    def update(self, endpoint, headers):
+        if not headers:
+            return
+        for kind in ('requests', 'tokens'):
+            remaining = headers.get(f'x-ratelimit-remaining-{kind}')
+            reset = parse_reset(headers.get(f'x-ratelimit-reset-{kind}'))
+            if remaining is not None and reset and int(remaining) <= 0:
+                self.buckets[endpoint].block(reset)
+
+    def backoff(self, attempt):
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    # Call function(*args, **kwargs) within the endpoint's limits, retrying
+    # with exponential backoff and jitter when OpenAI says we are too fast.
+    def call(self, endpoint, function, *args, **kwargs):
+        for attempt in range(self.retries + 1):
+            self.wait(endpoint, self.buckets[endpoint].reserve())
+            with self.lock:
+                self.requests[endpoint] += 1
+            try:
+                response = function(*args, **kwargs)
+            except RateLimitError as error:
+                with self.lock:
+                    self.rate_limited[endpoint] += 1
+                if attempt == self.retries:
+                    raise
+                headers = getattr(error.response, 'headers', None)
+                delay = max(get_retry_after(headers) or 0, self.backoff(attempt))
+                print(f'Rate limited by {endpoint}, retrying in {delay:.1f} seconds.')
+                self.buckets[endpoint].block(delay)
+                continue
+            self.update(endpoint, getattr(response, 'headers', None))
+            return response
+
+    def summary(self):
+        return ', '.join(
+            f'{endpoint}: {self.requests[endpoint]} requests, '
+            f'{self.rate_limited[endpoint]} rate limited, '
+            f'{self.throttled_seconds[endpoint]:.1f} seconds throttled'
+            for endpoint in self.buckets
+        )
@@ -1,81 +1,129 @@
 #!/usr/bin/env python
 
-from glob import glob
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import datetime
+import functools
+import heapq
+from itertools import repeat
 import subprocess
 import tempfile
-import time
+import threading
 import os
+from time import sleep, time
 
 import click
-from openai import OpenAI, RateLimitError
 import pyinotify
 
 try:
     from ..common import (
+        Episode,
         get_stripped_name,
-        find_stripped_filename,
-        is_stripped_filename,
-        oldest_first
+        newest_first,
+        read_feed_weights
     )
 except ImportError:
     from file_util import (
+        Episode,
         get_stripped_name,
-        find_stripped_filename,
-        is_stripped_filename,
-        oldest_first
+        newest_first,
+        read_feed_weights
     )
 
 from ffmpeg_util import (
     seconds_to_ffmpeg_format,
-    reduce_audio_file,
-    write_audio_clip,
-    join_segments_mp3,
+    UPLOAD_ENCODINGS,
+    reduce_audio,
+    find_silences,
+    get_split_points,
+    render_copied,
+    render_segments,
+    render_trimmed,
+    resolve_parts,
     get_duration,
     get_image,
-    add_image,
+    run_program,
 )
 from openai_util import (
-    get_transcript,
-    get_commercials,
     combine_commercials,
-    write_sponsor
+    limiter,
+    result_cache,
+    sponsor_cache
 )
 
-from playlist import Playlist
+from backends import BACKENDS, CAPABILITIES, OpenAIBackend, make_backend
+from batch import BatchQueue, Deferred
+from cache import DiskCache, get_file_hash, get_key
+from edl import get_plan, get_plan_parts, read_sidecar, write_sidecar
+from fingerprint import FingerprintIndex, fingerprint_file, get_span, is_available
+from jobs import AGING, PENDING, SKIPPED, JobQueue
+from pipeline import Pipeline, Stage, get_cpu_count
+from prefilter import estimate_tokens, get_candidate_lines
+from watch import Debouncer, is_episode, scan_episodes
+from workspace import Workspace, new_file
+
+try:
+    from ..common import metrics
+except ImportError:
+    from metrics import metrics
 
 MAX_PODCAST_LENGTH = 70*60
 
-with open('version') as version_file:
-    VERSION = version_file.read().strip()
+RENDERERS = {
+    'segments': render_segments,
+    'single-pass': render_trimmed,
+    'copy': render_copied,
+}
+
+WATERMARK = 'checkmark.png'
+
+# Sponsor announcements spoken at once for an episode.
+TTS_WORKERS = 4
+
+# Watermarked cover art by the hash of the original.
+art_cache = DiskCache(name='art')
+
+# Commercials we have found before, recognized by their audio.
+fingerprint_index = FingerprintIndex()
+
+# Written into the image by the build.
+VERSION_FILE = 'version'
+
 
+# The version stripped episodes are named after. Read when first needed, so
+# the stripper can be imported without a version file.
+@functools.cache
+def get_version():
+    with open(VERSION_FILE) as version_file:
+        return version_file.read().strip()
 
-def get_watermarked(image_file):
+
+def get_watermarked(image_file, workspace=None):
     if image_file is None:
         return None
 
-    with tempfile.NamedTemporaryFile(delete=False, suffix=".jpg") as watermarked:
-        command = [
-            'convert',
-            image_file,
-            '(',
-            'checkmark.png',
-            '-resize',
-            '30%x30%',
-            ')',
-            '-gravity',
-            'northeast',
-            '-geometry',
-            '+5%+5%',
-            '-composite',
-            watermarked.name
-        ]
-        try:
-            subprocess.run(command, check=True)
-        except subprocess.CalledProcessError as error:
-            print(f'Failed to watermark {image_file}: {error}')
-            return image_file
+    watermarked = new_file(workspace, '.jpg', os.path.getsize(image_file))
+    command = [
+        'convert',
+        image_file,
+        '(',
+        WATERMARK,
+        '-resize',
+        '30%x30%',
+        ')',
+        '-gravity',
+        'northeast',
+        '-geometry',
+        '+5%+5%',
+        '-composite',
+        watermarked
+    ]
+    try:
+        run_program(command, check=True)
+    except subprocess.CalledProcessError as error:
+        print(f'Failed to watermark {image_file}: {error}')
+        return image_file
 
-        return watermarked.name
+    return watermarked
 
 
 def dump_commercial(commercial):
@@ -122,14 +170,18 @@ def print_transcript_at_commercial(transcript, commercial):
     print('---')
 
 
-def write_trimmed(client, audio_file, transcript, commercial_data, output_file):
-    playlist = Playlist()
-    image_file = get_watermarked(get_image(audio_file))
+# Yields the parts of the stripped episode as the commercials arrive.
+# With speakers, an executor, the announcements are spoken while the rest of
+# the episode is cut, and come as futures. Each sponsor is spoken once.
+def get_parts(backend, transcript, commercial_data, workspace=None, speakers=None):
+    spoken = {}
     prev_commercial_end = 0
     for commercial in commercial_data:
         try:
-            commercial_start = transcript.segments[commercial['start_line']].start
-            commercial_end = transcript.segments[commercial['end_line']].end
+            commercial_start = commercial.get(
+                'start', transcript.segments[commercial['start_line']].start)
+            commercial_end = commercial.get(
+                'end', transcript.segments[commercial['end_line']].end)
         except IndexError:
             print('Oh snap, IndexError. Let''s sneak up on it.')
             dump_commercial(commercial)
@@ -148,123 +200,825 @@ def write_trimmed(client, audio_file, transcript, commercial_data, output_file):
               + f"to {seconds_to_ffmpeg_format(commercial_end)}.")
 
         if commercial_start > prev_commercial_end:
-            write_audio_clip(
-                audio_file,
-                playlist.new_file('.wav'),
-                prev_commercial_end,
-                commercial_start
-            )
-        write_sponsor(client, commercial['sponsor'], playlist.new_file('.wav'))
+            yield (prev_commercial_end, commercial_start)
+        sponsor = commercial['sponsor']
+        if speakers is None:
+            yield backend.speak(sponsor, new_file(workspace, '.wav'))
+        else:
+            if sponsor not in spoken:
+                spoken[sponsor] = speakers.submit(backend.speak, sponsor,
+                                                  new_file(workspace, '.wav'))
+            yield spoken[sponsor]
         prev_commercial_end = commercial_end
 
-    write_audio_clip(
-        audio_file,
-        playlist.new_file('.wav'),
-        prev_commercial_end
-    )
-    join_segments_mp3(playlist.get_files(), output_file)
-    add_image(output_file, image_file)
+    yield (prev_commercial_end, None)
+
+
+# Every episode of a feed usually has the same cover art, so we only
+# watermark each image once.
+def get_cover_art(audio_file, workspace=None):
+    image_file = get_image(audio_file, workspace)
+    if image_file is None:
+        return None
+    key = get_key('watermarked', get_file_hash(image_file), get_file_hash(WATERMARK))
+    cached = art_cache.get(key, '.jpg')
+    if cached:
+        os.remove(image_file)
+        return cached
+    watermarked = get_watermarked(image_file, workspace)
+    if watermarked == image_file:
+        return image_file
+    os.remove(image_file)
+    cached = art_cache.put(key, watermarked, '.jpg')
+    if cached != watermarked:
+        os.remove(watermarked)
+    return cached
+
+
+def render_episode(audio_file, parts, output_file, render='segments', workspace=None):
+    image_file = get_cover_art(audio_file, workspace)
+    RENDERERS[render](audio_file, parts, output_file, image_file, workspace)
 
     print(f'Reduced by {get_duration(audio_file) - get_duration(output_file)} seconds.')
-    time.sleep(30)
 
 
-def strip(client, path, output):
-    print(f'Starting {os.path.basename(path)} -> {os.path.basename(output)}')
+# Passes items on, keeping a copy of each in kept.
+def record(items, kept):
+    for item in items:
+        kept.append(item)
+        yield item
+
+
+# Returns the commercials and parts, for the sidecar.
+def write_trimmed(backend, audio_file, transcript, commercial_data, output_file,
+                  render='segments', workspace=None):
+    commercials = []
+    parts = []
+    with ThreadPoolExecutor(TTS_WORKERS) as speakers:
+        render_episode(
+            audio_file,
+            record(get_parts(backend, transcript, record(commercial_data, commercials),
+                             workspace, speakers),
+                   parts),
+            output_file,
+            render,
+            workspace
+        )
+    return commercials, resolve_parts(parts)
+
+
+# How to strip an episode. Every job carries these.
+DEFAULT_SETTINGS = {
+    'render': 'segments',
+    'chunk_length': 0,
+    'encoding': 'opus',
+    'bitrate': '24k',
+    'prefilter_threshold': 0,
+    'prefilter_margin': 10,
+    'detect_encoding': 'packed',
+    'detect_window': 0,
+    'fingerprint': False,
+    'batch': False,
+}
+
+
+def get_job(path, output, **settings):
+    return {'path': path, 'output': output, **DEFAULT_SETTINGS, **settings}
+
+
+# The stages of stripping an episode. Each takes and returns a job dict from
+# get_job. reduce_stage and render_stage only use ffmpeg and run in a process
+# pool. analyze_stage only talks to the backend.
+def reduce_stage(job):
+    path = job['path']
+    print(f'Starting {os.path.basename(path)} -> {os.path.basename(job["output"])}')
+    if 'transcript' in job:
+        # Picking up where we left off, so we only need fingerprints.
+        if job['fingerprint'] and 'commercials' not in job:
+            job = {**job, 'landmarks': fingerprint_file(path)}
+        return job
     original_duration = get_duration(path)
-    if original_duration > MAX_PODCAST_LENGTH:
+    if not job['chunk_length'] and original_duration > MAX_PODCAST_LENGTH:
         print(f'Skipping. {os.path.basename(path)} is {original_duration} seconds'
               f', which exceeds our limit of {MAX_PODCAST_LENGTH} seconds.')
+        return None
+    points = []
+    if job['chunk_length'] and original_duration > job['chunk_length']:
+        points = get_split_points(find_silences(path), original_duration, job['chunk_length'])
+    offsets = [0] + points
+    chunks = [
+        (start, reduce_audio(path, job['encoding'], job['bitrate'], start, end))
+        for start, end in zip(offsets, points + [None])
+    ]
+    if job['fingerprint']:
+        job = {**job, 'landmarks': fingerprint_file(path)}
+    return {**job, 'chunks': chunks}
+
+
+def transcribe(backend, job):
+    _, extension = UPLOAD_ENCODINGS[job['encoding']]
+    transcript = backend.transcribe(job['chunks'], extension)
+    print(f'Audio to transcribe: {sum(len(audio) for _, audio in job["chunks"])} bytes')
+    return transcript
+
+
+# Commercials from the fingerprint index, with the transcript lines they cover
+# and their exact start and end.
+def get_known_commercials(segments, landmarks):
+    known = []
+    for match in fingerprint_index.match(*landmarks):
+        lines = [
+            line for line, segment in enumerate(segments)
+            if match['start'] <= (segment.start + segment.end) / 2 <= match['end']
+        ]
+        if lines:
+            known.append({
+                'sponsor': match['sponsor'],
+                'start_line': lines[0],
+                'end_line': lines[-1],
+                'start': match['start'],
+                'end': match['end'],
+                'known': True,
+            })
+    return known
+
+
+# Shortest and longest commercial worth remembering, in seconds. Anything
+# else is more likely a mistake than a commercial we will hear again.
+LEARN_SECONDS = (10, 120)
+
+
+# Remember the audio of a commercial the model found, so we recognize it in
+# later episodes without asking.
+def learn_commercial(transcript, job, commercial):
+    if commercial.get('known'):
         return
+    start = transcript.segments[commercial['start_line']].start
+    end = transcript.segments[commercial['end_line']].end
+    if not LEARN_SECONDS[0] <= end - start <= LEARN_SECONDS[1]:
+        return
+    hashes, times = get_span(*job['landmarks'], start, end)
+    if len(hashes):
+        fingerprint_index.add(commercial['sponsor'], hashes, times, end - start)
+
+
+# Commercials are counted and learned one sponsor at a time as they are
+# found, before commercials next to each other are combined into "A and B".
+def take_found(transcript, job, commercials):
+    for commercial in commercials:
+        sponsor_cache.record(commercial['sponsor'])
+        if job.get('landmarks') is not None:
+            learn_commercial(transcript, job, commercial)
+        yield commercial
+
+
+# Yields commercials as the model finds them. Jobs with batch set ask
+# batch_queue, if any, which raises Deferred until a batch has answered.
+def detect_commercials(backend, transcript, job, batch_queue=None):
+    known = []
+    if job.get('landmarks') is not None:
+        known = get_known_commercials(transcript.segments, job['landmarks'])
+        print(f'Recognized {len(known)} commercials from earlier episodes')
+
+    lines = None
+    if job['prefilter_threshold']:
+        lines = get_candidate_lines(
+            transcript.segments,
+            job['prefilter_threshold'],
+            job['prefilter_margin'],
+            sponsor_cache.top_sponsors(200)
+        )
+        total = estimate_tokens(transcript.segments)
+        print(f'Asking about {len(lines)} of {len(transcript.segments)} lines, '
+              f'about {total - estimate_tokens(transcript.segments, lines)} of {total} '
+              'transcript tokens saved')
+    if known:
+        covered = {
+            line for commercial in known
+            for line in range(commercial['start_line'], commercial['end_line'] + 1)
+        }
+        if lines is None:
+            lines = range(len(transcript.segments))
+        lines = [line for line in lines if line not in covered]
+    found = None
+    if job['batch'] and batch_queue:
+        found = batch_queue.detect(transcript, lines, job['detect_encoding'],
+                                   job['detect_window'])
+    if found is None:
+        found = backend.detect(transcript, lines, job['detect_encoding'], job['detect_window'])
+    commercials = combine_commercials(heapq.merge(
+        known,
+        take_found(transcript, job, found),
+        key=lambda commercial: commercial['start_line']
+    ))
+    for commercial in commercials:
+        print_transcript_at_commercial(transcript, commercial)
+        yield commercial
+
+
+# Gauges of things we only know here: the caches, OpenAI requests and the
+# queue.
+def update_gauges(job_queue=None, batch_queue=None):
+    for cache in (sponsor_cache, result_cache, art_cache):
+        metrics.set('cache_bytes', cache.size, cache=cache.name)
+    for endpoint in limiter.buckets:
+        metrics.set('openai_requests', limiter.requests[endpoint], endpoint=endpoint)
+        metrics.set('openai_rate_limited', limiter.rate_limited[endpoint], endpoint=endpoint)
+        metrics.set('openai_throttled_seconds', limiter.throttled_seconds[endpoint],
+                    endpoint=endpoint)
+    metrics.set('fingerprints', len(fingerprint_index))
+    if batch_queue:
+        metrics.set('batch_requests', batch_queue.pending())
+    if job_queue:
+        for state, count, age in job_queue.status():
+            metrics.set('jobs', count, state=state)
+            metrics.set('oldest_job_seconds', age, state=state)
+
+
+# Keep the metrics file, if any, up to date.
+def export_metrics(metrics_file, interval, job_queue=None, batch_queue=None):
+    while True:
+        update_gauges(job_queue, batch_queue)
+        if metrics_file:
+            metrics.write_textfile(metrics_file)
+        sleep(interval)
+
+
+def print_usage():
+    print(f'OpenAI usage so far: {limiter.summary()}')
+    print(f'Sponsor cache: {sponsor_cache.summary()}')
+    print(f'Result cache: {result_cache.summary()}')
+    print(f'Art cache: {art_cache.summary()}')
+    if len(fingerprint_index):
+        print(f'Fingerprint index: {len(fingerprint_index)} commercials')
+
+
+# Records each step in job_queue, if any, so a restart doesn't repeat it.
+# A job waiting for a batch is put aside until batch_queue has its answers.
+def analyze_stage(backend, job, job_queue=None, batch_queue=None):
+    transcript = job.get('transcript')
+    if transcript is None:
+        transcript = transcribe(backend, job)
+        if job_queue:
+            job_queue.advance(job['id'], 'transcribed', transcript=transcript)
+    commercials = job.get('commercials')
+    if commercials is None:
+        try:
+            commercials = list(detect_commercials(backend, transcript, job, batch_queue))
+        except Deferred as deferred:
+            job_queue.release(job['id'], 'batched')
+            batch_queue.wait(job['id'], deferred.keys)
+            print(f'Waiting for a batch to find the commercials in '
+                  f'{os.path.basename(job["path"])}')
+            return None
+        if job_queue:
+            job_queue.advance(job['id'], 'detected', commercials=commercials)
+    # The render stage runs in another process, so it gets files, not futures.
+    with ThreadPoolExecutor(TTS_WORKERS) as speakers:
+        parts = resolve_parts(get_parts(backend, transcript, commercials, job.get('workspace'),
+                                        speakers))
+    print_usage()
+    return {**job, 'commercials': commercials, 'parts': parts}
+
+
+def render_stage(job):
+    render_episode(job['path'], job['parts'], job['output'], job['render'],
+                   job.get('workspace'))
+    write_sidecar(job['path'],
+                  get_plan(job['path'], job['commercials'], job['parts'], get_version()))
+    return job
+
+
+SCRATCH_BUCKETS = tuple(megabytes * 1_000_000 for megabytes in (1, 10, 50, 100, 250, 500, 1000))
+# From queued to stripped, up to a day and a half for a batch.
+TIME_TO_STRIPPED_BUCKETS = tuple(minutes * 60 for minutes in
+                                 (1, 5, 10, 30, 60, 180, 360, 720, 1440, 2160))
+
+# Where each job keeps its intermediate files. See Workspace.
+scratch = {'directory': None, 'ram_directory': None, 'ram_budget': 0}
+
+
+def release_workspace(job):
+    if job.get('workspace') is None:
+        return
+    peak = job['workspace'].cleanup()
+    print(f'Scratch space for {os.path.basename(job["path"])}: peak {peak / 1e6:.1f} MB')
+    metrics.observe('scratch_bytes', peak, buckets=SCRATCH_BUCKETS)
+
+
+def strip(backend, path, output, **settings):
+    with Workspace(**scratch) as workspace:
+        with metrics.timer('stage_seconds', stage='reduce'):
+            job = reduce_stage(get_job(path, output, workspace=workspace, **settings))
+        if job is None:
+            return
+        with metrics.timer('stage_seconds', stage='transcribe'):
+            transcript = transcribe(backend, job)
+        # Rendering starts with the first commercial, while the model is still
+        # looking for the rest.
+        with metrics.timer('stage_seconds', stage='render'):
+            commercials, parts = write_trimmed(
+                backend, path, transcript, detect_commercials(backend, transcript, job),
+                output, job['render'], workspace)
+        write_sidecar(path, get_plan(path, commercials, parts, get_version()))
+    print(f'Scratch space: peak {workspace.peak / 1e6:.1f} MB')
+    print_usage()
+
+
+# Hands jobs from the queue to the pipeline as it has room for them, so a
+# fresh episode only waits for the jobs already started.
+def feed(pipeline, job_queue):
+    while True:
+        pipeline.wait_for_room()
+        job = job_queue.take()
+        print(f'Taking {os.path.basename(job["path"])} ({job["state"]}) from the queue')
+        pipeline.submit(**get_job(**job, workspace=Workspace(**scratch)))
+
+
+def make_pipeline(backend, jobs, api_concurrency, job_queue, batch_queue=None,
+                  batch_interval=300):
+    def skipped(job, result):
+        if result is None:
+            release_workspace(job)
+            job_queue.fail(job['id'], SKIPPED, retry=False)
+
+    def deferred(job, result):
+        if result is None:
+            release_workspace(job)
+
+    def failed(job, error):
+        release_workspace(job)
+        job_queue.fail(job['id'], repr(error))
+
+    def rendered(job, result):
+        release_workspace(result)
+        fresh, seconds = job_queue.finish(job['id'])
+        priority = 'fresh' if fresh else 'backlog'
+        metrics.observe('time_to_stripped_seconds', seconds, buckets=TIME_TO_STRIPPED_BUCKETS,
+                        priority=priority)
+        metrics.log('stripped', path=job['path'], priority=priority, seconds=round(seconds, 3))
+
+    processes = ProcessPoolExecutor(jobs)
+    pipeline = Pipeline([
+        Stage('reduce', reduce_stage, jobs, processes, on_result=skipped, on_error=failed),
+        Stage('analyze', lambda job: analyze_stage(backend, job, job_queue, batch_queue),
+              api_concurrency, on_result=deferred, on_error=failed),
+        Stage('render', render_stage, jobs, processes, on_result=rendered, on_error=failed),
+    ])
+    threading.Thread(target=feed, args=(pipeline, job_queue), name='feed', daemon=True).start()
+    if batch_queue:
+        # Answered jobs go back to the queue to be detected and rendered.
+        threading.Thread(
+            target=batch_queue.run,
+            args=(lambda job_id: job_queue.advance(job_id, 'transcribed'), batch_interval),
+            name='batch',
+            daemon=True
+        ).start()
+    return pipeline
+
+
+# Hashes of episodes by path, size and modification time, so scanning only
+# reads episodes that changed.
+episode_hashes = {}
+
+
+def get_episode_hash(path):
+    stat = os.stat(path)
+    key = (path, stat.st_size, stat.st_mtime_ns)
+    if key not in episode_hashes:
+        episode_hashes[key] = get_file_hash(path)
+    return episode_hashes[key]
+
+
+def enqueue(job_queue, path, output, fresh=False, weight=1, **settings):
+    if job_queue.add(path, output, settings, get_episode_hash(path), fresh, weight) is None:
+        print(f'Already queued {os.path.basename(path)}')
+    else:
+        print(f'Queued {os.path.basename(path)}{" (fresh)" if fresh else ""}')
+
+
+def enqueue_episode(job_queue, path, fresh=False, weight=1, **settings):
     try:
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".mp3") as fp:
-            reduce_audio_file(path, fp.name)
-            transcript = get_transcript(client, fp.name)
-            fp.close()
-        commercials = combine_commercials(get_commercials(client, transcript))
-        for commercial in commercials:
-            print_transcript_at_commercial(transcript, commercial)
-        write_trimmed(client, path, transcript, commercials, output)
-    except RateLimitError as error:
-        raise error
-
-
-def strip_all(client, scan_directory):
-    print(f'Stripping everything under {scan_directory}/*')
-    for relative_path in oldest_first(glob(os.path.join(scan_directory, '*', '*.mp3'))):
-        path = os.path.join(scan_directory, relative_path)
-        directory = os.path.dirname(path)
-        filename = os.path.basename(path)
-
-        if is_stripped_filename(filename):
-            print(f'ignoring {filename}')
-            continue
+        enqueue(
+            job_queue,
+            path,
+            os.path.join(
+                os.path.dirname(path),
+                get_stripped_name(get_version(), os.path.basename(path))
+            ),
+            fresh,
+            weight,
+            **settings
+        )
+    except (ValueError, FileNotFoundError) as e:
+        print(f'Failed to strip {os.path.basename(path)}: {e}')
+
+
+# The weight the manager gave the feed of the episode at path.
+def get_weight(weights, path):
+    return weights.get(os.path.basename(os.path.dirname(path)), 1)
+
+
+# Downloaded within the last fresh_seconds.
+def is_fresh(path, fresh_seconds):
+    try:
+        return time() - os.path.getmtime(path) < fresh_seconds
+    except OSError:
+        return False
+
 
+# Queue every complete episode under scan_directory that is not stripped or
+# queued yet, in case we missed its event, newest first. That includes
+# episodes that failed, or changed, since they were queued. Episodes downloaded
+# in the last fresh_seconds, while we weren't looking, are as fresh as the
+# ones we are told about and don't wait for a batch.
+def strip_all(job_queue, scan_directory, min_age=0, directories=None, fresh_seconds=0,
+              **settings):
+    weights = read_feed_weights(scan_directory)
+    for path in newest_first(list(scan_episodes(scan_directory, min_age, directories))):
         try:
-            if find_stripped_filename(filename, os.listdir(directory)):
-                print(f'Skipping already stripped file {filename}')
+            if job_queue.has_job(path, get_episode_hash(path)):
                 continue
-        except ValueError as e:
-            print(e)
+        except FileNotFoundError:
+            continue
+        if is_fresh(path, fresh_seconds):
+            enqueue_episode(job_queue, path, True, get_weight(weights, path),
+                            **{**settings, 'batch': False})
+        else:
+            enqueue_episode(job_queue, path, False, get_weight(weights, path), **settings)
+
 
+def reconcile(job_queue, scan_directory, interval, min_age, fresh_seconds=0, **settings):
+    directories = {}
+    while True:
+        sleep(interval)
         try:
-            strip(
-                client,
-                path,
-                os.path.join(
-                    directory,
-                    get_stripped_name(VERSION, filename)
-                )
-            )
-        except ValueError as e:
-            print(f'Failed to strip {filename}: {e}')
+            strip_all(job_queue, scan_directory, min_age, directories, fresh_seconds, **settings)
+        except OSError as error:
+            print(f'Failed to scan {scan_directory}: {error}')
 
 
+# Episodes are queued once they are complete: when the file is closed after
+# writing, or moved into place from a .part download. Bursts of events for a
+# file are debounced into one.
 class EventHandler(pyinotify.ProcessEvent):
-    def __init__(self, client):
+    def __init__(self, debouncer):
         super().__init__()
-        self.client = client
+        self.debouncer = debouncer
 
-    def process_IN_CREATE(self, event):
-        print("Notified of create:", event.pathname)
-        if event.pathname.endswith('-stripped.mp3'):
-            print(f'ignoring {event.pathname}')
+    def touch(self, event):
+        if event.dir or not is_episode(os.path.basename(event.pathname)):
             return
-        try:
-            strip(
-                self.client,
-                event.pathname,
-                os.path.join(
-                    os.path.dirname(event.pathname),
-                    get_stripped_name(VERSION, os.path.basename(event.pathname))
-                )
-            )
-        except ValueError as e:
-            print(e)
+        print(f'Notified of {event.maskname}: {event.pathname}')
+        self.debouncer.touch(event.pathname)
+
+    def process_IN_CLOSE_WRITE(self, event):
+        self.touch(event)
 
+    def process_IN_MOVED_TO(self, event):
+        self.touch(event)
 
-@click.command()
+
+# "stripper.py PATH [OPTIONS]" still strips PATH. Anything that is not the
+# name of another command goes to "strip".
+class StripperCommands(click.Group):
+    def parse_args(self, ctx, args):
+        if not args or (args[0] not in self.commands and args[0] != '--help'):
+            args = ['strip'] + list(args)
+        return super().parse_args(ctx, args)
+
+
+cache_dir_option = click.option(
+    '--cache-dir', envvar='CACHE_DIR', default=os.path.expanduser('~/.cache/short-spot'),
+    show_default=True, help='Where to keep results that can be reused, and the job queue')
+
+
+def get_job_queue(cache_dir, max_attempts=3, aging=AGING):
+    os.makedirs(cache_dir, exist_ok=True)
+    return JobQueue(os.path.join(cache_dir, 'jobs.sqlite3'), max_attempts, aging=aging)
+
+
+def backend_options(command):
+    options = [
+        click.option('--backend', envvar='BACKEND', type=click.Choice(list(BACKENDS)),
+                     default='openai', show_default=True,
+                     help='Where transcripts, commercials and sponsor announcements come from. '
+                          'local only transcribes, fake makes them up.'),
+        click.option('--transcribe-backend', envvar='TRANSCRIBE_BACKEND',
+                     type=click.Choice(list(BACKENDS)), help='Transcribe with this instead'),
+        click.option('--detect-backend', envvar='DETECT_BACKEND',
+                     type=click.Choice(list(BACKENDS)), help='Find commercials with this instead'),
+        click.option('--speak-backend', envvar='SPEAK_BACKEND',
+                     type=click.Choice(list(BACKENDS)),
+                     help='Announce sponsors with this instead'),
+        click.option('--model-path', envvar='MODEL_PATH',
+                     help='Directory of a faster-whisper model, for the local backend'),
+        click.option('--batch-size', envvar='BATCH_SIZE', default=8, show_default=True,
+                     help='30 second windows of audio, from any episodes, the local backend '
+                          'transcribes at once'),
+        click.option('--open-ai-key', envvar='OPEN_AI_KEY', help='OpenAI API key'),
+        click.option('--rate-limit', multiple=True, metavar='ENDPOINT=RPM',
+                     help='Requests per minute for transcriptions, chat or speech'),
+        cache_dir_option,
+        click.option('--tts-cache-size', default=500, show_default=True,
+                     help='Megabytes of sponsor announcements to keep'),
+        click.option('--result-cache-size', default=200, show_default=True,
+                     help='Megabytes of transcripts and detected commercials to keep'),
+    ]
+    for option in reversed(options):
+        command = option(command)
+    return command
+
+
+# What rendering needs, which is all a rerender needs.
+def configure_render_caches(cache_dir):
+    art_cache.configure(os.path.join(cache_dir, 'art'), 50_000_000)
+
+
+def get_backend(backend, transcribe_backend, detect_backend, speak_backend, model_path,
+                batch_size, open_ai_key, rate_limit, cache_dir, tts_cache_size,
+                result_cache_size):
+    for setting in rate_limit:
+        endpoint, per_minute = setting.split('=')
+        if endpoint not in limiter.buckets:
+            raise click.BadParameter(f'Unknown endpoint {endpoint}', param_hint='--rate-limit')
+        limiter.configure(endpoint, int(per_minute))
+    sponsor_cache.configure(os.path.join(cache_dir, 'tts'), tts_cache_size * 1_000_000)
+    result_cache.configure(os.path.join(cache_dir, 'results'), result_cache_size * 1_000_000)
+    configure_render_caches(cache_dir)
+    chosen = {'transcribe': transcribe_backend, 'detect': detect_backend,
+              'speak': speak_backend}
+    names = {capability: chosen[capability] or backend for capability in CAPABILITIES}
+    try:
+        return make_backend(names, open_ai_key, model_path, batch_size)
+    except ValueError as error:
+        raise click.BadParameter(str(error), param_hint='--backend')
+
+
+@click.group(cls=StripperCommands)
+def main():
+    pass
+
+
+@main.command('strip')
 @click.argument('path')
-@click.option('--open-ai-key', envvar='OPEN_AI_KEY', help='OpenAI API key')
 @click.option('--output', help='Audio file with result')
 @click.option('--monitor', is_flag=True, help='Monitor the given path')
-def main(path, open_ai_key, output, monitor):
-    client = OpenAI(api_key=open_ai_key)
+@click.option('--render', type=click.Choice(list(RENDERERS)), default='segments',
+              help='segments: one ffmpeg per clip, then join. '
+                   'single-pass: one ffmpeg for the whole episode. '
+                   'copy: copy the episode\'s MP3 frames, only encoding the gaps.')
+@click.option('--jobs', default=get_cpu_count(), show_default=True,
+              help='Episodes to reduce and render at the same time')
+@click.option('--api-concurrency', default=4, show_default=True,
+              help='Episodes to transcribe and analyze at the same time')
+@click.option('--chunk-minutes', envvar='CHUNK_MINUTES', default=0, show_default=True,
+              help='Transcribe longer episodes in chunks of this many minutes at once. '
+                   f'0 skips episodes over {MAX_PODCAST_LENGTH // 60} minutes.')
+@click.option('--upload-encoding', type=click.Choice(list(UPLOAD_ENCODINGS)),
+              default='opus', show_default=True, help='How to encode audio for Whisper')
+@click.option('--upload-bitrate', default='24k', show_default=True,
+              help='Bitrate of audio for Whisper')
+@click.option('--prefilter-threshold', envvar='PREFILTER_THRESHOLD', default=0,
+              show_default=True,
+              help='Only ask about lines near ones with at least this ad score. 0 asks about '
+                   'every line, 1 also asks about every pre-roll and post-roll line.')
+@click.option('--prefilter-margin', default=10, show_default=True,
+              help='Lines of context to ask about around each likely ad line')
+@click.option('--detect-encoding', type=click.Choice(['packed', 'messages']),
+              default='packed', show_default=True,
+              help='packed: the transcript as one message of numbered lines. '
+                   'messages: one message per line with timestamps.')
+@click.option('--detect-window', envvar='DETECT_WINDOW', default=0, show_default=True,
+              help='Ask about this many lines at a time, all at once. 0 asks about all of them.')
+@click.option('--fingerprint/--no-fingerprint', envvar='FINGERPRINT', default=False,
+              show_default=True,
+              help='Recognize commercials found in earlier episodes by their audio. '
+                   'Needs numpy.')
+@click.option('--max-attempts', default=3, show_default=True,
+              help='Times to try an episode with --monitor before giving up on it')
+@click.option('--debounce', default=2.0, show_default=True,
+              help='With --monitor, seconds a new file must be left alone before stripping it')
+@click.option('--scan-interval', envvar='SCAN_INTERVAL', default=600, show_default=True,
+              help='With --monitor, seconds between scans for episodes we missed')
+@click.option('--scratch-dir', envvar='SCRATCH_DIR', default=tempfile.gettempdir(),
+              show_default=True, help='Where to keep intermediate files')
+@click.option('--ram-dir', envvar='RAM_DIR',
+              help='A RAM-backed directory such as /dev/shm for intermediate files')
+@click.option('--ram-budget', envvar='RAM_BUDGET', default=256, show_default=True,
+              help='Megabytes of intermediate files to keep in --ram-dir per episode')
+@click.option('--fresh-hours', envvar='FRESH_HOURS', default=24, show_default=True,
+              help='With --monitor, episodes downloaded this recently count as new when '
+                   'found by scanning')
+@click.option('--aging-hours', envvar='AGING_HOURS', default=AGING / 3600, show_default=True,
+              help='With --monitor, hours for a backlog episode to gain one point of '
+                   'priority while it waits. Episodes start with their feed\'s weight, 1 '
+                   'unless the manager says otherwise.')
+@click.option('--batch-backlog/--no-batch-backlog', envvar='BATCH_BACKLOG', default=False,
+              show_default=True,
+              help='With --monitor, find the commercials in episodes found by scanning, '
+                   'rather than as they arrive, through OpenAI\'s Batch API. Half the price, '
+                   'but it can take a day.')
+@click.option('--batch-interval', envvar='BATCH_INTERVAL', default=300, show_default=True,
+              help='Seconds between sending waiting requests as a batch and checking on '
+                   'batches')
+@click.option('--metrics-file', envvar='METRICS_FILE',
+              help='Write Prometheus metrics here, for node_exporter\'s textfile collector')
+@click.option('--metrics-port', envvar='METRICS_PORT', type=int,
+              help='Serve Prometheus metrics at /metrics on this port')
+@click.option('--json-logs/--no-json-logs', envvar='JSON_LOGS', default=False,
+              help='Also log timings as JSON lines')
+@backend_options
+def strip_command(path, output, monitor, render, jobs, api_concurrency, chunk_minutes,
+                  upload_encoding, upload_bitrate, prefilter_threshold, prefilter_margin,
+                  detect_encoding, detect_window, fingerprint, max_attempts, debounce,
+                  scan_interval, scratch_dir, ram_dir, ram_budget, fresh_hours,
+                  aging_hours, batch_backlog, batch_interval, metrics_file, metrics_port,
+                  json_logs, **backend_settings):
+    """Strip commercials from PATH, or from everything under it with --monitor."""
+    # Fail now rather than for every episode.
+    get_version()
+    if fingerprint and not is_available():
+        raise click.BadParameter('needs numpy', param_hint='--fingerprint')
+    backend = get_backend(**backend_settings)
+    if batch_backlog and not isinstance(backend.detector, OpenAIBackend):
+        raise click.BadParameter('needs the openai detect backend', param_hint='--batch-backlog')
+    if fingerprint:
+        fingerprint_index.configure(os.path.join(backend_settings['cache_dir'], 'fingerprints'))
+    metrics.configure('stripper', json_logs)
+    if metrics_port:
+        metrics.serve(metrics_port)
+    os.makedirs(scratch_dir, exist_ok=True)
+    scratch.update(directory=scratch_dir, ram_directory=ram_dir,
+                   ram_budget=ram_budget * 1_000_000)
+    settings = {
+        'render': render,
+        'chunk_length': chunk_minutes * 60,
+        'encoding': upload_encoding,
+        'bitrate': upload_bitrate,
+        'prefilter_threshold': prefilter_threshold,
+        'prefilter_margin': prefilter_margin,
+        'detect_encoding': detect_encoding,
+        'detect_window': detect_window,
+        'fingerprint': fingerprint,
+    }
 
     if monitor:
-        strip_all(client, path)
+        job_queue = get_job_queue(backend_settings['cache_dir'], max_attempts,
+                                  aging_hours * 3600)
+        batch_queue = None
+        if batch_backlog:
+            batch_queue = BatchQueue(
+                backend.detector.client,
+                os.path.join(backend_settings['cache_dir'], 'batches.sqlite3')
+            )
+        else:
+            # Nothing will answer episodes left waiting for a batch, so ask directly.
+            job_queue.move('batched', 'transcribed')
+        retried = job_queue.retry_failed()
+        if retried:
+            print(f'Retrying {retried} episodes that failed before')
+        make_pipeline(backend, jobs, api_concurrency, job_queue, batch_queue, batch_interval)
+        if metrics_file or metrics_port:
+            threading.Thread(target=export_metrics,
+                             args=(metrics_file, 15, job_queue, batch_queue),
+                             name='metrics', daemon=True).start()
+        # Episodes we find by scanning are a backlog that can wait for a
+        # batch, and for spare capacity. New ones are stripped as they arrive,
+        # ahead of it.
+        backlog_settings = {**settings, 'batch': batch_backlog}
+        print(f'Stripping everything under {path}/*')
+        strip_all(job_queue, path, debounce, None, fresh_hours * 3600, **backlog_settings)
+        threading.Thread(target=reconcile,
+                         args=(job_queue, path, scan_interval, debounce, fresh_hours * 3600),
+                         kwargs=backlog_settings, name='reconcile', daemon=True).start()
         print(f'Monitoring {path}')
+
+        def enqueue_fresh(episode):
+            weight = get_weight(read_feed_weights(path), episode)
+            enqueue_episode(job_queue, episode, True, weight, **settings)
+
+        debouncer = Debouncer(enqueue_fresh, debounce)
+        debouncer.start()
         manager = pyinotify.WatchManager()  # Watch Manager
-        handler = EventHandler(client)
+        handler = EventHandler(debouncer)
         notifier = pyinotify.Notifier(manager, handler)
         _ = manager.add_watch(
             path,
-            pyinotify.IN_CREATE,
-            rec=True)
+            pyinotify.IN_CLOSE_WRITE | pyinotify.IN_MOVED_TO,
+            rec=True,
+            auto_add=True)
 
         notifier.loop()
     else:
-        strip(client, path, output)
+        strip(backend, path, output, **settings)
+        update_gauges()
+        if metrics_file:
+            metrics.write_textfile(metrics_file)
+
+
+# Render an episode again from its sidecar, as this version would, and
+# remove the stripped versions of it it replaces, the filenames in stripped.
+# Returns the new file, or None if the episode was skipped.
+def rerender_episode(sidecar, stripped, render='segments', force=False):
+    directory = os.path.dirname(sidecar)
+    try:
+        plan = read_sidecar(sidecar)
+        path = os.path.join(directory, plan['source'])
+        output = os.path.join(directory, get_stripped_name(get_version(), plan['source']))
+        if os.path.exists(output) and not force:
+            return None
+        if get_file_hash(path) != plan['source_hash']:
+            print(f'Skipping {plan["source"]}, which changed since it was stripped')
+            return None
+        with Workspace(**scratch) as workspace:
+            render_episode(path, get_plan_parts(plan, directory), output, render, workspace)
+        write_sidecar(path, {**plan, 'version': get_version()})
+    except (OSError, ValueError) as error:
+        print(f'Failed to rerender {os.path.basename(sidecar)}: {error}')
+        return None
+    for filename in stripped:
+        if filename != os.path.basename(output):
+            print(f'Replacing {filename}')
+            os.remove(os.path.join(directory, filename))
+    return output
+
+
+@main.command('status')
+@cache_dir_option
+def status(cache_dir):
+    """Show how many episodes are in each stage, and for how long."""
+    job_queue = get_job_queue(cache_dir)
+    backlog = 0
+    for state, count, age in job_queue.status():
+        oldest = f', oldest {datetime.timedelta(seconds=int(age))}' if count else ''
+        print(f'{state}: {count}{oldest}')
+        if state in PENDING or state == 'batched':
+            backlog += count
+    print(f'Backlog: {backlog}')
+    failures = job_queue.failures()
+    if failures:
+        print('Recent failures:')
+        for failure in failures:
+            print(f'  {failure["path"]} after {failure["attempts"]} attempts: '
+                  f'{failure["error"]}')
+
+
+@main.command('retry-failed')
+@click.option('--skipped', is_flag=True,
+              help='Also retry episodes that were skipped, such as those that were too long')
+@cache_dir_option
+def retry_failed(skipped, cache_dir):
+    """Put episodes that failed back in the queue, from the last stage they finished."""
+    count = get_job_queue(cache_dir).retry_failed(skipped)
+    print(f'Retrying {count} episodes')
+
+
+@main.command('rerender')
+@click.argument('path')
+@click.option('--render', type=click.Choice(list(RENDERERS)), default='segments',
+              show_default=True, help='How to render, as with strip')
+@click.option('--jobs', default=get_cpu_count(), show_default=True,
+              help='Episodes to render at the same time')
+@click.option('--force', is_flag=True,
+              help='Also render episodes already stripped by this version')
+@click.option('--scratch-dir', envvar='SCRATCH_DIR', default=tempfile.gettempdir(),
+              show_default=True, help='Where to keep intermediate files')
+@cache_dir_option
+def rerender(path, render, jobs, force, scratch_dir, cache_dir):
+    """Strip every episode under PATH again from its sidecar, without calling any API."""
+    configure_render_caches(cache_dir)
+    scratch.update(directory=scratch_dir)
+    # Each directory is listed once, for its sidecars and the stripped
+    # versions of their episodes.
+    sidecars = []
+    replaced = []
+    for root, _, filenames in sorted(os.walk(path)):
+        stripped = {}
+        for filename in filenames:
+            if filename.endswith('.mp3') and Episode(filename).stripped:
+                stripped.setdefault(Episode(filename).original(), []).append(filename)
+        for filename in sorted(filenames):
+            if filename.endswith('.edl.json'):
+                sidecars.append(os.path.join(root, filename))
+                replaced.append(stripped.get(filename[:-len('.edl.json')] + '.mp3', []))
+    print(f'Rendering {len(sidecars)} episodes as {get_version()}')
+    with ProcessPoolExecutor(jobs) as executor:
+        outputs = list(executor.map(rerender_episode, sidecars, replaced, repeat(render),
+                                    repeat(force)))
+    print(f'Rendered {sum(1 for output in outputs if output)} of {len(sidecars)} episodes')
+
+
+@main.command('warm-tts-cache')
+@click.option('--top', default=50, show_default=True,
+              help='How many of the most common sponsors to render')
+@backend_options
+def warm_tts_cache(top, **backend_settings):
+    """Render the sponsors we have seen most often into the cache."""
+    backend = get_backend(**backend_settings)
+    for sponsor in sponsor_cache.top_sponsors(top):
+        print(f'{sponsor}: {backend.speak(sponsor)}')
+    print(f'Sponsor cache: {sponsor_cache.summary()}')
 
 
 if __name__ == "__main__":
@@ -0,0 +1,165 @@
+# Stands in for OpenAI's files and batches endpoints on localhost. Batches
+# finish after polls_before_done checks, answering each chat request by
+# finding the lines that say who the episode is brought to you by, or with
+# a refusal if a line says REFUSE.
+
+import email
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import itertools
+import json
+import re
+import threading
+import time
+
+SPONSOR_LINE = re.compile(r'brought to you by (\w+ \d+)')
+
+
+def answer(body):
+    if 'REFUSE' in body['messages'][-1]['content']:
+        return get_completion(body, "I can't help with that.")
+    commercials = []
+    for text in body['messages'][-1]['content'].split('\n'):
+        line, text = text.split(' ', 1)
+        match = SPONSOR_LINE.search(text)
+        if not match:
+            continue
+        line = int(line)
+        if (commercials and commercials[-1]['end_line'] == line - 1
+                and commercials[-1]['sponsor'] == match.group(1)):
+            commercials[-1]['end_line'] = line
+        else:
+            commercials.append({'sponsor': match.group(1), 'start_line': line, 'end_line': line})
+    return get_completion(body, json.dumps({'commercials': commercials}))
+
+
+def get_completion(body, content):
+    return {
+        'id': 'chatcmpl-test',
+        'object': 'chat.completion',
+        'created': int(time.time()),
+        'model': body['model'],
+        'choices': [{
+            'index': 0,
+            'message': {'role': 'assistant', 'content': content},
+            'finish_reason': 'stop',
+        }],
+        'usage': {'prompt_tokens': 100, 'completion_tokens': 10, 'total_tokens': 110},
+    }
+
+
+class BatchServer(ThreadingHTTPServer):
+    def __init__(self, polls_before_done=1, status='completed'):
+        super().__init__(('127.0.0.1', 0), Handler)
+        self.polls_before_done = polls_before_done
+        self.status = status
+        self.files = {}
+        self.batches = {}
+        self.polls = {}
+        self.ids = itertools.count(1)
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    @property
+    def base_url(self):
+        return f'http://127.0.0.1:{self.server_address[1]}/v1'
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def add_file(self, data, filename, purpose):
+        file_id = f'file-{next(self.ids)}'
+        self.files[file_id] = data
+        return {
+            'id': file_id,
+            'object': 'file',
+            'bytes': len(data),
+            'created_at': int(time.time()),
+            'filename': filename,
+            'purpose': purpose,
+            'status': 'processed',
+        }
+
+    def finish(self, batch):
+        batch['status'] = self.status
+        if self.status != 'completed':
+            return
+        output = ''
+        for line in self.files[batch['input_file_id']].decode().splitlines():
+            request = json.loads(line)
+            output += json.dumps({
+                'id': f'batch_req_{next(self.ids)}',
+                'custom_id': request['custom_id'],
+                'response': {'status_code': 200, 'request_id': 'req',
+                             'body': answer(request['body'])},
+                'error': None,
+            }) + '\n'
+        batch['output_file_id'] = self.add_file(output.encode(), 'output.jsonl',
+                                                'batch_output')['id']
+
+
+class Handler(BaseHTTPRequestHandler):
+    def send_json(self, value):
+        body = json.dumps(value).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_body(self):
+        return self.rfile.read(int(self.headers['Content-Length']))
+
+    def do_POST(self):
+        if self.path == '/v1/files':
+            message = email.message_from_bytes(
+                f'Content-Type: {self.headers["Content-Type"]}\r\n\r\n'.encode()
+                + self.read_body())
+            fields = {
+                part.get_param('name', header='content-disposition'):
+                    (part.get_filename(), part.get_payload(decode=True))
+                for part in message.get_payload()
+            }
+            filename, data = fields['file']
+            self.send_json(self.server.add_file(data, filename, fields['purpose'][1].decode()))
+        elif self.path == '/v1/batches':
+            request = json.loads(self.read_body())
+            batch_id = f'batch_{next(self.server.ids)}'
+            self.server.batches[batch_id] = {
+                'id': batch_id,
+                'object': 'batch',
+                'endpoint': request['endpoint'],
+                'input_file_id': request['input_file_id'],
+                'completion_window': request['completion_window'],
+                'status': 'validating',
+                'created_at': int(time.time()),
+                'output_file_id': None,
+                'error_file_id': None,
+            }
+            self.server.polls[batch_id] = 0
+            self.send_json(self.server.batches[batch_id])
+        else:
+            self.send_error(404)
+
+    def do_GET(self):
+        parts = self.path.strip('/').split('/')
+        if parts[:2] == ['v1', 'batches'] and parts[2] in self.server.batches:
+            batch = self.server.batches[parts[2]]
+            self.server.polls[batch['id']] += 1
+            if batch['status'] in ('validating', 'in_progress'):
+                if self.server.polls[batch['id']] > self.server.polls_before_done:
+                    self.server.finish(batch)
+                else:
+                    batch['status'] = 'in_progress'
+            self.send_json(batch)
+        elif parts[:2] == ['v1', 'files'] and parts[-1] == 'content':
+            body = self.server.files[parts[2]]
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/octet-stream')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        else:
+            self.send_error(404)
+
+    def log_message(self, *args):
+        pass
@@ -0,0 +1,157 @@
+import os
+import threading
+import time
+import unittest
+
+from backends import (
+    WINDOW_SECONDS,
+    Batcher,
+    FakeBackend,
+    LocalBackend,
+    get_segments,
+    join_windows,
+    make_backend,
+    split_windows,
+)
+from ffmpeg_util import reduce_audio
+from openai_util import result_cache
+
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+EPISODE = os.path.join(TEST_DIR, 'pizza_pod.mp3')
+
+
+class TestBatcher(unittest.TestCase):
+    def test_batches_across_threads(self):
+        batches = []
+
+        def run(items):
+            batches.append(list(items))
+            return [item * 2 for item in items]
+
+        batcher = Batcher(run, size=4, max_wait=0.5)
+        results = {}
+
+        def submit(name):
+            futures = [batcher.submit(value) for value in range(3)]
+            results[name] = [future.result() for future in futures]
+
+        threads = [threading.Thread(target=submit, args=(name,)) for name in 'ab']
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, {'a': [0, 2, 4], 'b': [0, 2, 4]})
+        self.assertEqual(sum(len(batch) for batch in batches), 6)
+        self.assertEqual(max(len(batch) for batch in batches), 4)
+
+    def test_failure(self):
+        def run(items):
+            raise RuntimeError('no model')
+
+        batcher = Batcher(run, max_wait=0)
+        with self.assertRaises(RuntimeError):
+            batcher.submit(1).result()
+
+
+class TestWindows(unittest.TestCase):
+    def test_split_windows(self):
+        windows = split_windows(list(range(70)), rate=1, seconds=30)
+        self.assertEqual([len(window) for window in windows], [30, 30, 10])
+
+    def test_get_segments(self):
+        timestamp_begin, eot = 100, 50
+        tokens = [100, 1, 2, 150, 150, 3, 200, 50]
+        segments = get_segments(tokens, timestamp_begin, eot,
+                                lambda text: ' ' + ' '.join(map(str, text)))
+        self.assertEqual(segments, [(0, 1.0, '1 2'), (1.0, 2.0, '3')])
+
+    def test_get_segments_shared_timestamps(self):
+        tokens = [100, 1, 200, 2, 300, 50]
+        segments = get_segments(tokens, 100, 50, lambda text: ' '.join(map(str, text)))
+        self.assertEqual(segments, [(0, 2.0, '1'), (2.0, 4.0, '2')])
+
+    def test_get_segments_unfinished(self):
+        segments = get_segments([100, 1], 100, 50, lambda text: 'hi')
+        self.assertEqual(segments, [(0, WINDOW_SECONDS, 'hi')])
+
+    def test_join_windows(self):
+        transcript = join_windows([[(0, 2, 'one')], [], [(1, 40, 'two')]])
+        self.assertEqual(
+            [(segment['start'], segment['end']) for segment in transcript['segments']],
+            [(0, 2), (61, 90)])
+        self.assertEqual(transcript['text'], 'one two')
+
+
+class TestFakeBackend(unittest.TestCase):
+    def test_commercials(self):
+        backend = FakeBackend(line_seconds=2, period=20, length=4)
+        transcript = backend.transcribe([(0, reduce_audio(EPISODE, 'opus', '24k'))])
+        again = backend.transcribe([(0, reduce_audio(EPISODE, 'opus', '24k'))])
+        self.assertEqual(transcript, again)
+        commercials = list(backend.detect(transcript))
+        self.assertEqual(commercials[0], {'sponsor': 'Sponsor 0', 'start_line': 5, 'end_line': 6})
+        self.assertEqual(commercials[1]['sponsor'], 'Sponsor 1')
+
+    def test_chunks(self):
+        backend = FakeBackend(line_seconds=2, period=20, length=4)
+        audio = reduce_audio(EPISODE, 'opus', '24k', 0, 12)
+        transcript = backend.transcribe([(0, audio), (12, audio)])
+        self.assertEqual(transcript.segments[6].start, 12)
+        self.assertEqual(list(backend.detect(transcript, range(7))),
+                         [{'sponsor': 'Sponsor 0', 'start_line': 5, 'end_line': 6}])
+
+    def test_speak(self):
+        file = FakeBackend(speech_seconds=1).speak('Pizza')
+        self.assertEqual(os.path.getsize(file), 44 + 48000)
+        os.remove(file)
+
+
+# The batching and stitching of LocalBackend, with a stand-in for the model.
+class CountingBackend(LocalBackend):
+    def __init__(self):
+        super().__init__('models/counting', batch_size=16, max_wait=0.5)
+        self.batches = []
+
+    def run_batch(self, windows):
+        self.batches.append(len(windows))
+        time.sleep(0.01)
+        return [[(0, 5, f'{len(window)} samples')] for window in windows]
+
+
+class TestLocalBackend(unittest.TestCase):
+    def setUp(self):
+        result_cache.configure(None)
+
+    def test_batches_episodes_together(self):
+        backend = CountingBackend()
+        audio = reduce_audio(EPISODE, 'opus', '24k', 0, 70)
+        transcripts = []
+        threads = [
+            threading.Thread(target=lambda: transcripts.append(
+                backend.transcribe([(0, audio)])))
+            for _ in range(2)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(sum(backend.batches), 6)
+        self.assertLess(len(backend.batches), 6)
+        starts = [segment.start for segment in transcripts[0].segments]
+        self.assertEqual(starts, [0, 30, 60])
+
+    def test_chunks(self):
+        backend = CountingBackend()
+        audio = reduce_audio(EPISODE, 'opus', '24k', 0, 40)
+        transcript = backend.transcribe([(0, audio), (40, audio)])
+        self.assertEqual([segment.start for segment in transcript.segments], [0, 30, 40, 70])
+
+    def test_make_backend(self):
+        with self.assertRaises(ValueError):
+            make_backend({'transcribe': 'fake', 'detect': 'local', 'speak': 'fake'})
+        backend = make_backend({'transcribe': 'fake', 'detect': 'fake', 'speak': 'fake'})
+        self.assertIs(backend.transcriber, backend.speaker)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,115 @@
+import os
+import tempfile
+import unittest
+
+from openai import OpenAI
+
+from batch import BatchQueue, Deferred
+from cache import to_namespace
+from tests.batch_server import BatchServer
+
+
+def get_transcript(lines=30, ads=((10, 12, 'Sponsor 0'), (25, 26, 'Sponsor 1'))):
+    segments = []
+    for line in range(lines):
+        text = f'Line {line}, where the hosts keep talking.'
+        for start, end, sponsor in ads:
+            if start <= line <= end:
+                text = f'This episode is brought to you by {sponsor}.'
+        segments.append({'id': line, 'start': line * 4, 'end': line * 4 + 4, 'text': text})
+    return to_namespace({'text': '', 'segments': segments})
+
+
+EXPECTED = [
+    {'sponsor': 'Sponsor 0', 'start_line': 10, 'end_line': 12},
+    {'sponsor': 'Sponsor 1', 'start_line': 25, 'end_line': 26},
+]
+
+
+class TestBatchQueue(unittest.TestCase):
+    def start(self, **settings):
+        server = BatchServer(**settings)
+        self.addCleanup(server.stop)
+        return OpenAI(api_key='test', base_url=server.base_url, max_retries=0)
+
+    def defer(self, batches, job_id, transcript, window=0):
+        with self.assertRaises(Deferred) as deferred:
+            batches.detect(transcript, None, 'packed', window)
+        batches.wait(job_id, deferred.exception.keys)
+        return deferred.exception.keys
+
+    def test_detect(self):
+        batches = BatchQueue(self.start())
+        transcript = get_transcript()
+        self.defer(batches, 7, transcript)
+        self.assertEqual(batches.pending(), 1)
+        # Sent, but not finished yet.
+        self.assertEqual(batches.run_once(), [])
+        self.assertEqual(batches.run_once(), [7])
+        self.assertEqual(batches.pending(), 0)
+        self.assertEqual(batches.detect(transcript, None, 'packed', 0), EXPECTED)
+        self.assertEqual(batches.run_once(), [])
+
+    def test_windows_in_one_batch(self):
+        batches = BatchQueue(self.start(polls_before_done=0))
+        first, second = get_transcript(), get_transcript(ads=((3, 4, 'Sponsor 2'),))
+        self.assertEqual(len(self.defer(batches, 1, first, window=12)), 4)
+        self.defer(batches, 2, second)
+        self.assertEqual(sorted(batches.run_once()), [1, 2])
+        self.assertEqual(batches.detect(first, None, 'packed', 12), EXPECTED)
+        self.assertEqual(batches.detect(second, None, 'packed', 0),
+                         [{'sponsor': 'Sponsor 2', 'start_line': 3, 'end_line': 4}])
+
+    def test_failed_batch(self):
+        batches = BatchQueue(self.start(polls_before_done=0, status='failed'))
+        transcript = get_transcript()
+        self.defer(batches, 1, transcript)
+        self.assertEqual(batches.run_once(), [1])
+        self.assertIsNone(batches.detect(transcript, None, 'packed', 0))
+
+    def test_split_by_size(self):
+        batches = BatchQueue(self.start(polls_before_done=0), max_bytes=5000)
+        transcript = get_transcript()
+        self.assertEqual(len(self.defer(batches, 1, transcript, window=12)), 4)
+        self.assertEqual(sorted(batches.run_once()), [1])
+        self.assertGreater(
+            batches.connection.execute('SELECT COUNT(*) FROM batches').fetchone()[0], 1)
+        self.assertEqual(batches.detect(transcript, None, 'packed', 12), EXPECTED)
+
+    def test_batched_again_after_failing(self):
+        batches = BatchQueue(self.start(polls_before_done=0, status='failed'))
+        transcript = get_transcript()
+        self.defer(batches, 1, transcript)
+        self.assertEqual(batches.run_once(), [1])
+        self.assertIsNone(batches.detect(transcript, None, 'packed', 0))
+        self.defer(batches, 2, transcript)
+        self.assertEqual(batches.pending(), 1)
+
+    def test_bad_answer(self):
+        batches = BatchQueue(self.start(polls_before_done=0))
+        good = get_transcript()
+        bad = to_namespace({'text': '', 'segments': [
+            {'id': 0, 'start': 0, 'end': 4, 'text': 'REFUSE'}]})
+        self.defer(batches, 1, good)
+        self.defer(batches, 2, bad)
+        self.assertEqual(sorted(batches.run_once()), [1, 2])
+        self.assertEqual(batches.detect(good, None, 'packed', 0), EXPECTED)
+        self.assertIsNone(batches.detect(bad, None, 'packed', 0))
+        self.assertEqual(batches.run_once(), [])
+
+    def test_restart(self):
+        client = self.start()
+        transcript = get_transcript()
+        with tempfile.TemporaryDirectory() as directory:
+            database = os.path.join(directory, 'batches.sqlite3')
+            batches = BatchQueue(client, database)
+            self.defer(batches, 3, transcript)
+            batches.run_once()
+
+            batches = BatchQueue(client, database)
+            self.assertEqual(batches.run_once(), [3])
+            self.assertEqual(batches.detect(transcript, None, 'packed', 0), EXPECTED)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,129 @@
+import os
+import tempfile
+from types import SimpleNamespace
+import unittest
+
+from cache import (
+    DiskCache,
+    ResultCache,
+    SponsorCache,
+    get_file_hash,
+    get_sponsor_key,
+    normalize_sponsor,
+    to_namespace
+)
+
+
+def write_file(directory, name, size):
+    path = os.path.join(directory, name)
+    with open(path, 'wb') as file:
+        file.write(b'x' * size)
+    return path
+
+
+class TestDiskCache(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.source = tempfile.mkdtemp()
+
+    def test_disabled(self):
+        cache = DiskCache()
+        source = write_file(self.source, 'a.wav', 10)
+        self.assertIsNone(cache.get('key'))
+        self.assertEqual(cache.put('key', source), source)
+
+    def test_put_and_get(self):
+        cache = DiskCache(self.directory)
+        self.assertIsNone(cache.get('abcdef', '.wav'))
+        path = cache.put('abcdef', write_file(self.source, 'a.wav', 10), '.wav')
+        self.assertEqual(cache.get('abcdef', '.wav'), path)
+        self.assertTrue(path.endswith('.wav'))
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        self.assertEqual(cache.size, 10)
+
+    def test_size_survives_restart(self):
+        DiskCache(self.directory).put('abcdef', write_file(self.source, 'a', 10))
+        self.assertEqual(DiskCache(self.directory).size, 10)
+
+    def test_overwrite(self):
+        cache = DiskCache(self.directory)
+        cache.put('abcdef', write_file(self.source, 'a', 10))
+        cache.put('abcdef', write_file(self.source, 'a', 20))
+        self.assertEqual(cache.size, 20)
+
+    def test_evicts_least_recently_used(self):
+        cache = DiskCache(self.directory, max_bytes=25)
+        first = cache.put('aaaa', write_file(self.source, 'a', 10))
+        second = cache.put('bbbb', write_file(self.source, 'b', 10))
+        os.utime(first, (0, 0))
+        os.utime(second, (1, 1))
+        cache.get('aaaa')
+        cache.put('cccc', write_file(self.source, 'c', 10))
+        self.assertIsNotNone(cache.get('aaaa'))
+        self.assertIsNone(cache.get('bbbb'))
+        self.assertIsNotNone(cache.get('cccc'))
+        self.assertEqual(cache.size, 20)
+
+    def test_keeps_files_in_use(self):
+        cache = DiskCache(self.directory, max_bytes=15, grace=60)
+        first = cache.put('aaaa', write_file(self.source, 'a', 10))
+        cache.put('bbbb', write_file(self.source, 'b', 10))
+        # Just handed out, so over the limit for now.
+        self.assertTrue(os.path.exists(first))
+        self.assertEqual(cache.size, 20)
+        os.utime(first, (0, 0))
+        cache.put('cccc', write_file(self.source, 'c', 1))
+        self.assertFalse(os.path.exists(first))
+        self.assertEqual(cache.size, 11)
+
+
+class TestSponsorCache(unittest.TestCase):
+    def test_normalize_sponsor(self):
+        self.assertEqual(normalize_sponsor('  Squarespace.'), 'squarespace')
+        self.assertEqual(normalize_sponsor('Better   Help'), 'better help')
+
+    def test_get_sponsor_key(self):
+        self.assertEqual(
+            get_sponsor_key('tts-1', 'shimmer', 'Squarespace', 'wav'),
+            get_sponsor_key('tts-1', 'shimmer', 'squarespace ', 'wav'))
+        self.assertNotEqual(
+            get_sponsor_key('tts-1', 'shimmer', 'Squarespace', 'wav'),
+            get_sponsor_key('tts-1', 'alloy', 'Squarespace', 'wav'))
+
+    def test_top_sponsors(self):
+        cache = SponsorCache(tempfile.mkdtemp())
+        for sponsor in ['A', 'B', 'b ', 'C', 'c.', 'C', '']:
+            cache.record(sponsor)
+        self.assertEqual(cache.top_sponsors(2), ['c', 'b'])
+        self.assertEqual(cache.size, 0)
+
+
+class TestResultCache(unittest.TestCase):
+    def test_get_file_hash(self):
+        directory = tempfile.mkdtemp()
+        self.assertEqual(
+            get_file_hash(write_file(directory, 'a', 10)),
+            get_file_hash(write_file(directory, 'b', 10)))
+        self.assertNotEqual(
+            get_file_hash(write_file(directory, 'a', 10)),
+            get_file_hash(write_file(directory, 'b', 11)))
+
+    def test_json_round_trip(self):
+        cache = ResultCache(tempfile.mkdtemp())
+        transcript = SimpleNamespace(
+            text='hello world',
+            segments=[SimpleNamespace(start=0.0, end=1.5, text='hello world')])
+        cache.put_json('transcript', transcript)
+        cached = to_namespace(cache.get_json('transcript'))
+        self.assertEqual(cached.segments[0].end, 1.5)
+        self.assertEqual(cached.text, 'hello world')
+
+        commercials = [{'sponsor': 'Some Company', 'start_line': 1, 'end_line': 2}]
+        cache.put_json('commercials', commercials)
+        self.assertEqual(cache.get_json('commercials'), commercials)
+        self.assertIsNone(cache.get_json('missing'))
+
+    def test_top_sponsors_disabled(self):
+        cache = SponsorCache()
+        cache.record('A')
+        self.assertEqual(cache.top_sponsors(2), [])
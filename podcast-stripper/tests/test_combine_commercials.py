@@ -160,3 +160,39 @@ class TestCommercialGroups(unittest.TestCase):
                 'end_line': 115
             }
         )
+
+    def test_combine_commercial_group_known(self):
+        self.assertEqual(combine_commercial_group([
+            {
+                'sponsor': 'Some Company',
+                'start_line': 77,
+                'end_line': 80,
+                'start': 301.5,
+                'end': 330.25,
+                'known': True
+            },
+            {
+                'sponsor': 'Some Other Company',
+                'start_line': 81,
+                'end_line': 90
+            }
+        ]),
+            {
+                'sponsor': 'Some Company and Some Other Company',
+                'start_line': 77,
+                'end_line': 90,
+                'start': 301.5,
+                'known': True
+            }
+        )
+
+    def test_combine_commercial_group_ends_last(self):
+        self.assertEqual(combine_commercial_group([
+            {'sponsor': 'Some Company', 'start_line': 10, 'end_line': 30, 'end': 120.5},
+            {'sponsor': 'Some Other Company', 'start_line': 12, 'end_line': 20, 'end': 80.0},
+        ]), {
+            'sponsor': 'Some Company and Some Other Company',
+            'start_line': 10,
+            'end_line': 30,
+            'end': 120.5
+        })
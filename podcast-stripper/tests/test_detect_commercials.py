@@ -0,0 +1,115 @@
+import json
+from types import SimpleNamespace
+import unittest
+
+from openai_util import (
+    get_messages,
+    get_windows,
+    iter_array_objects,
+    merge_window_commercials
+)
+
+
+TRANSCRIPT = SimpleNamespace(segments=[
+    SimpleNamespace(start=2.0 * n, end=2.0 * n + 2, text=f' line {n}') for n in range(5)
+])
+
+
+class TestGetMessages(unittest.TestCase):
+    def test_packed(self):
+        messages = get_messages(TRANSCRIPT, [1, 3, 4], 'packed')
+        self.assertEqual(len(messages), 2)
+        self.assertEqual(messages[0]['role'], 'system')
+        self.assertEqual(messages[1]['content'], '1 line 1\n3 line 3\n4 line 4')
+
+    def test_messages(self):
+        messages = get_messages(TRANSCRIPT, [1, 3], 'messages')
+        self.assertEqual(len(messages), 3)
+        self.assertTrue(messages[1]['content'].startswith('1 '))
+        self.assertTrue(messages[2]['content'].endswith('line 3'))
+
+
+class TestGetWindows(unittest.TestCase):
+    def test_short(self):
+        self.assertEqual(get_windows(range(10), 0, 2), [list(range(10))])
+        self.assertEqual(get_windows(range(10), 10, 2), [list(range(10))])
+
+    def test_overlap(self):
+        self.assertEqual(
+            get_windows(range(100), 40, 10),
+            [list(range(0, 40)), list(range(30, 70)), list(range(60, 100))])
+        self.assertEqual(
+            get_windows(range(41), 40, 10),
+            [list(range(0, 40)), list(range(30, 41))])
+
+    def test_overlap_at_most_half(self):
+        self.assertEqual(
+            get_windows(range(10), 6, 20),
+            [list(range(0, 6)), list(range(3, 9)), list(range(6, 10))])
+
+    def test_keeps_line_numbers(self):
+        self.assertEqual(get_windows([3, 5, 8, 13], 3, 1), [[3, 5, 8], [8, 13]])
+
+
+class TestMergeWindowCommercials(unittest.TestCase):
+    def test_seam(self):
+        self.assertEqual(merge_window_commercials([
+            [{'sponsor': 'Some Company', 'start_line': 35, 'end_line': 39}],
+            [
+                {'sponsor': 'some company', 'start_line': 35, 'end_line': 42},
+                {'sponsor': 'Some Other Company', 'start_line': 50, 'end_line': 55},
+            ],
+        ]), [
+            {'sponsor': 'Some Company', 'start_line': 35, 'end_line': 42},
+            {'sponsor': 'Some Other Company', 'start_line': 50, 'end_line': 55},
+        ])
+
+    def test_overlapping_spans_merge(self):
+        self.assertEqual(merge_window_commercials([
+            [{'sponsor': 'Squarespace', 'start_line': 10, 'end_line': 30}],
+            [{'sponsor': 'SquareSpace.com', 'start_line': 12, 'end_line': 20},
+             {'sponsor': 'Some Company', 'start_line': 31, 'end_line': 35}],
+        ]), [
+            {'sponsor': 'Squarespace', 'start_line': 10, 'end_line': 30},
+            {'sponsor': 'Some Company', 'start_line': 31, 'end_line': 35},
+        ])
+
+    def test_back_to_back_sponsors_kept(self):
+        self.assertEqual(merge_window_commercials([
+            [{'sponsor': 'Squarespace', 'start_line': 10, 'end_line': 20},
+             {'sponsor': 'Some Company', 'start_line': 20, 'end_line': 30}],
+            [{'sponsor': 'Squarespace', 'start_line': 12, 'end_line': 20},
+             {'sponsor': 'Some Company', 'start_line': 20, 'end_line': 30}],
+        ]), [
+            {'sponsor': 'Squarespace', 'start_line': 10, 'end_line': 20},
+            {'sponsor': 'Some Company', 'start_line': 21, 'end_line': 30},
+        ])
+
+
+class TestIterArrayObjects(unittest.TestCase):
+    COMMERCIALS = [
+        {'sponsor': 'Some "Company" {Inc}', 'start_line': 77, 'end_line': 80},
+        {'sponsor': 'Some Other Company [and], \\friends', 'start_line': 103, 'end_line': 111},
+    ]
+
+    def pieces(self, text, size):
+        return [text[start:start + size] for start in range(0, len(text), size)]
+
+    def test_structured(self):
+        text = json.dumps({'commercials': self.COMMERCIALS})
+        for size in (1, 3, 1000):
+            self.assertEqual(list(iter_array_objects(self.pieces(text, size))), self.COMMERCIALS)
+
+    def test_bare_array_with_chatter(self):
+        text = 'Here you go: ' + json.dumps(self.COMMERCIALS) + ' Anything else?'
+        self.assertEqual(list(iter_array_objects(self.pieces(text, 5))), self.COMMERCIALS)
+
+    def test_yields_before_the_end(self):
+        def pieces():
+            yield '{"commercials": [' + json.dumps(self.COMMERCIALS[0])
+            self.fail('Read past the first commercial')
+
+        self.assertEqual(next(iter_array_objects(pieces())), self.COMMERCIALS[0])
+
+    def test_empty(self):
+        self.assertEqual(list(iter_array_objects(['{"commercials": []}'])), [])
@@ -0,0 +1,111 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+import wave
+
+from cache import get_file_hash
+from edl import (
+    get_plan,
+    get_plan_parts,
+    get_sidecar_path,
+    read_sidecar,
+    write_sidecar,
+)
+from ffmpeg_util import get_duration, render_segments
+
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+class TestEdl(unittest.TestCase):
+    def setUp(self):
+        self.temp = tempfile.TemporaryDirectory()
+        self.episode = os.path.join(self.temp.name, '2024-01-01-pizza-6ca13d52.mp3')
+        shutil.copy(os.path.join(TEST_DIR, 'pizza_pod.mp3'), self.episode)
+        self.clip = os.path.join(self.temp.name, 'sponsor.wav')
+        with wave.open(self.clip, 'wb') as clip:
+            clip.setnchannels(1)
+            clip.setsampwidth(2)
+            clip.setframerate(24000)
+            clip.writeframes(bytes(2 * 24000))
+
+    def tearDown(self):
+        self.temp.cleanup()
+
+    def get_plan(self):
+        commercials = [{'sponsor': 'Acme', 'start_line': 3, 'end_line': 5}]
+        parts = [(0, 20.5), self.clip, (30.25, None)]
+        return get_plan(self.episode, commercials, parts, 'v1.2')
+
+    def test_plan(self):
+        plan = self.get_plan()
+        clip = get_file_hash(self.clip)
+        self.assertEqual(plan, {
+            'format': 1,
+            'source': '2024-01-01-pizza-6ca13d52.mp3',
+            'source_hash': get_file_hash(self.episode),
+            'version': 'v1.2',
+            'parts': [
+                {'start': 0, 'end': 20.5},
+                {'sponsor': 'Acme', 'clip': clip, 'file': '2024-01-01-pizza-6ca13d52.edl.0.wav'},
+                {'start': 30.25, 'end': None},
+            ],
+        })
+        # Still there once the job's workspace is gone.
+        os.remove(self.clip)
+        parts = get_plan_parts(plan, self.temp.name)
+        self.assertEqual(parts[0], (0, 20.5))
+        self.assertEqual(parts[1], os.path.join(self.temp.name, plan['parts'][1]['file']))
+        self.assertEqual(get_file_hash(parts[1]), clip)
+        self.assertEqual(parts[2], (30.25, None))
+
+    def test_old_clips_removed(self):
+        commercials = [{'sponsor': 'Acme', 'start_line': 3, 'end_line': 5}] * 2
+        get_plan(self.episode, commercials, [(0, 1), self.clip, (2, 3), self.clip, (4, None)],
+                 'v1.2')
+        self.assertIn('2024-01-01-pizza-6ca13d52.edl.1.wav', os.listdir(self.temp.name))
+        self.get_plan()
+        self.assertNotIn('2024-01-01-pizza-6ca13d52.edl.1.wav', os.listdir(self.temp.name))
+
+    def test_readable_as_episode(self):
+        os.chmod(self.episode, 0o644)
+        plan = self.get_plan()
+        path = write_sidecar(self.episode, plan)
+        for name in path, os.path.join(self.temp.name, plan['parts'][1]['file']):
+            self.assertEqual(os.stat(name).st_mode & 0o777, 0o644)
+
+    def test_sidecar(self):
+        plan = self.get_plan()
+        path = write_sidecar(self.episode, plan)
+        self.assertEqual(path, os.path.join(self.temp.name, '2024-01-01-pizza-6ca13d52.edl.json'))
+        self.assertEqual(path, get_sidecar_path(self.episode))
+        self.assertEqual(read_sidecar(path), plan)
+        self.assertEqual(sorted(os.listdir(self.temp.name)),
+                         ['2024-01-01-pizza-6ca13d52.edl.0.wav', os.path.basename(path),
+                          os.path.basename(self.episode), 'sponsor.wav'])
+
+    def test_unknown_format(self):
+        path = write_sidecar(self.episode, {**self.get_plan(), 'format': 99})
+        with self.assertRaises(ValueError):
+            read_sidecar(path)
+
+    def test_missing_clip(self):
+        plan = self.get_plan()
+        os.remove(os.path.join(self.temp.name, plan['parts'][1]['file']))
+        with self.assertRaises(FileNotFoundError):
+            get_plan_parts(plan, self.temp.name)
+
+    def test_render_from_sidecar(self):
+        path = write_sidecar(self.episode, self.get_plan())
+        with open(path) as file:
+            plan = json.load(file)
+        output = os.path.join(self.temp.name, 'stripped.mp3')
+        render_segments(self.episode, get_plan_parts(plan, self.temp.name), output)
+        # A second of silence goes on either side of the announcement.
+        expected = get_duration(self.episode) - 9.75 + 1 + 2
+        self.assertAlmostEqual(get_duration(output), expected, delta=1.5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,12 +1,18 @@
+from concurrent.futures import ThreadPoolExecutor
 import os
+import shutil
 import subprocess
 import tempfile
+import time
 import unittest
 
 from ffmpeg_util import (
-    seconds_to_ffmpeg_format, reduce_audio_file,
-    write_audio_clip, join_segments_mp3, get_duration, get_size, add_image, get_image
+    UPLOAD_ENCODINGS, seconds_to_ffmpeg_format, reduce_audio_file, reduce_audio,
+    write_audio_clip, join_segments_mp3, get_duration, get_size, add_image, get_image,
+    render_segments, render_trimmed, render_copied, resolve_parts, find_silences,
+    get_split_points
 )
+from mp3_util import index_frames, read_art
 
 
 FILE1 = os.path.join(os.path.dirname(__file__), 'pizza1.mp3')
@@ -27,6 +33,28 @@ class TestFFmpegUtil(unittest.TestCase):
         reduce_audio_file(FILE1, output_file)
         self.assertLessEqual(get_size(output_file), get_size(FILE1))
 
+    def test_reduce_audio(self):
+        opus = reduce_audio(FILE1, 'opus', '16k')
+        self.assertTrue(opus.startswith(b'OggS'))
+        self.assertLess(len(opus), get_size(FILE1) / 4)
+        mp3 = reduce_audio(FILE1, 'mp3', None)
+        self.assertLess(len(opus), len(mp3))
+        self.assertLess(len(reduce_audio(FILE1, 'opus', '16k', 3, 5)), len(opus))
+
+    def test_reduce_audio_same_bytes(self):
+        # The transcript cache goes by these bytes.
+        for encoding in UPLOAD_ENCODINGS:
+            self.assertEqual(reduce_audio(FILE1, encoding, '16k'),
+                             reduce_audio(FILE1, encoding, '16k'))
+            self.assertEqual(reduce_audio(FILE1, encoding, '16k', 3, 5),
+                             reduce_audio(FILE1, encoding, '16k', 3, 5))
+
+    def test_reduce_audio_chunk(self):
+        chunk = os.path.join(tempfile.mkdtemp(), 'chunk.ogg')
+        with open(chunk, 'wb') as file:
+            file.write(reduce_audio(FILE1, 'opus', '16k', 3, 5))
+        self.assertAlmostEqual(get_duration(chunk), 2, delta=0.1)
+
     def test_write_audio_clip(self):
         output_file = '/tmp/test-clip.mp3'
         write_audio_clip(FILE1, output_file, 3, 5)
@@ -53,6 +81,85 @@ class TestFFmpegUtil(unittest.TestCase):
                                 expected_duration - 1)
         self.assertLessEqual(get_duration(output_file), expected_duration + 1)
 
+    def test_render_trimmed(self):
+        parts = [(1, 4), COMMERCIAL, (get_duration(FILE1) - 4, None)]
+        segments_file = '/tmp/test-render-segments.mp3'
+        trimmed_file = '/tmp/test-render-trimmed.mp3'
+        render_segments(FILE1, parts, segments_file)
+        render_trimmed(FILE1, parts, trimmed_file)
+        expected_duration = 3 + 1 + get_duration(COMMERCIAL) + 1 + 4
+        self.assertAlmostEqual(get_duration(trimmed_file), expected_duration, delta=1)
+        self.assertAlmostEqual(
+            get_duration(trimmed_file), get_duration(segments_file), delta=0.5)
+
+    def test_render_with_image(self):
+        parts = [(1, 4), COMMERCIAL, (get_duration(FILE1) - 4, None)]
+        with open(IMAGE, 'rb') as file:
+            image = file.read()
+        expected_duration = 3 + 1 + get_duration(COMMERCIAL) + 1 + 4
+        with tempfile.TemporaryDirectory() as directory:
+            for render in render_segments, render_trimmed:
+                output = os.path.join(directory, f'{render.__name__}.mp3')
+                render(FILE1, parts, output, IMAGE)
+                self.assertEqual(read_art(output), ('image/jpeg', image))
+                self.assertAlmostEqual(get_duration(output), expected_duration, delta=1)
+
+    def test_render_segments_futures(self):
+        with tempfile.TemporaryDirectory() as directory, ThreadPoolExecutor(2) as executor:
+            def speak(name, seconds):
+                time.sleep(seconds)
+                return shutil.copy(COMMERCIAL, os.path.join(directory, name))
+
+            late, early = executor.submit(speak, 'late.mp3', 1), executor.submit(
+                speak, 'early.mp3', 0)
+            parts = [(1, 4), late, (5, 7), early, (get_duration(FILE1) - 4, None)]
+            self.assertEqual(resolve_parts(parts)[1], os.path.join(directory, 'late.mp3'))
+            output = os.path.join(directory, 'output.mp3')
+            render_segments(FILE1, parts, output, workers=3)
+            # Four seconds of silence between the five parts.
+            expected_duration = 3 + 2 + 4 + 2 * get_duration(COMMERCIAL) + 4
+            self.assertAlmostEqual(get_duration(output), expected_duration, delta=1)
+
+    def test_render_copied(self):
+        parts = [(1, 4), COMMERCIAL, (get_duration(FILE1) - 4, None)]
+        copied_file = '/tmp/test-render-copied.mp3'
+        trimmed_file = '/tmp/test-render-trimmed.mp3'
+        render_copied(FILE1, parts, copied_file)
+        render_trimmed(FILE1, parts, trimmed_file)
+        self.assertAlmostEqual(
+            get_duration(copied_file), get_duration(trimmed_file), delta=0.5)
+        decoded = subprocess.run(['ffmpeg', '-v', 'error', '-i', copied_file, '-f', 'null', '-'],
+                                 capture_output=True, text=True)
+        self.assertEqual(decoded.stderr, '')
+
+        # The last four seconds are the episode's own frames.
+        index = index_frames(FILE1)
+        with open(FILE1, 'rb') as source, open(copied_file, 'rb') as copied:
+            source.seek(index.offsets[-1] - 3 * 16000)
+            tail = source.read()
+            self.assertTrue(copied.read().endswith(tail))
+
+    def test_render_copied_not_mp3(self):
+        with tempfile.TemporaryDirectory() as directory:
+            episode = os.path.join(directory, 'episode.wav')
+            output = os.path.join(directory, 'output.mp3')
+            subprocess.run(['ffmpeg', '-loglevel', 'error', '-f', 'lavfi', '-i',
+                            'sine=duration=10', episode], check=True)
+            render_copied(episode, [(0, 3), (6, None)], output)
+            self.assertAlmostEqual(get_duration(output), 8, delta=0.5)
+
+    def test_find_silences(self):
+        silences = find_silences(PIZZA_POD, min_duration=0.1)
+        for start, end in silences:
+            self.assertLess(start, end)
+
+    def test_get_split_points(self):
+        self.assertEqual(get_split_points([], 50, 60), [])
+        self.assertEqual(get_split_points([], 130, 60), [60, 120])
+        self.assertEqual(get_split_points([(54, 56), (100, 102)], 130, 60), [55, 101])
+        # Too early in the chunk
+        self.assertEqual(get_split_points([(10, 12)], 100, 60), [60])
+
     def test_get_image(self):
         self.assertIsNone(get_image(FILE1))
         self.assertIsNotNone(get_image(PIZZA_POD))
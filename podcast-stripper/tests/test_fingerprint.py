@@ -0,0 +1,85 @@
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+from ffmpeg_util import get_duration
+from fingerprint import FRAME_SECONDS, FingerprintIndex, fingerprint_file, get_span
+
+
+class TestFingerprint(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.commercial = fingerprint_file('tests/commercial.mp3')
+        cls.episode = fingerprint_file('tests/pizza_pod.mp3')
+
+    def get_index(self, directory=None):
+        index = FingerprintIndex(directory)
+        index.add('Acme', *self.commercial, get_duration('tests/commercial.mp3'))
+        return index
+
+    def test_match(self):
+        matches = self.get_index().match(*self.episode)
+        self.assertEqual(len(matches), 1)
+        self.assertEqual(matches[0]['sponsor'], 'Acme')
+        self.assertAlmostEqual(matches[0]['start'], 22.76, delta=0.1)
+        self.assertAlmostEqual(matches[0]['end'], 41.46, delta=0.1)
+
+    def test_no_match(self):
+        self.assertEqual(self.get_index().match(*fingerprint_file('tests/pizza1.mp3')), [])
+
+    def test_empty(self):
+        self.assertEqual(FingerprintIndex().match(*self.episode), [])
+        self.assertEqual(self.get_index().match(np.empty(0, dtype=np.int64),
+                                                np.empty(0, dtype=np.int64)), [])
+
+    def test_span(self):
+        hashes, times = get_span(*self.episode, 22.76, 41.46)
+        self.assertTrue(len(hashes))
+        self.assertGreaterEqual(times.min(), 0)
+        self.assertLessEqual(times.max(), (41.46 - 22.76) / FRAME_SECONDS)
+
+        index = FingerprintIndex()
+        index.add('Acme', hashes, times, 41.46 - 22.76)
+        matches = index.match(*self.episode)
+        self.assertEqual(len(matches), 1)
+        self.assertAlmostEqual(matches[0]['start'], 22.76, delta=0.1)
+
+    def test_saved(self):
+        with tempfile.TemporaryDirectory() as directory:
+            self.get_index(directory)
+            index = FingerprintIndex(directory)
+            self.assertEqual(len(index), 1)
+            self.assertEqual(index.match(*self.episode)[0]['sponsor'], 'Acme')
+
+    def test_added_after_build(self):
+        index = self.get_index()
+        index.add('Other', np.array([1, 2, 3]), np.array([0, 1, 2]), 30)
+        index.build()
+        index.add('Another', np.array([4, 5, 6]), np.array([0, 1, 2]), 30)
+        self.assertEqual([match['sponsor'] for match in index.match(*self.episode)], ['Acme'])
+
+    def test_saved_by_each_process(self):
+        with tempfile.TemporaryDirectory() as directory:
+            # Two processes sharing the directory each learn a commercial.
+            first, second = FingerprintIndex(directory), FingerprintIndex(directory)
+            first.add('Acme', *self.commercial, get_duration('tests/commercial.mp3'))
+            second.add('Other', np.array([1, 2, 3]), np.array([0, 1, 2]), 30)
+            self.assertEqual(len(FingerprintIndex(directory)), 2)
+
+    def test_forgets_oldest(self):
+        with tempfile.TemporaryDirectory() as directory:
+            index = self.get_index(directory)
+            index.max_ads = 2
+            index.add('Other', np.array([1, 2, 3]), np.array([0, 1, 2]), 30)
+            index.add('Another', np.array([4, 5, 6]), np.array([0, 1, 2]), 30)
+            self.assertEqual(len(index), 2)
+            self.assertEqual(index.match(*self.episode), [])
+            self.assertEqual(len(os.listdir(directory)), 2)
+            self.assertEqual(len(FingerprintIndex(directory, max_ads=1)), 1)
+            self.assertEqual(len(os.listdir(directory)), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
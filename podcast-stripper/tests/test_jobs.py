@@ -0,0 +1,262 @@
+import os
+import sqlite3
+import tempfile
+import unittest
+from types import SimpleNamespace
+
+from jobs import JobQueue
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestJobQueue(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.queue = JobQueue(max_attempts=3, retry_delay=60, clock=self.clock)
+
+    def add(self, path='a.mp3', content_hash='abc'):
+        return self.queue.add(path, f'{path}-stripped', {'render': 'segments'}, content_hash)
+
+    def test_add_and_take(self):
+        job_id = self.add()
+        job = self.queue.take(timeout=0)
+        self.assertEqual(job, {
+            'id': job_id,
+            'path': 'a.mp3',
+            'output': 'a.mp3-stripped',
+            'state': 'queued',
+            'render': 'segments',
+        })
+        # Already taken.
+        self.assertIsNone(self.queue.take(timeout=0))
+
+    def test_dedupe(self):
+        self.assertIsNotNone(self.add())
+        self.assertIsNone(self.add())
+        self.assertIsNotNone(self.add(content_hash='def'))
+        self.assertIsNotNone(self.add(path='b.mp3'))
+
+    def test_add_again(self):
+        with tempfile.TemporaryDirectory() as directory:
+            output = os.path.join(directory, 'a-stripped.mp3')
+            job_id = self.queue.add('a.mp3', output, {}, 'abc')
+            self.queue.take(timeout=0)
+            self.queue.advance(job_id, 'detected', transcript={'segments': []}, commercials=[])
+            self.queue.finish(job_id)
+            open(output, 'w').close()
+            self.assertTrue(self.queue.has_job('a.mp3', 'abc'))
+            self.assertIsNone(self.queue.add('a.mp3', output, {}, 'abc'))
+
+            # Stripped, but the stripped file is gone, so it starts over.
+            os.remove(output)
+            self.assertFalse(self.queue.has_job('a.mp3', 'abc'))
+            self.assertEqual(self.queue.add('a.mp3', output, {}, 'abc'), job_id)
+            job = self.queue.take(timeout=0)
+            self.assertEqual((job['id'], job['state']), (job_id, 'queued'))
+            self.assertNotIn('transcript', job)
+
+            # Failed, so it picks up where it left off.
+            self.queue.advance(job_id, 'transcribed', transcript={'segments': []})
+            for _ in range(3):
+                self.queue.fail(job_id, 'oops')
+            self.assertFalse(self.queue.has_job('a.mp3', 'abc'))
+            self.assertEqual(self.queue.add('a.mp3', output, {}, 'abc'), job_id)
+            self.assertEqual(self.queue.take(timeout=0)['state'], 'transcribed')
+
+            # A changed file is a new job.
+            self.assertFalse(self.queue.has_job('a.mp3', 'def'))
+            self.assertNotEqual(self.queue.add('a.mp3', output, {}, 'def'), job_id)
+
+    def test_skipped_not_added_again(self):
+        job_id = self.add()
+        self.queue.take(timeout=0)
+        self.queue.fail(job_id, 'skipped', retry=False)
+        self.assertTrue(self.queue.has_job('a.mp3', 'abc'))
+        self.assertIsNone(self.add())
+
+    def test_stages(self):
+        job_id = self.add()
+        self.queue.take(timeout=0)
+        transcript = SimpleNamespace(segments=[SimpleNamespace(start=0, end=1, text='hi')])
+        self.queue.advance(job_id, 'transcribed', transcript=transcript)
+        self.queue.advance(job_id, 'detected', commercials=[])
+        job = self.queue.get(job_id)
+        self.assertEqual(job['state'], 'detected')
+        self.assertEqual(job['transcript'].segments[0].text, 'hi')
+        self.assertEqual(job['commercials'], [])
+        self.queue.finish(job_id)
+        self.assertEqual(self.queue.get(job_id)['state'], 'rendered')
+        self.assertIsNone(self.queue.take(timeout=0))
+
+    def test_retry_with_backoff(self):
+        job_id = self.add()
+        self.queue.take(timeout=0)
+        self.queue.fail(job_id, 'oops')
+        self.assertIsNone(self.queue.take(timeout=0))
+        self.clock.now += 60
+        self.assertEqual(self.queue.take(timeout=0)['id'], job_id)
+        self.queue.fail(job_id, 'oops')
+        self.clock.now += 119
+        self.assertIsNone(self.queue.take(timeout=0))
+        self.clock.now += 1
+        self.queue.take(timeout=0)
+        self.queue.fail(job_id, 'oops again')
+        self.assertEqual(self.queue.get(job_id)['state'], 'failed')
+        self.assertEqual([tuple(row) for row in self.queue.failures()],
+                         [('a.mp3', 3, 'oops again')])
+
+    def test_no_retry(self):
+        job_id = self.add()
+        self.queue.take(timeout=0)
+        self.queue.fail(job_id, 'skipped', retry=False)
+        self.assertEqual(self.queue.get(job_id)['state'], 'failed')
+
+    def test_release(self):
+        job_id = self.add()
+        self.queue.take(timeout=0)
+        self.queue.release(job_id, 'batched')
+        self.assertIsNone(self.queue.take(timeout=0))
+        self.queue.advance(job_id, 'transcribed')
+        job = self.queue.take(timeout=0)
+        self.assertEqual((job['id'], job['state']), (job_id, 'transcribed'))
+        self.assertEqual(self.queue.get(job_id)['state'], 'transcribed')
+
+    def test_move(self):
+        job_id = self.add()
+        self.queue.take(timeout=0)
+        self.queue.release(job_id, 'batched')
+        self.queue.move('batched', 'transcribed')
+        self.assertEqual(self.queue.take(timeout=0)['id'], job_id)
+
+    def test_resume(self):
+        with tempfile.TemporaryDirectory() as directory:
+            database = os.path.join(directory, 'jobs.sqlite3')
+            queue = JobQueue(database, clock=self.clock)
+            first = queue.add('a.mp3', 'a-stripped.mp3', {}, 'abc')
+            second = queue.add('b.mp3', 'b-stripped.mp3', {}, 'def')
+            queue.take(timeout=0)
+            queue.advance(first, 'detected', commercials=[])
+            queue.take(timeout=0)
+            queue.finish(second)
+
+            # Restarted while the first was being rendered.
+            queue = JobQueue(database, clock=self.clock)
+            job = queue.take(timeout=0)
+            self.assertEqual((job['id'], job['state'], job['commercials']),
+                             (first, 'detected', []))
+            self.assertIsNone(queue.take(timeout=0))
+
+    def test_priority(self):
+        self.queue = JobQueue(clock=self.clock, aging=3600)
+        old = self.queue.add('old.mp3', 'o', {}, 'a')
+        light = self.queue.add('light.mp3', 'l', {}, 'b', weight=0.5)
+        heavy = self.queue.add('heavy.mp3', 'h', {}, 'c', weight=3)
+        fresh = self.queue.add('fresh.mp3', 'f', {}, 'd', fresh=True)
+        self.assertEqual([self.queue.take(timeout=0)['id'] for _ in range(4)],
+                         [fresh, heavy, old, light])
+
+    def test_fresh_before_heavy_backlog(self):
+        self.queue = JobQueue(clock=self.clock, aging=3600)
+        heavy = self.queue.add('heavy.mp3', 'h', {}, 'a', weight=12)
+        light = self.queue.add('light.mp3', 'l', {}, 'b', weight=0.5, fresh=True)
+        fresh = self.queue.add('fresh.mp3', 'f', {}, 'c', weight=1, fresh=True)
+        self.assertEqual([self.queue.take(timeout=0)['id'] for _ in range(3)],
+                         [fresh, light, heavy])
+
+    def test_aging(self):
+        self.queue = JobQueue(clock=self.clock, aging=3600)
+        backlog = self.queue.add('backlog.mp3', 'b', {}, 'a')
+        self.clock.now += 8 * 3600
+        fresh = self.queue.add('fresh.mp3', 'f', {}, 'b', fresh=True)
+        self.assertEqual(self.queue.take(timeout=0)['id'], fresh)
+        self.queue.finish(fresh)
+        # Waited long enough to go ahead of heavier backlog that came later.
+        heavy = self.queue.add('heavy.mp3', 'h', {}, 'c', weight=3)
+        self.assertEqual(self.queue.take(timeout=0)['id'], backlog)
+        self.queue.finish(backlog)
+        # But never ahead of new arrivals, however long it waits.
+        self.clock.now += 1000 * 3600
+        later = self.queue.add('later.mp3', 'l', {}, 'd', fresh=True)
+        self.assertEqual(self.queue.take(timeout=0)['id'], later)
+        self.assertEqual(self.queue.take(timeout=0)['id'], heavy)
+
+    def test_waiting_job_does_not_block(self):
+        retried = self.add('a.mp3')
+        self.queue.take(timeout=0)
+        self.queue.fail(retried, 'oops')
+        other = self.add('b.mp3')
+        self.assertEqual(self.queue.take(timeout=0)['id'], other)
+        self.assertEqual(self.queue.next_ready(), (None, 60))
+
+    def test_finish(self):
+        self.queue.add('a.mp3', 'a-stripped.mp3', {}, 'abc', fresh=True)
+        job_id = self.queue.take(timeout=0)['id']
+        self.clock.now += 90
+        self.assertEqual(self.queue.finish(job_id), (True, 90))
+
+    def test_upgrade(self):
+        with tempfile.TemporaryDirectory() as directory:
+            database = os.path.join(directory, 'jobs.sqlite3')
+            connection = sqlite3.connect(database)
+            with connection:
+                connection.execute(
+                    'CREATE TABLE jobs (id INTEGER PRIMARY KEY, path TEXT NOT NULL, '
+                    'content_hash TEXT NOT NULL, output TEXT NOT NULL, settings TEXT NOT NULL, '
+                    "state TEXT NOT NULL DEFAULT 'queued', attempts INTEGER NOT NULL DEFAULT 0, "
+                    'error TEXT, transcript TEXT, commercials TEXT, created REAL NOT NULL, '
+                    'updated REAL NOT NULL, not_before REAL NOT NULL DEFAULT 0, '
+                    'UNIQUE (path, content_hash))')
+                connection.execute(
+                    "INSERT INTO jobs (path, content_hash, output, settings, created, updated) "
+                    "VALUES ('a.mp3', 'abc', 'a-stripped.mp3', '{}', 1, 1)")
+            connection.close()
+            queue = JobQueue(database, clock=self.clock)
+            fresh = queue.add('b.mp3', 'b-stripped.mp3', {}, 'def', fresh=True)
+            self.assertEqual(queue.take(timeout=0)['id'], fresh)
+            self.assertEqual(queue.take(timeout=0)['path'], 'a.mp3')
+
+    def test_retry_failed(self):
+        transcribed = self.add('a.mp3')
+        self.queue.take(timeout=0)
+        self.queue.advance(transcribed, 'transcribed', transcript={'segments': []})
+        for _ in range(3):
+            self.queue.fail(transcribed, 'oops')
+        skipped = self.add('b.mp3')
+        self.queue.take(timeout=0)
+        self.queue.fail(skipped, 'skipped', retry=False)
+        self.assertIsNone(self.queue.take(timeout=0))
+
+        self.assertEqual(self.queue.retry_failed(), 1)
+        job = self.queue.take(timeout=0)
+        self.assertEqual((job['id'], job['state']), (transcribed, 'transcribed'))
+        self.queue.fail(transcribed, 'oops')
+        self.assertEqual(self.queue.get(transcribed)['state'], 'transcribed')
+        self.assertEqual(self.queue.retry_failed(skipped=True), 1)
+        self.assertEqual(self.queue.take(timeout=0)['id'], skipped)
+
+    def test_status(self):
+        self.add('a.mp3')
+        self.clock.now += 30
+        self.add('b.mp3')
+        job_id = self.queue.take(timeout=0)['id']
+        self.clock.now += 10
+        self.queue.advance(job_id, 'transcribed')
+        self.clock.now += 5
+        self.assertEqual(self.queue.status(), [
+            ('queued', 1, 15.0),
+            ('transcribed', 1, 5.0),
+            ('batched', 0, 0),
+            ('detected', 0, 0),
+            ('rendered', 0, 0),
+            ('failed', 0, 0),
+        ])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,175 @@
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+from ffmpeg_util import ffprobe, probe, probe_file
+from mp3_util import (
+    count_frames,
+    get_reservoir,
+    get_reservoir_frame,
+    get_xing_frame,
+    index_frames,
+    main_data_begin,
+    parse_frame_header,
+    read_art,
+    read_mp3_info,
+    write_art,
+)
+
+FILES = [
+    'tests/commercial.mp3',
+    'tests/pizza1.mp3',
+    'tests/pizza2.mp3',
+    'tests/pizza_pod.mp3',
+    'tests/pizza_pod_stripped.mp3',
+]
+IMAGE = 'tests/pizza.jpg'
+
+
+class TestMp3Util(unittest.TestCase):
+    def test_parse_frame_header(self):
+        # MPEG 1 layer III, 128 kb/s, 44.1 kHz, no padding, mono.
+        frame = parse_frame_header(b'\xff\xfb\x90\xc4')
+        self.assertEqual((frame.version, frame.layer, frame.bitrate, frame.sample_rate,
+                          frame.channels, frame.length, frame.samples),
+                         (1, 3, 128000, 44100, 1, 417, 1152))
+        self.assertIsNone(parse_frame_header(b'\xff\xfb\xf0\xc4'))
+        self.assertIsNone(parse_frame_header(b'ID3\x04'))
+
+    def test_same_as_ffprobe(self):
+        for file in FILES:
+            with self.subTest(file=file):
+                info = read_mp3_info(file)
+                expected = ffprobe(file)
+                self.assertAlmostEqual(info.duration, expected.duration, delta=0.1)
+                self.assertEqual(info.sample_rate, expected.sample_rate)
+                self.assertEqual(info.channels, expected.channels)
+                self.assertEqual(info.has_art, expected.has_art)
+
+    def test_vbr(self):
+        with tempfile.TemporaryDirectory() as directory:
+            output = os.path.join(directory, 'vbr.mp3')
+            subprocess.run(['ffmpeg', '-loglevel', 'error', '-i', FILES[1], '-ac', '2',
+                            '-c:a', 'libmp3lame', '-q:a', '6', output], check=True)
+            self.assertAlmostEqual(read_mp3_info(output).duration, ffprobe(output).duration,
+                                   delta=0.1)
+            self.assertEqual(read_mp3_info(output).channels, 2)
+
+    def test_not_mp3(self):
+        with tempfile.NamedTemporaryFile(suffix='.mp3') as file:
+            file.write(b'not an mp3 at all' * 100)
+            file.flush()
+            self.assertIsNone(read_mp3_info(file.name))
+
+    def test_index_frames(self):
+        index = index_frames(FILES[3])
+        with open(FILES[3], 'rb') as file:
+            data = file.read()
+        self.assertEqual(data[index.offsets[0]], 0xFF)
+        self.assertEqual(index.offsets[-1], len(data))
+        self.assertEqual(len(index.offsets) - 1, len(index.reservoir))
+        self.assertEqual(count_frames(data[index.offsets[0]:]), len(index.reservoir))
+        self.assertIsNone(index_frames(IMAGE))
+
+    def test_reservoir_frame(self):
+        index = index_frames(FILES[1])
+        number = max(range(index.first_frame, len(index.reservoir)),
+                     key=lambda number: index.reservoir[number])
+        with open(FILES[1], 'rb') as file:
+            data = file.read()
+        reservoir = get_reservoir(data, index, number)
+        self.assertEqual(len(reservoir), index.reservoir[number])
+        template = data[index.offsets[number]:index.offsets[number] + 4]
+        frame = get_reservoir_frame(template, reservoir)
+        header = parse_frame_header(frame)
+        self.assertEqual(len(frame), header.length)
+        self.assertEqual(main_data_begin(frame, 0, header), 0)
+        self.assertTrue(frame.endswith(reservoir))
+
+    def test_xing_frame(self):
+        template = b'\xff\xfb\x90\xc4'
+        frame = get_xing_frame(template, 100, 41700)
+        with tempfile.NamedTemporaryFile(suffix='.mp3') as file:
+            file.write(frame + template + bytes(413) * 100)
+            file.flush()
+            self.assertAlmostEqual(read_mp3_info(file.name).duration, 100 * 1152 / 44100)
+
+
+class TestArt(unittest.TestCase):
+    def test_read_art(self):
+        with open(IMAGE, 'rb') as file:
+            image = file.read()
+        self.assertEqual(read_art(FILES[3]), ('image/jpeg', image))
+        self.assertIsNone(read_art(FILES[1]))
+
+    def test_write_art(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'episode.mp3')
+            shutil.copy(FILES[1], path)
+            audio_size = os.path.getsize(path)
+
+            # No tag to start with, so the file is written once with one.
+            self.assertTrue(write_art(path, b'first image'))
+            self.assertEqual(read_art(path), ('image/jpeg', b'first image'))
+            self.assertGreater(os.path.getsize(path), audio_size)
+
+            # After that there's room in the padding.
+            size, inode = os.path.getsize(path), os.stat(path).st_ino
+            self.assertTrue(write_art(path, b'second image', 'image/png'))
+            self.assertEqual(read_art(path), ('image/png', b'second image'))
+            self.assertEqual((os.path.getsize(path), os.stat(path).st_ino), (size, inode))
+            self.assertAlmostEqual(ffprobe(path).duration, ffprobe(FILES[1]).duration,
+                                   delta=0.1)
+
+    def test_write_art_keeps_tags(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'episode.mp3')
+            shutil.copy(FILES[3], path)
+            self.assertTrue(write_art(path, b'new image'))
+            self.assertEqual(read_art(path), ('image/jpeg', b'new image'))
+            tags = [
+                subprocess.run(['ffmpeg', '-v', 'error', '-i', file, '-f', 'ffmetadata', '-'],
+                               capture_output=True, check=True).stdout
+                for file in (FILES[3], path)
+            ]
+            self.assertIn(b'encoder=', tags[0])
+            self.assertEqual(tags[1], tags[0])
+
+    def test_write_art_unsupported(self):
+        with tempfile.NamedTemporaryFile(suffix='.mp3') as file:
+            # An ID3v2.2 tag.
+            file.write(b'ID3\x02\0\0\0\0\0\x10' + bytes(16))
+            file.flush()
+            self.assertFalse(write_art(file.name, b'image'))
+
+
+class TestProbe(unittest.TestCase):
+    def test_memoized(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'episode.mp3')
+            shutil.copy(FILES[1], path)
+            probe_file.cache_clear()
+            first = probe(path)
+            self.assertEqual(probe(path), first)
+            self.assertEqual(probe_file.cache_info().hits, 1)
+
+            # A different file at the same path is probed again.
+            shutil.copy(FILES[0], path)
+            os.utime(path, ns=(0, os.stat(path).st_mtime_ns + 1))
+            self.assertAlmostEqual(probe(path).duration, 18.7, delta=0.1)
+            self.assertEqual(probe_file.cache_info().misses, 2)
+
+    def test_ffprobe_fallback(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'tone.wav')
+            subprocess.run(['ffmpeg', '-loglevel', 'error', '-f', 'lavfi', '-i',
+                            'sine=duration=2:sample_rate=8000', path], check=True)
+            info = probe(path)
+            self.assertAlmostEqual(info.duration, 2, delta=0.1)
+            self.assertEqual((info.sample_rate, info.channels, info.has_art), (8000, 1, False))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,117 @@
+from concurrent.futures import ProcessPoolExecutor
+import threading
+import unittest
+
+from metrics import metrics
+from pipeline import Pipeline, Stage, get_cpu_count
+
+
+def double(job):
+    return {**job, 'value': 2 * job['value']}
+
+
+def count_double(job):
+    metrics.count('doubled_total')
+    return double(job)
+
+
+class TestPipeline(unittest.TestCase):
+    def test_get_cpu_count(self):
+        self.assertGreaterEqual(get_cpu_count(), 1)
+
+    def test_stages_in_order(self):
+        results = []
+        lock = threading.Lock()
+
+        def collect(job):
+            with lock:
+                results.append(job['value'])
+            return job
+
+        with ProcessPoolExecutor(2) as processes:
+            pipeline = Pipeline([
+                Stage('double', double, 2, processes),
+                Stage('add', lambda job: {**job, 'value': job['value'] + 1}, 3),
+                Stage('collect', collect),
+            ])
+            for value in range(10):
+                pipeline.submit(path=str(value), value=value)
+            pipeline.join()
+
+        self.assertEqual(sorted(results), [2 * value + 1 for value in range(10)])
+
+    def test_none_drops_job(self):
+        results = []
+        pipeline = Pipeline([
+            Stage('filter', lambda job: job if job['value'] % 2 else None),
+            Stage('collect', results.append),
+        ])
+        for value in range(4):
+            pipeline.submit(path=str(value), value=value)
+        pipeline.join()
+        self.assertEqual(sorted(job['value'] for job in results), [1, 3])
+
+    def test_failure_does_not_stop_stage(self):
+        results = []
+        pipeline = Pipeline([
+            Stage('fail', lambda job: job if job['value'] else 1 / 0),
+            Stage('collect', results.append),
+        ])
+        pipeline.submit(path='zero', value=0)
+        pipeline.submit(path='one', value=1)
+        pipeline.join()
+        self.assertEqual([job['path'] for job in results], ['one'])
+
+    def test_callbacks(self):
+        results = []
+        errors = []
+        pipeline = Pipeline([
+            Stage('check', lambda job: job if job['value'] else 1 / 0,
+                  on_result=lambda job, result: results.append(result['path']),
+                  on_error=lambda job, error: errors.append((job['path'], type(error)))),
+        ])
+        pipeline.submit(path='zero', value=0)
+        pipeline.submit(path='one', value=1)
+        pipeline.join()
+        self.assertEqual(results, ['one'])
+        self.assertEqual(errors, [('zero', ZeroDivisionError)])
+
+    def test_wait_for_room(self):
+        started = threading.Event()
+        release = threading.Event()
+
+        def block(job):
+            started.set()
+            release.wait()
+
+        pipeline = Pipeline([Stage('block', block)])
+        pipeline.wait_for_room()
+        pipeline.submit(path='first')
+        started.wait()
+        pipeline.wait_for_room()
+        pipeline.submit(path='second')
+        waiting = threading.Thread(target=pipeline.wait_for_room)
+        waiting.start()
+        waiting.join(0.2)
+        self.assertTrue(waiting.is_alive())
+        release.set()
+        waiting.join(5)
+        self.assertFalse(waiting.is_alive())
+        pipeline.join()
+
+    def test_metrics(self):
+        metrics.reset()
+        with ProcessPoolExecutor(2) as processes:
+            pipeline = Pipeline([
+                Stage('double', count_double, 2, processes),
+                Stage('fail', lambda job: 1 / 0),
+            ])
+            for value in range(3):
+                pipeline.submit(path=str(value), value=value)
+            pipeline.join()
+        text = metrics.render()
+        metrics.reset()
+        # Counted in the worker processes.
+        self.assertIn('doubled_total 3', text)
+        self.assertIn('stage_seconds_count{stage="double"} 3', text)
+        self.assertIn('stage_failures_total{stage="fail"} 3', text)
@@ -0,0 +1,46 @@
+from types import SimpleNamespace
+import unittest
+
+from prefilter import estimate_tokens, get_candidate_lines, score_segments, score_text
+
+
+def segments(*texts):
+    return [
+        SimpleNamespace(start=10.0 * n, end=10.0 * n + 10, text=text)
+        for n, text in enumerate(texts)
+    ]
+
+
+class TestPrefilter(unittest.TestCase):
+    def test_score_text(self):
+        self.assertEqual(score_text('Pizza is great.'), 0)
+        self.assertGreaterEqual(score_text('This episode is brought to you by Cyberdyne.'), 2)
+        self.assertGreaterEqual(score_text('Use promo code PIZZA at cyberdyne dot com.'), 3)
+        self.assertEqual(score_text('Cyberdyne makes robots.', ['Cyberdyne']), 2)
+
+    def test_score_segments_rolls(self):
+        texts = ['talk'] * 40
+        scores = score_segments(segments(*texts))
+        self.assertEqual(scores[0], 1)
+        self.assertEqual(scores[20], 0)
+        self.assertEqual(scores[-1], 1)
+
+    def test_get_candidate_lines(self):
+        texts = ['talk'] * 40
+        texts[20] = 'This show is brought to you by Cyberdyne.'
+        self.assertEqual(get_candidate_lines(segments(*texts), 2, 2), [18, 19, 20, 21, 22])
+        lines = get_candidate_lines(segments(*texts), 1, 0)
+        self.assertIn(0, lines)
+        self.assertIn(20, lines)
+        self.assertIn(39, lines)
+        self.assertNotIn(10, lines)
+        self.assertEqual(get_candidate_lines(segments(*texts), 3, 2), [])
+
+    def test_margin_stays_in_transcript(self):
+        texts = ['brought to you by Cyberdyne', 'talk', 'talk']
+        self.assertEqual(get_candidate_lines(segments(*texts), 2, 5), [0, 1, 2])
+
+    def test_estimate_tokens(self):
+        transcript = segments('a' * 40, 'b' * 80)
+        self.assertEqual(estimate_tokens(transcript), 32)
+        self.assertEqual(estimate_tokens(transcript, [0]), 11)
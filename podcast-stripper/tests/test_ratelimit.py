@@ -0,0 +1,102 @@
+from types import SimpleNamespace
+import unittest
+
+from openai import RateLimitError
+
+from ratelimit import RateLimiter, TokenBucket, get_retry_after, parse_reset
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+def rate_limit_error(headers):
+    response = SimpleNamespace(request=None, status_code=429, headers=headers)
+    return RateLimitError('slow down', response=response, body=None)
+
+
+class TestParseReset(unittest.TestCase):
+    def test_parse_reset(self):
+        self.assertEqual(parse_reset('1s'), 1)
+        self.assertEqual(parse_reset('6m0s'), 360)
+        self.assertAlmostEqual(parse_reset('20ms'), 0.02)
+        self.assertEqual(parse_reset('1h2m3s'), 3723)
+        self.assertEqual(parse_reset('2.5'), 2.5)
+        self.assertIsNone(parse_reset(None))
+        self.assertIsNone(parse_reset('soon'))
+
+    def test_get_retry_after(self):
+        self.assertEqual(get_retry_after({'retry-after-ms': '1500'}), 1.5)
+        self.assertEqual(get_retry_after({'retry-after': '3'}), 3)
+        self.assertIsNone(get_retry_after({}))
+        self.assertIsNone(get_retry_after(None))
+
+
+class TestTokenBucket(unittest.TestCase):
+    def test_spacing(self):
+        clock = FakeClock()
+        bucket = TokenBucket(60, clock=clock)
+        self.assertEqual(bucket.reserve(), 0)
+        self.assertAlmostEqual(bucket.reserve(), 1)
+        self.assertAlmostEqual(bucket.reserve(), 2)
+        clock.sleep(10)
+        self.assertEqual(bucket.reserve(), 0)
+
+    def test_block(self):
+        clock = FakeClock()
+        bucket = TokenBucket(6000, clock=clock)
+        bucket.block(5)
+        self.assertAlmostEqual(bucket.reserve(), 5)
+
+
+class TestRateLimiter(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.limiter = RateLimiter(
+            {'chat': 60}, retries=3, clock=self.clock, sleep=self.clock.sleep)
+
+    def test_call_returns_response(self):
+        self.assertEqual(self.limiter.call('chat', lambda x: x * 2, 21), 42)
+        self.assertEqual(self.limiter.requests['chat'], 1)
+        self.assertEqual(self.limiter.throttled_seconds['chat'], 0)
+
+    def test_throttles_to_rate(self):
+        for _ in range(3):
+            self.limiter.call('chat', lambda: None)
+        self.assertAlmostEqual(self.limiter.throttled_seconds['chat'], 2)
+
+    def test_retries_rate_limit_error(self):
+        errors = [rate_limit_error({'retry-after': '7'})]
+
+        def flaky():
+            if errors:
+                raise errors.pop()
+            return 'ok'
+
+        self.assertEqual(self.limiter.call('chat', flaky), 'ok')
+        self.assertEqual(self.limiter.rate_limited['chat'], 1)
+        self.assertGreaterEqual(self.limiter.throttled_seconds['chat'], 7)
+
+    def test_gives_up(self):
+        def always():
+            raise rate_limit_error({})
+
+        with self.assertRaises(RateLimitError):
+            self.limiter.call('chat', always)
+        self.assertEqual(self.limiter.rate_limited['chat'], 4)
+
+    def test_blocks_on_exhausted_headers(self):
+        response = SimpleNamespace(headers={
+            'x-ratelimit-remaining-requests': '0',
+            'x-ratelimit-reset-requests': '12s',
+        })
+        self.limiter.call('chat', lambda: response)
+        self.limiter.call('chat', lambda: None)
+        self.assertGreaterEqual(self.limiter.throttled_seconds['chat'], 12)
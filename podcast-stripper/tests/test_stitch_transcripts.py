@@ -0,0 +1,30 @@
+from types import SimpleNamespace
+import unittest
+
+from openai_util import stitch_transcripts
+
+
+def transcript(*texts):
+    return SimpleNamespace(
+        text=' '.join(texts),
+        segments=[
+            SimpleNamespace(id=n, start=2.0 * n, end=2.0 * n + 2, text=text)
+            for n, text in enumerate(texts)
+        ])
+
+
+class TestStitchTranscripts(unittest.TestCase):
+    def test_one(self):
+        stitched = stitch_transcripts([transcript('a', 'b')], [0])
+        self.assertEqual(stitched.text, 'a b')
+        self.assertEqual([segment.text for segment in stitched.segments], ['a', 'b'])
+
+    def test_offsets_and_numbering(self):
+        stitched = stitch_transcripts(
+            [transcript('a', 'b'), transcript('c'), transcript('d', 'e')],
+            [0, 100, 200])
+        self.assertEqual(stitched.text, 'a b c d e')
+        self.assertEqual([segment.id for segment in stitched.segments], [0, 1, 2, 3, 4])
+        self.assertEqual(
+            [(segment.start, segment.end) for segment in stitched.segments],
+            [(0, 2), (2, 4), (100, 102), (200, 202), (202, 204)])
@@ -0,0 +1,183 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from click.testing import CliRunner
+
+import stripper
+from backends import Backend, FakeBackend
+from batch import BatchQueue
+from edl import get_sidecar_path, read_sidecar
+from fingerprint import is_available
+from jobs import JobQueue
+from openai import OpenAI
+from tests.batch_server import BatchServer
+
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+# A minute long, with cover art. The fake backend below hears a 20 second
+# commercial for Sponsor 0 from 40 seconds in.
+EPISODE = os.path.join(TEST_DIR, 'pizza_pod.mp3')
+
+
+# Drives the stripper's stages, pipeline and commands as --monitor and the
+# other commands would, with the fake backend and a feed directory of our own.
+class TestStripper(unittest.TestCase):
+    def setUp(self):
+        self.temp = tempfile.TemporaryDirectory()
+        self.root = os.path.join(self.temp.name, 'podcasts')
+        self.feed = os.path.join(self.root, 'pizza')
+        os.makedirs(self.feed)
+        self.cache_dir = os.path.join(self.temp.name, 'cache')
+        stripper.sponsor_cache.configure(os.path.join(self.cache_dir, 'tts'))
+        stripper.result_cache.configure(os.path.join(self.cache_dir, 'results'))
+        stripper.configure_render_caches(self.cache_dir)
+        stripper.scratch.update(directory=self.temp.name)
+        self.set_version('v9')
+        fake = FakeBackend(line_seconds=2, period=80, length=20)
+        self.backend = Backend(fake, fake, fake)
+        self.job_queue = JobQueue(os.path.join(self.temp.name, 'jobs.sqlite3'))
+
+    def tearDown(self):
+        stripper.sponsor_cache.configure(None)
+        stripper.result_cache.configure(None)
+        stripper.art_cache.configure(None)
+        stripper.fingerprint_index.configure(None)
+        stripper.VERSION_FILE = 'version'
+        stripper.get_version.cache_clear()
+        self.temp.cleanup()
+
+    def set_version(self, version):
+        stripper.VERSION_FILE = os.path.join(self.temp.name, 'version')
+        with open(stripper.VERSION_FILE, 'w') as file:
+            file.write(f'{version}\n')
+        stripper.get_version.cache_clear()
+
+    def add_episode(self, filename='2024-01-01-pizza-aaaaaaaa.mp3'):
+        path = os.path.join(self.feed, filename)
+        shutil.copy(EPISODE, path)
+        return path
+
+    def wait_for(self, job_id, states, timeout=60):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            job = self.job_queue.get(job_id)
+            if job['state'] in states:
+                return job
+            time.sleep(0.1)
+        self.fail(f'Job {job_id} still {job["state"]}')
+
+    def get_states(self):
+        return {state: count for state, count, _ in self.job_queue.status() if count}
+
+    def take(self):
+        job = self.job_queue.take(timeout=0)
+        return stripper.get_job(**job)
+
+    def test_strip_all(self):
+        path = self.add_episode()
+        stripper.strip_all(self.job_queue, self.root, **stripper.DEFAULT_SETTINGS)
+        self.assertEqual(self.get_states(), {'queued': 1})
+        # Already queued.
+        stripper.strip_all(self.job_queue, self.root, **stripper.DEFAULT_SETTINGS)
+        self.assertEqual(self.get_states(), {'queued': 1})
+
+        stripper.make_pipeline(self.backend, 1, 1, self.job_queue)
+        job = self.wait_for(1, ('rendered', 'failed'))
+        self.assertEqual(job['state'], 'rendered')
+        output = os.path.join(self.feed, '2024-01-01-pizza-aaaaaaaa-stripped.v9.mp3')
+        self.assertEqual(job['output'], output)
+        self.assertEqual([commercial['sponsor'] for commercial in job['commercials']],
+                         ['Sponsor 0'])
+        # Twenty seconds of commercial become a second of silence on either side
+        # of a two second announcement.
+        self.assertAlmostEqual(stripper.get_duration(output),
+                               stripper.get_duration(path) - 20 + 4, delta=1.5)
+        plan = read_sidecar(get_sidecar_path(path))
+        self.assertEqual(plan['version'], 'v9')
+        self.assertTrue(os.path.exists(os.path.join(self.feed, plan['parts'][1]['file'])))
+
+        # Stripped, so not queued again.
+        stripper.strip_all(self.job_queue, self.root, **stripper.DEFAULT_SETTINGS)
+        self.assertEqual(self.get_states(), {'rendered': 1})
+
+    def test_batch(self):
+        server = BatchServer(polls_before_done=0)
+        self.addCleanup(server.stop)
+        batch_queue = BatchQueue(OpenAI(api_key='test', base_url=server.base_url,
+                                        max_retries=0))
+        path = self.add_episode()
+        stripper.strip_all(self.job_queue, self.root, **{**stripper.DEFAULT_SETTINGS,
+                                                         'batch': True})
+        job = stripper.reduce_stage(self.take())
+        self.assertIsNone(stripper.analyze_stage(self.backend, job, self.job_queue,
+                                                 batch_queue))
+        self.assertEqual(self.job_queue.get(job['id'])['state'], 'batched')
+        self.assertIsNone(self.job_queue.take(timeout=0))
+
+        self.assertEqual(batch_queue.run_once(), [job['id']])
+        self.job_queue.advance(job['id'], 'transcribed')
+        job = self.take()
+        self.assertEqual(job['path'], path)
+        job = stripper.analyze_stage(self.backend, stripper.reduce_stage(job), self.job_queue,
+                                     batch_queue)
+        self.assertEqual([commercial['sponsor'] for commercial in job['commercials']],
+                         ['Sponsor 0'])
+        self.assertEqual(self.job_queue.get(job['id'])['state'], 'detected')
+
+    @unittest.skipUnless(is_available(), 'needs numpy')
+    def test_fingerprint(self):
+        stripper.fingerprint_index.configure(os.path.join(self.cache_dir, 'fingerprints'))
+        settings = {**stripper.DEFAULT_SETTINGS, 'fingerprint': True}
+        first = self.add_episode('2024-01-01-pizza-aaaaaaaa.mp3')
+        job = stripper.analyze_stage(
+            self.backend, stripper.reduce_stage(stripper.get_job(first, 'a.mp3', **settings)))
+        self.assertFalse(job['commercials'][0].get('known'))
+        self.assertEqual(len(stripper.fingerprint_index), 1)
+
+        second = self.add_episode('2024-01-02-pizza-bbbbbbbb.mp3')
+        job = stripper.analyze_stage(
+            self.backend, stripper.reduce_stage(stripper.get_job(second, 'b.mp3', **settings)))
+        [commercial] = job['commercials']
+        self.assertTrue(commercial.get('known'))
+        self.assertEqual(commercial['sponsor'], 'Sponsor 0')
+
+    def test_status_and_retry_failed(self):
+        path = self.add_episode()
+        job_queue = stripper.get_job_queue(self.cache_dir, max_attempts=1)
+        job_id = job_queue.add(path, 'out.mp3', {}, 'hash')
+        job_queue.take(timeout=0)
+        job_queue.fail(job_id, 'oops')
+        runner = CliRunner()
+        result = runner.invoke(stripper.main, ['status', '--cache-dir', self.cache_dir])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn('failed: 1', result.output)
+        self.assertIn('oops', result.output)
+
+        result = runner.invoke(stripper.main, ['retry-failed', '--cache-dir', self.cache_dir])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn('Retrying 1 episodes', result.output)
+        self.assertEqual(job_queue.get(job_id)['state'], 'queued')
+
+    def test_rerender(self):
+        path = self.add_episode()
+        job = stripper.analyze_stage(self.backend, stripper.reduce_stage(stripper.get_job(
+            path, os.path.join(self.feed, '2024-01-01-pizza-aaaaaaaa-stripped.v9.mp3'))))
+        stripper.render_stage(job)
+        self.assertTrue(os.path.exists(job['output']))
+
+        self.set_version('v10')
+        result = CliRunner().invoke(stripper.main, [
+            'rerender', self.root, '--jobs', '1', '--cache-dir', self.cache_dir,
+            '--scratch-dir', self.temp.name])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn('Rendered 1 of 1 episodes', result.output)
+        self.assertFalse(os.path.exists(job['output']))
+        self.assertTrue(os.path.exists(
+            os.path.join(self.feed, '2024-01-01-pizza-aaaaaaaa-stripped.v10.mp3')))
+        self.assertEqual(read_sidecar(get_sidecar_path(path))['version'], 'v10')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+import os
+import tempfile
+import unittest
+
+from watch import Debouncer, is_episode, scan_episodes
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestWatch(unittest.TestCase):
+    def test_is_episode(self):
+        self.assertTrue(is_episode('2024-01-01-feed-abcdef12.mp3'))
+        self.assertFalse(is_episode('2024-01-01-feed-abcdef12.mp3.part'))
+        self.assertFalse(is_episode('2024-01-01-feed-abcdef12-stripped.1.2.mp3'))
+        self.assertFalse(is_episode('.2024-01-01-feed-abcdef12.mp3'))
+        self.assertFalse(is_episode('feed.xml'))
+
+    def test_scan_episodes(self):
+        with tempfile.TemporaryDirectory() as directory:
+            files = [
+                'one/2024-01-01-one-aaaaaaaa.mp3',
+                'one/2024-01-01-one-aaaaaaaa-stripped.v1.mp3',
+                'one/2024-01-02-one-bbbbbbbb.mp3',
+                'one/2024-01-03-one-cccccccc.mp3.part',
+                'two/2024-01-01-two-dddddddd.mp3',
+                'two/notes.txt',
+            ]
+            for file in files:
+                os.makedirs(os.path.join(directory, os.path.dirname(file)), exist_ok=True)
+                open(os.path.join(directory, file), 'w').close()
+            open(os.path.join(directory, 'index.html'), 'w').close()
+
+            self.assertEqual(list(scan_episodes(directory)), [
+                os.path.join(directory, 'one/2024-01-02-one-bbbbbbbb.mp3'),
+                os.path.join(directory, 'two/2024-01-01-two-dddddddd.mp3'),
+            ])
+
+            # Too new, it may still be being written.
+            old = os.path.join(directory, 'two/2024-01-01-two-dddddddd.mp3')
+            os.utime(old, (0, 0))
+            self.assertEqual(list(scan_episodes(directory, min_age=60)), [old])
+
+    def test_debounce(self):
+        clock = Clock()
+        submitted = []
+        debouncer = Debouncer(submitted.append, quiet=2, clock=clock)
+        debouncer.touch('a.mp3')
+        clock.now += 1
+        debouncer.touch('a.mp3')
+        debouncer.touch('b.mp3')
+        clock.now += 1.5
+        debouncer.flush()
+        self.assertEqual(submitted, [])
+        clock.now += 0.5
+        debouncer.flush()
+        self.assertEqual(submitted, ['a.mp3', 'b.mp3'])
+        clock.now += 10
+        debouncer.flush()
+        self.assertEqual(submitted, ['a.mp3', 'b.mp3'])
+
+
+if __name__ == '__main__':
+    unittest.main()
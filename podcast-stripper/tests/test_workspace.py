@@ -0,0 +1,73 @@
+import os
+import pickle
+import tempfile
+import unittest
+
+from workspace import Workspace, new_file
+
+
+class TestWorkspace(unittest.TestCase):
+    def setUp(self):
+        self.temp = tempfile.TemporaryDirectory()
+        self.disk = os.path.join(self.temp.name, 'disk')
+        self.ram = os.path.join(self.temp.name, 'ram')
+        os.mkdir(self.disk)
+        os.mkdir(self.ram)
+
+    def tearDown(self):
+        self.temp.cleanup()
+
+    def test_new_file(self):
+        with Workspace(self.disk) as workspace:
+            file = workspace.new_file('.wav')
+            self.assertTrue(os.path.isfile(file))
+            self.assertTrue(file.endswith('.wav'))
+            self.assertTrue(file.startswith(workspace.directory))
+            self.assertNotEqual(file, workspace.new_file('.wav'))
+
+    def test_cleanup(self):
+        with Workspace(self.disk, self.ram, 1000) as workspace:
+            with open(workspace.new_file(), 'wb') as file:
+                file.write(bytes(100))
+        self.assertEqual(os.listdir(self.disk), [])
+        self.assertEqual(os.listdir(self.ram), [])
+
+    def test_cleanup_on_failure(self):
+        with self.assertRaises(RuntimeError):
+            with Workspace(self.disk) as workspace:
+                workspace.new_file()
+                raise RuntimeError('failed')
+        self.assertEqual(os.listdir(self.disk), [])
+
+    def test_ram_budget(self):
+        with Workspace(self.disk, self.ram, 1000) as workspace:
+            small = workspace.new_file(size=600)
+            self.assertTrue(small.startswith(workspace.ram_directory))
+            with open(small, 'wb') as file:
+                file.write(bytes(600))
+            self.assertTrue(workspace.new_file(size=600).startswith(workspace.directory))
+            self.assertTrue(workspace.new_file(size=400).startswith(workspace.ram_directory))
+
+    def test_no_ram_directory(self):
+        with Workspace(self.disk, None, 1000) as workspace:
+            self.assertTrue(workspace.new_file(size=1).startswith(workspace.directory))
+
+    def test_peak(self):
+        workspace = Workspace(self.disk, self.ram, 1000)
+        for size in (300, 2000):
+            with open(workspace.new_file(size=size), 'wb') as file:
+                file.write(bytes(size))
+        # Another process may add files to the same workspace.
+        copy = pickle.loads(pickle.dumps(workspace))
+        copy.new_file()
+        os.remove(copy.new_file())
+        self.assertEqual(workspace.cleanup(), 2300)
+
+    def test_new_file_without_workspace(self):
+        file = new_file(None, '.mp3')
+        self.assertTrue(os.path.isfile(file))
+        os.remove(file)
+
+
+if __name__ == '__main__':
+    unittest.main()
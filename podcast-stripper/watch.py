@@ -0,0 +1,77 @@
+import os
+import threading
+import time
+
+try:
+    from ..common import FeedDirectory, is_stripped_filename
+except ImportError:
+    from file_util import FeedDirectory, is_stripped_filename
+
+
+# Downloads in progress end in .part and hidden files are someone's
+# temporary files.
+def is_episode(filename):
+    return (filename.endswith('.mp3')
+            and not filename.startswith('.')
+            and not is_stripped_filename(filename))
+
+
+# Paths of complete episodes under scan_directory/*/ without a stripped
+# version. Files changed within the last min_age seconds may still be being
+# written, and are left for the next scan. Pass the same directories dict to
+# each scan to only re-read feed directories that changed.
+def scan_episodes(scan_directory, min_age=0, directories=None, clock=time.time):
+    if directories is None:
+        directories = {}
+    now = clock()
+    with os.scandir(scan_directory) as feeds:
+        feed_directories = sorted(feed.path for feed in feeds if feed.is_dir())
+    for feed_directory in feed_directories:
+        if feed_directory in directories:
+            directories[feed_directory].refresh()
+        else:
+            directories[feed_directory] = FeedDirectory(feed_directory)
+        for episode in sorted(directories[feed_directory].unstripped(),
+                              key=lambda episode: episode.filename):
+            path = os.path.join(feed_directory, episode.filename)
+            try:
+                if now - os.stat(path).st_mtime < min_age:
+                    continue
+            except FileNotFoundError:
+                continue
+            yield path
+
+
+# Collects paths from a burst of events and hands each to submit once it has
+# been quiet for quiet seconds.
+class Debouncer:
+    def __init__(self, submit, quiet=2, clock=time.monotonic):
+        self.submit = submit
+        self.quiet = quiet
+        self.clock = clock
+        self.pending = {}
+        self.lock = threading.Lock()
+
+    def touch(self, path):
+        with self.lock:
+            self.pending[path] = self.clock()
+
+    def flush(self):
+        now = self.clock()
+        with self.lock:
+            due = [path for path, seen in self.pending.items() if now - seen >= self.quiet]
+            for path in due:
+                del self.pending[path]
+        for path in due:
+            try:
+                self.submit(path)
+            except Exception as error:
+                print(f'Failed to submit {path}: {error!r}')
+
+    def run(self):
+        while True:
+            time.sleep(self.quiet / 2)
+            self.flush()
+
+    def start(self):
+        threading.Thread(target=self.run, name='debounce', daemon=True).start()
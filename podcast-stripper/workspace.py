@@ -0,0 +1,77 @@
+import os
+import shutil
+import tempfile
+
+
+# Scratch space for the intermediate files of one job: sponsor announcements,
+# clips and cover art. Files go in ram_directory (a tmpfs such as /dev/shm)
+# while they add up to no more than ram_budget bytes, and in directory
+# otherwise. Everything is removed by cleanup, or when the with block ends,
+# however the job went.
+#
+# A Workspace is pickled along with its job to the processes that reduce and
+# render it, so it only holds paths and numbers, and measures what is there
+# rather than keeping count.
+class Workspace:
+    def __init__(self, directory=None, ram_directory=None, ram_budget=0, prefix='job-'):
+        self.prefix = prefix
+        self.directory = tempfile.mkdtemp(prefix=prefix, dir=directory)
+        self.ram_directory = None
+        if ram_directory and ram_budget > 0:
+            self.ram_directory = tempfile.mkdtemp(prefix=prefix, dir=ram_directory)
+        self.ram_budget = ram_budget
+        self.peak = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        self.cleanup()
+
+    def directories(self):
+        return [directory for directory in (self.ram_directory, self.directory) if directory]
+
+    @staticmethod
+    def get_bytes(directory):
+        try:
+            with os.scandir(directory) as entries:
+                return sum(entry.stat().st_size for entry in entries if entry.is_file())
+        except FileNotFoundError:
+            return 0
+
+    def get_ram_bytes(self):
+        return self.get_bytes(self.ram_directory) if self.ram_directory else 0
+
+    # Bytes in the workspace now, which also updates the peak.
+    def measure(self):
+        used = sum(self.get_bytes(directory) for directory in self.directories())
+        self.peak = max(self.peak, used)
+        return used
+
+    # Whether size more bytes fit in our share of RAM, and in the tmpfs, which
+    # other jobs share.
+    def fits_in_ram(self, size):
+        return (self.ram_directory is not None
+                and self.get_ram_bytes() + size <= self.ram_budget
+                and size < shutil.disk_usage(self.ram_directory).free)
+
+    # A new empty file for about size bytes, in RAM if it fits.
+    def new_file(self, suffix='', size=0):
+        self.measure()
+        directory = self.ram_directory if self.fits_in_ram(size) else self.directory
+        with tempfile.NamedTemporaryFile(delete=False, suffix=suffix, dir=directory) as file:
+            return file.name
+
+    def cleanup(self):
+        self.measure()
+        for directory in self.directories():
+            shutil.rmtree(directory, ignore_errors=True)
+        return self.peak
+
+
+# Where new files go for code that may run without a workspace.
+def new_file(workspace, suffix='', size=0):
+    if workspace is not None:
+        return workspace.new_file(suffix, size)
+    with tempfile.NamedTemporaryFile(delete=False, suffix=suffix) as file:
+        return file.name